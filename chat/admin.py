@@ -1,13 +1,32 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Channel, Message, ChannelMembership
+from django.urls import reverse
+from django.utils.html import format_html
+from . import jobs
+from .admin_lists import LargeTableAdminMixin, estimated_count
+from .models import ArchiveSegment, CustomUser, Channel, Message, ChannelMembership, RetentionPolicy
 from .forms import CustomUserCreationForm, CustomUserUpdateForm
 from django.contrib import admin
 from .models import ChannelMembership
 
+# Channels with more members than this are managed from the membership changelist.
+INLINE_MEMBER_LIMIT = getattr(settings, 'CHAT_ADMIN_INLINE_MEMBER_LIMIT', 50)
+
+
+def queue_bulk_action(modeladmin, request, queryset, func, description):
+    """Run an admin action as a chunked background job and tell the user so."""
+    count, estimated = estimated_count(queryset)
+    jobs.submit(queryset, func, description)
+    modeladmin.message_user(
+        request, f"{description.capitalize()}: {'about ' if estimated else ''}{count} rows queued; the change runs in the background.",
+    )
+
+
 class ChannelMembershipInline(admin.TabularInline):
     model = ChannelMembership
     extra = 1  # how many empty forms to show
+    autocomplete_fields = ['user']
 
 
 @admin.register(CustomUser)
@@ -51,36 +70,103 @@ class CustomUserAdmin(UserAdmin):
 
 @admin.register(Channel)
 class ChannelAdmin(admin.ModelAdmin):
-    list_display = ['name', 'created_by', 'is_group_chat', 'max_file_size']
-    list_filter = ['is_group_chat']
+    list_display = ['name', 'created_by', 'is_group_chat', 'is_broadcast', 'max_file_size']
+    list_filter = ['is_group_chat', 'is_broadcast']
+    list_select_related = ['created_by']
     search_fields = ['name']
+    autocomplete_fields = ['created_by']
+    readonly_fields = ['manage_members']
     inlines = [ChannelMembershipInline]  # ✅ use inline instead of filter_horizontal
 
+    def _member_count(self, obj):
+        return ChannelMembership.objects.filter(channel=obj)[:INLINE_MEMBER_LIMIT + 1].count()
+
+    def get_inlines(self, request, obj):
+        # One form per member does not scale; large channels get a link instead.
+        if obj is not None and self._member_count(obj) > INLINE_MEMBER_LIMIT:
+            return []
+        return super().get_inlines(request, obj)
+
+    def manage_members(self, obj):
+        if obj is None or obj.pk is None:
+            return '-'
+        count = self._member_count(obj)
+        url = reverse('admin:chat_channelmembership_changelist') + f'?channel__id__exact={obj.pk}'
+        label = f'more than {INLINE_MEMBER_LIMIT}' if count > INLINE_MEMBER_LIMIT else count
+        return format_html('<a href="{}">Manage members ({})</a>', url, label)
+
 
 
 @admin.register(ChannelMembership)
-class ChannelMembershipAdmin(admin.ModelAdmin):
-    list_display = ['user', 'channel', 'can_send_messages']
+class ChannelMembershipAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ['user', 'channel', 'can_send_messages', 'last_read_message_id']
     list_filter = ['can_send_messages']
+    list_select_related = ['user', 'channel']
+    autocomplete_fields = ['user', 'channel']
     search_fields = ['user__username', 'channel__name']
+    search_help_text = 'Exact username, or part of a channel name.'
     actions = ['allow_sending_messages', 'disallow_sending_messages']
 
+    def get_search_results(self, request, queryset, search_term):
+        # Resolve the small tables first, then probe memberships through their indexes.
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        user_ids = CustomUser.objects.filter(username__iexact=term).values_list('id', flat=True)
+        channel_ids = Channel.objects.filter(name__icontains=term).values_list('id', flat=True)
+        return queryset.filter(user_id__in=list(user_ids)) | queryset.filter(channel_id__in=list(channel_ids)), False
+
     def allow_sending_messages(self, request, queryset):
-        queryset.update(can_send_messages=True)
+        queue_bulk_action(self, request, queryset, _allow_sending, 'allowing sending')
 
     allow_sending_messages.short_description = "Allow selected users to send messages"
 
     def disallow_sending_messages(self, request, queryset):
-        queryset.update(can_send_messages=False)
+        queue_bulk_action(self, request, queryset, _disallow_sending, 'disallowing sending')
 
     disallow_sending_messages.short_description = "Disallow selected users from sending messages"
 
 
+def _allow_sending(queryset):
+    return queryset.update(can_send_messages=True)
+
+
+def _disallow_sending(queryset):
+    return queryset.update(can_send_messages=False)
+
+
+def _delete(queryset):
+    return queryset.delete()
+
+
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
-    list_display = ['sender', 'recipient', 'channel', 'content', 'timestamp', 'read']
-    list_filter = ['read', 'timestamp']
+class MessageAdmin(LargeTableAdminMixin, admin.ModelAdmin):
+    list_display = ['sender', 'recipient', 'channel', 'content', 'timestamp']
+    list_filter = ['timestamp']
+    list_select_related = ['sender', 'recipient', 'channel']
+    date_hierarchy = 'timestamp'
+    raw_id_fields = ['sender', 'recipient', 'channel']
     search_fields = ['sender__username']
+    search_help_text = 'Exact username of the sender.'
+    actions = ['delete_in_background']
+
+    def get_search_results(self, request, queryset, search_term):
+        # A LIKE over the joined user table scans every message; resolve the sender first.
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        sender_ids = CustomUser.objects.filter(username__iexact=term).values_list('id', flat=True)
+        return queryset.filter(sender_id__in=list(sender_ids)), False
+
+    def get_actions(self, request):
+        # The stock action loads every selected message for its confirmation page.
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    @admin.action(permissions=['delete'], description='Delete selected messages in the background')
+    def delete_in_background(self, request, queryset):
+        queue_bulk_action(self, request, queryset, _delete, 'deleting messages')
 
     def masked_content(self, obj):
         return '•••••••••' if obj.content else '(empty)'
@@ -89,4 +175,20 @@ class MessageAdmin(admin.ModelAdmin):
     exclude = ('content',)
 
 
+@admin.register(RetentionPolicy)
+class RetentionPolicyAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'archive_after_days', 'purge_attachments']
+    autocomplete_fields = ['channel']
 
+
+@admin.register(ArchiveSegment)
+class ArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ['conversation', 'month', 'message_count', 'first_message_id', 'last_message_id', 'updated_at']
+    search_fields = ['conversation']
+    date_hierarchy = 'month'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,202 @@
+"""
+Retention tiering: old messages move out of the Message table into compressed files.
+
+Each ``RetentionPolicy`` names an age for one channel, or for all private
+conversations.  ``archive_expired`` moves older messages into gzip JSONL
+files under ``CHAT_ARCHIVE_ROOT``, one file per conversation and month,
+indexed by ``ArchiveSegment`` rows, and then deletes them from the table.
+A line keeps the message's own columns.  Sender names and pictures are
+joined in when a page is read, so they stay current.
+
+History pages continue into the archive once the table runs out
+(``page_before``).  Archived attachments are still served unless their
+policy purges the files.  Archived messages leave the search index.
+"""
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import timedelta, timezone as dt_timezone
+from functools import lru_cache
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import inbox, message_cache
+from .media import can_access
+from .models import ArchiveSegment, ChannelMembership, CustomUser, Message, RetentionPolicy, conversation_key
+from .serializers import MESSAGE_FIELDS
+
+COLUMNS = ('id', 'sender_id', 'channel_id', 'recipient_id', 'content', 'file', 'file_type', 'thumbnail', 'timestamp')
+BATCH_SIZE = getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 5000)
+
+
+def archive_root():
+    return Path(getattr(settings, 'CHAT_ARCHIVE_ROOT', settings.BASE_DIR / 'archive'))
+
+
+def segment_path(key, month):
+    return f"{key.replace(':', '_')}/{month:%Y-%m}.jsonl.gz"
+
+
+def _key(row):
+    if row['channel_id']:
+        return conversation_key(channel_id=row['channel_id'])
+    return conversation_key(user_ids=(row['sender_id'], row['recipient_id']))
+
+
+def _month(timestamp):
+    return timestamp.astimezone(dt_timezone.utc).date().replace(day=1)
+
+
+def _write(path, rows):
+    target = archive_root() / path
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(target.name + '.partial')
+    with gzip.open(partial, 'wt', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps({**row, 'timestamp': row['timestamp'].isoformat()}, separators=(',', ':')) + '\n')
+    os.replace(partial, target)
+
+
+@lru_cache(maxsize=64)
+def _read(path, version):
+    with gzip.open(archive_root() / path, 'rt', encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f]
+    for row in rows:
+        row['timestamp'] = parse_datetime(row['timestamp'])
+    return tuple(rows)
+
+
+def read_segment(segment):
+    """The archived rows of ``segment``, oldest first."""
+    return _read(segment.path, segment.updated_at.isoformat())
+
+
+def _purge_files(rows):
+    storage = Message._meta.get_field('file').storage
+    for row in rows:
+        for name in (row['file'], row['thumbnail']):
+            if name:
+                storage.delete(name)
+
+
+def _archive_group(key, month, rows, purge_attachments):
+    segment = ArchiveSegment.objects.filter(conversation=key, month=month).first()
+    merged = {row['id']: row for row in (read_segment(segment) if segment else ())}
+    for row in rows:
+        merged[row['id']] = {**row, 'file': '', 'thumbnail': ''} if purge_attachments else row
+    ordered = sorted(merged.values(), key=lambda row: row['id'])
+    path = segment.path if segment else segment_path(key, month)
+    # Written before the rows are deleted: a crash in between leaves them in
+    # both places, and the next run merges them again by id.
+    _write(path, ordered)
+    with transaction.atomic():
+        ArchiveSegment.objects.update_or_create(conversation=key, month=month, defaults={
+            'path': path,
+            'first_message_id': ordered[0]['id'],
+            'last_message_id': ordered[-1]['id'],
+            'message_count': len(ordered),
+        })
+        Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        transaction.on_commit(lambda: message_cache.invalidate(key))
+        inbox.refresh_on_commit([key])
+        if purge_attachments:
+            transaction.on_commit(lambda: _purge_files(rows))
+
+
+def archive_messages(queryset, purge_attachments=False, batch_size=None):
+    """Move the messages of ``queryset`` into the archive; returns how many were moved."""
+    batch_size = batch_size or BATCH_SIZE
+    moved = 0
+    while True:
+        rows = list(queryset.order_by('id').values(*COLUMNS)[:batch_size])
+        if not rows:
+            return moved
+        groups = defaultdict(list)
+        for row in rows:
+            groups[_key(row), _month(row['timestamp'])].append(row)
+        for (key, month), group in groups.items():
+            _archive_group(key, month, group, purge_attachments)
+        moved += len(rows)
+
+
+def archive_expired(now=None, batch_size=None):
+    """Apply every retention policy; returns ``{policy: messages moved}``."""
+    now = now or timezone.now()
+    moved = {}
+    for policy in RetentionPolicy.objects.select_related('channel'):
+        cutoff = now - timedelta(days=policy.archive_after_days)
+        if policy.channel_id:
+            expired = Message.objects.filter(channel_id=policy.channel_id, timestamp__lt=cutoff)
+        else:
+            expired = Message.objects.filter(channel__isnull=True, timestamp__lt=cutoff)
+        moved[policy] = archive_messages(expired, policy.purge_attachments, batch_size)
+    return moved
+
+
+def _with_senders(rows):
+    """Archived rows in the ``values(*MESSAGE_FIELDS)`` form, with the senders' current profiles."""
+    senders = {
+        sender['id']: sender for sender in CustomUser.objects.filter(id__in={row['sender_id'] for row in rows}).values(
+            'id', 'username', 'first_name', 'last_name', 'profile_image', 'profile_thumbnail',
+        )
+    }
+    missing = {'username': 'deleted user', 'first_name': '', 'last_name': '', 'profile_image': '', 'profile_thumbnail': None}
+    result = []
+    for row in rows:
+        sender = senders.get(row['sender_id'], missing)
+        full = {**row, **{f'sender__{name}': value for name, value in sender.items() if name != 'id'}}
+        result.append({field: full[field] for field in MESSAGE_FIELDS})
+    return result
+
+
+def page_before(key, before_id=None, size=0):
+    """The ``size`` newest archived messages of ``key`` older than ``before_id``, oldest first, plus a has-more flag.
+
+    ``size=0`` only answers whether anything older is archived.
+    """
+    segments = ArchiveSegment.objects.filter(conversation=key)
+    if before_id:
+        segments = segments.filter(first_message_id__lt=before_id)
+    rows = []
+    # A conversation's segments are months, so their id ranges do not overlap.
+    for segment in segments.order_by('-last_message_id').iterator():
+        rows = [row for row in read_segment(segment) if not before_id or row['id'] < int(before_id)] + rows
+        if len(rows) > size:
+            break
+    page = rows[-size:] if size else []
+    return _with_senders(page), len(rows) > size
+
+
+def has_older(key, before_id=None):
+    segments = ArchiveSegment.objects.filter(conversation=key)
+    if before_id:
+        segments = segments.filter(first_message_id__lt=before_id)
+    return segments.exists()
+
+
+def get_attachment(user, message_id):
+    """An unsaved ``Message`` carrying an archived attachment the user may see, or Http404."""
+    # Only segments of the user's own conversations can hold a message they may see.
+    mine = Q(conversation__startswith=f'private:{user.id}:') | Q(
+        conversation__startswith='private:', conversation__endswith=f':{user.id}'
+    )
+    if user.is_superuser:
+        mine |= Q(conversation__startswith='channel:')
+    else:
+        channel_ids = ChannelMembership.objects.filter(user=user).values_list('channel_id', flat=True)
+        mine |= Q(conversation__in=[conversation_key(channel_id=channel_id) for channel_id in channel_ids])
+    segments = ArchiveSegment.objects.filter(mine, first_message_id__lte=message_id, last_message_id__gte=message_id)
+    for segment in segments:
+        for row in read_segment(segment):
+            if row['id'] == message_id and row['file']:
+                message = Message(**{column: row[column] for column in COLUMNS})
+                if can_access(user, message):
+                    return message
+    raise Http404('No such attachment')
@@ -0,0 +1,51 @@
+"""
+Benchmark helpers shared by the ``bench_*`` management commands.
+
+Benchmarks never touch the configured database: they run inside a throwaway
+test database (optionally kept on disk with ``--db-path``/``--keepdb`` so large
+datasets only have to be generated once).
+"""
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+@contextmanager
+def benchmark_database(path=None, keepdb=False):
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    if path:
+        test_settings['NAME'] = str(path)
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def time_call(func, repeat):
+    """Run ``func`` ``repeat`` times and return the latencies in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summarize(samples):
+    return {
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'mean': statistics.fmean(samples) if samples else 0.0,
+    }
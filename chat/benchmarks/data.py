@@ -0,0 +1,102 @@
+"""
+Synthetic data generator for benchmarks.
+
+Activity is Zipf-skewed: a few users and channels produce most of the
+traffic, which is what makes the hot paths (busy channels, chatty contacts)
+behave like production.
+"""
+import itertools
+import random
+
+from django.db import transaction
+
+from ..inbox import rebuild
+from ..models import Channel, ChannelMembership, CustomUser, Message, conversation_key
+
+
+def zipf_weights(count, exponent=1.1):
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def ensure_users(count):
+    existing = CustomUser.objects.count()
+    CustomUser.objects.bulk_create(
+        [CustomUser(username=f'bench_user_{index}', password='!') for index in range(existing, count)],
+        batch_size=1000,
+    )
+    return list(CustomUser.objects.order_by('id').values_list('id', flat=True)[:count])
+
+
+def ensure_channels(count, user_ids, members_per_channel=50, seed=0):
+    rng = random.Random(seed)
+    existing = Channel.objects.count()
+    if existing < count:
+        new_channels = Channel.objects.bulk_create(
+            [
+                Channel(name=f'bench_channel_{index}', created_by_id=rng.choice(user_ids), is_group_chat=index % 2 == 0)
+                for index in range(existing, count)
+            ],
+            batch_size=1000,
+        )
+        memberships = []
+        for channel in new_channels:
+            members = set(rng.sample(user_ids, min(members_per_channel, len(user_ids))))
+            members.add(channel.created_by_id)
+            memberships.extend(
+                ChannelMembership(user_id=user_id, channel_id=channel.id, can_send_messages=True)
+                for user_id in members
+            )
+        ChannelMembership.objects.bulk_create(memberships, batch_size=5000, ignore_conflicts=True)
+    return list(Channel.objects.order_by('id').values_list('id', flat=True)[:count])
+
+
+def channel_members(channel_ids):
+    members = {}
+    for channel_id, user_id in ChannelMembership.objects.filter(channel_id__in=channel_ids).values_list('channel', 'user'):
+        members.setdefault(channel_id, []).append(user_id)
+    return members
+
+
+def ensure_messages(count, user_ids, channel_ids, private_ratio=0.5, seed=0, batch_size=10000, progress=None):
+    """Top the message table up to ``count`` rows."""
+    rng = random.Random(seed + Message.objects.count())
+    user_weights = zipf_weights(len(user_ids))
+    channel_weights = zipf_weights(len(channel_ids)) if channel_ids else None
+    members = channel_members(channel_ids)
+    remaining = count - Message.objects.count()
+    while remaining > 0:
+        batch = []
+        for _ in range(min(batch_size, remaining)):
+            if not channel_ids or rng.random() < private_ratio:
+                sender_id, recipient_id = rng.choices(user_ids, cum_weights=user_weights, k=2)
+                if sender_id == recipient_id:
+                    recipient_id = rng.choice(user_ids)
+                if sender_id == recipient_id:
+                    continue
+                batch.append(Message(
+                    sender_id=sender_id,
+                    recipient_id=recipient_id,
+                    conversation=conversation_key(user_ids=(sender_id, recipient_id)),
+                    content='bench message',
+                ))
+            else:
+                channel_id = rng.choices(channel_ids, cum_weights=channel_weights)[0]
+                batch.append(Message(
+                    sender_id=rng.choice(members[channel_id]),
+                    channel_id=channel_id,
+                    content='bench message',
+                ))
+        with transaction.atomic():
+            Message.objects.bulk_create(batch, batch_size=1000)
+        remaining -= len(batch)
+        if progress:
+            progress(count - remaining)
+
+
+def generate(users, channels, messages, private_ratio=0.5, seed=0, progress=None):
+    user_ids = ensure_users(users)
+    channel_ids = ensure_channels(channels, user_ids, seed=seed)
+    ensure_messages(messages, user_ids, channel_ids, private_ratio=private_ratio, seed=seed, progress=progress)
+    # bulk_create skips the post_save hooks that maintain the inbox summaries.
+    rebuild()
+    return user_ids, channel_ids
@@ -0,0 +1,168 @@
+"""
+Simulated concurrent client load against the chat views, in-process.
+
+Each client is a thread with its own test ``Client`` logged in as one of the
+generated users (picked with the same skew as the data, so busy users poll
+busy conversations).  It repeats a weighted mix of what the pages do:
+chat.html opens a conversation, polls ``get_messages`` and posts to
+``send_message``; home.html loads the home page and polls
+``get_unread_counts``.  Every request is timed and its queries counted.
+
+Requests go through the full middleware and view stack but not through a
+server or the network, and the clients share one interpreter, so absolute
+numbers are lower bounds; they are meant for comparing commits on one machine.
+"""
+import random
+import threading
+import time
+
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from . import summarize
+from .data import zipf_weights
+from ..instrumentation import QueryCollector
+from ..models import ChannelMembership, CustomUser
+
+DEFAULT_MIX = {'poll': 55, 'unread': 20, 'send': 10, 'open': 10, 'home': 5}
+
+
+def parse_mix(text):
+    """``'poll=60,send=10'`` -> ``{'poll': 60, 'send': 10}``; unknown actions are rejected."""
+    mix = {}
+    for part in filter(None, text.split(',')):
+        name, _, weight = part.partition('=')
+        if name.strip() not in DEFAULT_MIX:
+            raise ValueError(f'Unknown action {name!r}; choose from {", ".join(DEFAULT_MIX)}.')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+class SimulatedClient:
+    def __init__(self, user_id, conversations, rng):
+        self.client = Client(raise_request_exception=False)
+        self.user_id = user_id
+        self.conversations = conversations
+        self.rng = rng
+        self.last_seen = {}
+        self.current = rng.choice(conversations)
+        self.sent = 0
+        self.client.force_login(CustomUser.objects.get(id=user_id))
+
+    def _params(self):
+        kind, target = self.current
+        return {'channel_id' if kind == 'channel' else 'recipient_id': target}
+
+    def open(self):
+        self.current = self.rng.choice(self.conversations)
+        kind, target = self.current
+        url = reverse('channel_chat' if kind == 'channel' else 'private_chat', args=[target])
+        return self.client.get(url)
+
+    def poll(self):
+        response = self.client.get(reverse('get_messages'), {
+            **self._params(), 'last_message_id': self.last_seen.get(self.current, 0),
+        })
+        if response.status_code == 200:
+            messages = response.json().get('messages')
+            if messages:
+                self.last_seen[self.current] = messages[-1]['id']
+        return response
+
+    def send(self):
+        self.sent += 1
+        query = f'?channel_id={self.current[1]}' if self.current[0] == 'channel' else ''
+        return self.client.post(reverse('send_message') + query, {
+            **self._params(), 'content': f'load message {self.user_id}/{self.sent}',
+        })
+
+    def unread(self):
+        return self.client.get(reverse('get_unread_counts'))
+
+    def home(self):
+        return self.client.get(reverse('home'))
+
+
+def _conversations(active, user_ids, channel_ids, rng, peers=5):
+    """For each active user: the channels they may post in plus a few skewed private peers."""
+    can_send = set(ChannelMembership.objects.filter(
+        user_id__in=active, channel_id__in=channel_ids, can_send_messages=True,
+    ).values_list('user_id', 'channel_id'))
+    weights = zipf_weights(len(user_ids))
+    result = {}
+    for user_id in active:
+        channels = [('channel', channel_id) for channel_id in channel_ids if (user_id, channel_id) in can_send]
+        private = {peer for peer in rng.choices(user_ids, cum_weights=weights, k=peers) if peer != user_id}
+        result[user_id] = channels + [('private', peer) for peer in sorted(private)] or [('private', user_ids[0])]
+    return result
+
+
+def run(user_ids, channel_ids, clients=8, requests=200, mix=None, think_time=0.0, seed=0):
+    """Drive ``clients`` threads for ``requests`` requests each.
+
+    Returns ``{'actions': {name: stats}, 'total': stats, 'elapsed': seconds}``
+    where stats hold the count, 5xx/exception errors, latency percentiles in
+    milliseconds, mean queries per request and, for the total, throughput.
+    """
+    mix = mix or DEFAULT_MIX
+    actions = [name for name in mix if mix[name] > 0]
+    rng = random.Random(seed)
+    active = rng.choices(user_ids, cum_weights=zipf_weights(len(user_ids)), k=clients)
+    conversations = _conversations(sorted(set(active)), user_ids, channel_ids, rng)
+    samples = {name: [] for name in actions}
+    queries = {name: [] for name in actions}
+    errors = {name: 0 for name in actions}
+    lock = threading.Lock()
+
+    def worker(simulated):
+        mine = {name: [] for name in actions}
+        try:
+            for _ in range(requests):
+                action = simulated.rng.choices(actions, weights=[mix[name] for name in actions])[0]
+                collector = QueryCollector()
+                began = time.perf_counter()
+                try:
+                    with connection.execute_wrapper(collector):
+                        failed = getattr(simulated, action)().status_code >= 500
+                except Exception:
+                    failed = True
+                mine[action].append(((time.perf_counter() - began) * 1000, collector.queries, failed))
+                if think_time:
+                    time.sleep(think_time)
+        finally:
+            connections.close_all()
+            with lock:
+                for name, rows in mine.items():
+                    samples[name] += [row[0] for row in rows]
+                    queries[name] += [row[1] for row in rows]
+                    errors[name] += sum(row[2] for row in rows)
+
+    with override_settings(ALLOWED_HOSTS=['testserver']):
+        simulated = [
+            SimulatedClient(user_id, conversations[user_id], random.Random(seed * 1000 + index))
+            for index, user_id in enumerate(active)
+        ]
+        threads = [threading.Thread(target=worker, args=(client,)) for client in simulated]
+        began = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+
+    def stats(latencies, counts, failed):
+        return {
+            'count': len(latencies),
+            'errors': failed,
+            **summarize(latencies),
+            'queries': sum(counts) / len(counts) if counts else 0.0,
+        }
+
+    result = {
+        'actions': {name: stats(samples[name], queries[name], errors[name]) for name in actions},
+        'total': stats(sum(samples.values(), []), sum(queries.values(), []), sum(errors.values())),
+        'elapsed': elapsed,
+    }
+    result['total']['throughput'] = result['total']['count'] / elapsed if elapsed else 0.0
+    return result
@@ -0,0 +1,57 @@
+"""
+Bulk posting of messages, for imports and broadcast announcements.
+
+``post_messages`` inserts unsaved ``Message`` instances with ``bulk_create``,
+one transaction per batch rather than per row, then does once per
+conversation what ``Message.save()`` and its signals do per message: inbox
+summaries, change versions, message-cache invalidation, thumbnails and push
+notifications (local and, through the bus, to other processes).
+The search index follows on its own through the database triggers.
+"""
+from django.conf import settings
+from django.db import transaction
+
+from . import bus, inbox, message_cache, thumbnails, versions
+from .hub import hub
+from .models import Message
+from .serializers import serialize_message
+
+BATCH_SIZE = getattr(settings, 'CHAT_BULK_BATCH_SIZE', 500)
+
+
+class BulkPostError(Exception):
+    pass
+
+
+def _notify(messages):
+    for key in {message.conversation_key for message in messages}:
+        message_cache.invalidate(key)
+    for message in messages:
+        if message.file_type == 'image':
+            thumbnails.schedule('message', message.pk)
+        key = message.conversation_key
+        # Serializing is the expensive part, so skip it where nobody is listening.
+        if hub.subscriber_count(key):
+            hub.publish(key, serialize_message(message))
+        # Coalesced per conversation, so the whole batch is one bus message.
+        bus.notify(key, message.pk)
+
+
+def post_messages(messages, batch_size=None):
+    """Save ``messages`` in batches; returns them with ids assigned."""
+    batch_size = batch_size or BATCH_SIZE
+    for message in messages:
+        if not message.content and not message.file:
+            raise BulkPostError('Every message needs content or a file.')
+        if bool(message.channel_id) == bool(message.recipient_id):
+            raise BulkPostError('Every message needs exactly one of channel or recipient.')
+        message.set_derived_fields()
+
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start:start + batch_size]
+        with transaction.atomic():
+            Message.objects.bulk_create(batch)
+            inbox.record_messages(batch)
+            versions.record_messages(batch)
+            transaction.on_commit(lambda batch=batch: _notify(batch))
+    return messages
@@ -0,0 +1,322 @@
+"""
+Cross-process bus for new-message notifications.
+
+The message hub only reaches the connections of its own process.  When
+several workers serve the site, each committed message is also announced
+on the bus as "conversation ``key`` has new messages up to id ``N``".  The
+other processes bump the conversation's change version (and, when the
+version cache is per-process, the unread versions of its members), then
+pass it on to their hub as a hint payload (``{'conversation': key,
+'last_id': N}``).  WebSocket connections and long-poll waiters then read
+the new rows themselves.  Each process starts listening the first time it
+serves a poll, long-poll or WebSocket.
+
+``notify`` coalesces: only the highest id per conversation is kept, and
+pending notifications go out as one batch every ``CHAT_BUS_FLUSH_INTERVAL``
+seconds.  A burst of messages to one channel therefore costs one bus
+message, and one wakeup per subscriber in every other process.
+
+``CHAT_BUS_BACKEND`` selects a backend by dotted path; ``None`` (the
+default) keeps notifications in-process.  There are three backends:
+
+* ``LocalSocketBus``: Unix datagram sockets in ``CHAT_BUS_SOCKET_DIR``, one
+  per listening process.  It has no dependencies and suits a single host
+  and the tests.
+* ``RedisBus``: Redis pub/sub on ``CHAT_BUS_REDIS_URL``; needs ``redis``.
+* ``PostgresBus``: ``LISTEN``/``NOTIFY`` on the default database; needs
+  ``psycopg``.
+
+All of them publish and listen on ``CHAT_BUS_CHANNEL``.
+"""
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import suppress
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import message_cache, versions
+from .hub import hub as default_hub
+
+logger = logging.getLogger(__name__)
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+class NotificationBus:
+    # Largest encoded batch the transport takes; bigger ones are split.
+    max_payload = 64 * 1024
+
+    def __init__(self, channel=None, flush_interval=None, hub=None):
+        self.channel = channel or getattr(settings, 'CHAT_BUS_CHANNEL', 'chat_messages')
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'CHAT_BUS_FLUSH_INTERVAL', 0.05)
+        self.flush_interval = flush_interval
+        self.hub = hub or default_hub
+        self.origin = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+        self._listener = None
+        self._closed = False
+
+    def notify(self, key, last_id):
+        """Announce that ``key`` has messages up to ``last_id``; sent with the next batch."""
+        with self._lock:
+            if last_id > self._pending.get(key, 0):
+                self._pending[key] = last_id
+            timer = None
+            if self.flush_interval and self._timer is None:
+                timer = self._timer = threading.Timer(self.flush_interval, self.flush)
+                timer.daemon = True
+        if not self.flush_interval:
+            self.flush()
+        elif timer is not None:
+            timer.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending, self._timer = self._pending, {}, None
+        if not pending:
+            return
+        for data in self._encode(pending):
+            try:
+                self.send(data)
+            except Exception:
+                # Subscribers still catch up on their next poll or long-poll timeout.
+                logger.exception('Could not publish %d new-message notifications', len(pending))
+
+    def _encode(self, conversations):
+        data = json.dumps({'origin': self.origin, 'conversations': conversations}).encode()
+        if len(data) <= self.max_payload or len(conversations) == 1:
+            return [data]
+        items = list(conversations.items())
+        half = len(items) // 2
+        return self._encode(dict(items[:half])) + self._encode(dict(items[half:]))
+
+    def receive(self, data):
+        """Hand a batch from the transport to the local hub."""
+        try:
+            batch = json.loads(data)
+            conversations = batch['conversations']
+        except (ValueError, TypeError, KeyError):
+            logger.warning('Ignoring a malformed bus message')
+            return
+        if batch.get('origin') == self.origin:
+            return
+        cache = message_cache.get_cache()
+        if cache is not None and not cache.shared:
+            # A per-process message cache never saw the other process's write.
+            for key in conversations:
+                cache.invalidate(key)
+        try:
+            # Neither did a per-process version cache, so the members' unread counts move too.
+            user_ids = () if versions.shared() else versions.conversation_participants(conversations)
+            versions.bump(user_ids, conversations)
+        except Exception:
+            logger.exception('Could not bump the versions of %d conversations', len(conversations))
+        for key, last_id in conversations.items():
+            self.hub.publish(key, {'conversation': key, 'last_id': last_id})
+
+    def start(self):
+        """Start listening on a daemon thread; does nothing if already listening."""
+        with self._lock:
+            if self._listener is not None or self._closed:
+                return
+            self._listener = threading.Thread(target=self._listen_forever, name='chat-bus', daemon=True)
+        self._listener.start()
+
+    def _listen_forever(self):
+        while not self._closed:
+            try:
+                self.listen()
+            except Exception:
+                if self._closed:
+                    return
+                logger.exception('Bus listener failed; reconnecting')
+                time.sleep(1)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            timer = self._timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+        self.stop()
+        if self._listener is not None:
+            self._listener.join(timeout=5)
+
+    def send(self, data):
+        raise NotImplementedError
+
+    def listen(self):
+        """Block, passing every batch that arrives to ``receive``, until closed."""
+        raise NotImplementedError
+
+    def stop(self):
+        """Wake ``listen`` up so it can return."""
+
+
+class LocalSocketBus(NotificationBus):
+    def __init__(self, socket_dir=None, **kwargs):
+        super().__init__(**kwargs)
+        self.socket_dir = socket_dir or getattr(
+            settings, 'CHAT_BUS_SOCKET_DIR', os.path.join(tempfile.gettempdir(), 'chat-bus'),
+        )
+        self.path = os.path.join(self.socket_dir, f'{self.origin}.sock')
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # A receiver that stopped reading must not block the publisher.
+        self._sender.setblocking(False)
+
+    def send(self, data):
+        try:
+            names = os.listdir(self.socket_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.socket_dir, name)
+            if not name.endswith('.sock') or path == self.path:
+                continue
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left behind by a process that is gone.
+                with suppress(OSError):
+                    os.unlink(path)
+            except BlockingIOError:
+                logger.warning('Bus socket %s is full; dropped a notification batch', path)
+
+    def listen(self):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.bind(self.path)
+            try:
+                while not self._closed:
+                    data = sock.recv(self.max_payload)
+                    if data:
+                        self.receive(data)
+            finally:
+                with suppress(OSError):
+                    os.unlink(self.path)
+
+    def stop(self):
+        # An empty datagram wakes the blocked recv.
+        with suppress(OSError):
+            self._sender.sendto(b'', self.path)
+        self._sender.close()
+
+
+class RedisBus(NotificationBus):
+    max_payload = 512 * 1024
+
+    def __init__(self, url=None, **kwargs):
+        try:
+            import redis
+        except ImportError as exc:
+            raise ImproperlyConfigured('RedisBus needs the redis package.') from exc
+        super().__init__(**kwargs)
+        self.client = redis.Redis.from_url(url or getattr(settings, 'CHAT_BUS_REDIS_URL', 'redis://localhost:6379/0'))
+        self._pubsub = None
+
+    def send(self, data):
+        self.client.publish(self.channel, data)
+
+    def listen(self):
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            self._pubsub.subscribe(self.channel)
+            while not self._closed:
+                message = self._pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    self.receive(message['data'])
+        finally:
+            self._pubsub.close()
+
+    def stop(self):
+        # get_message times out every second and sees the flag.
+        pass
+
+
+class PostgresBus(NotificationBus):
+    # NOTIFY payloads must stay under 8000 bytes.
+    max_payload = 7900
+
+    def __init__(self, using='default', **kwargs):
+        try:
+            import psycopg
+        except ImportError as exc:
+            raise ImproperlyConfigured('PostgresBus needs the psycopg package.') from exc
+        super().__init__(**kwargs)
+        self.psycopg = psycopg
+        self.using = using
+        self._send_lock = threading.Lock()
+        self._send_connection = None
+
+    def _connect(self):
+        params = connections[self.using].get_connection_params()
+        return self.psycopg.connect(**params, autocommit=True)
+
+    def send(self, data):
+        with self._send_lock:
+            if self._send_connection is None or self._send_connection.closed:
+                self._send_connection = self._connect()
+            self._send_connection.execute('SELECT pg_notify(%s, %s)', [self.channel, data.decode()])
+
+    def listen(self):
+        with self._connect() as connection:
+            connection.execute(self.psycopg.sql.SQL('LISTEN {}').format(self.psycopg.sql.Identifier(self.channel)))
+            while not self._closed:
+                for notification in connection.notifies(timeout=1.0):
+                    self.receive(notification.payload)
+
+    def stop(self):
+        with self._send_lock:
+            if self._send_connection is not None:
+                self._send_connection.close()
+
+
+def get_bus():
+    """The configured bus, or None when notifications stay in-process."""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            path = getattr(settings, 'CHAT_BUS_BACKEND', None)
+            _bus = import_string(path)() if path else False
+    return _bus or None
+
+
+def start():
+    """Listen for other processes' notifications; called by everything that serves new messages."""
+    bus = get_bus()
+    if bus is not None:
+        bus.start()
+
+
+def notify(key, last_id):
+    bus = get_bus()
+    if bus is not None:
+        bus.notify(key, last_id)
+
+
+@receiver(setting_changed)
+def _reset(setting, **kwargs):
+    global _bus
+    if setting.startswith('CHAT_BUS'):
+        with _bus_lock:
+            bus, _bus = _bus, None
+        if bus:
+            bus.close()
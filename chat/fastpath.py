@@ -0,0 +1,175 @@
+"""
+Fast path for the JSON polling endpoints.
+
+A browser tab polls ``get_messages`` and ``get_unread_counts`` every few
+seconds, and each poll used to pay for the whole middleware stack: a session
+row, a user row, message storage and several response-header passes.
+``PollingFastPathMiddleware`` sits right after ``SecurityMiddleware``.  For a
+GET to one of ``CHAT_FAST_PATH_VIEWS`` it does the following:
+
+* takes the session from a per-process cache of sessions it authenticated
+  before, loading it from the session engine on a miss;
+* takes the user from a per-process identity cache, checking the session's
+  auth hash and ``is_active`` like ``django.contrib.auth.get_user`` does;
+* calls the view directly, skipping the rest of the stack.
+
+An unchanged poll therefore runs no queries for the session or the user.
+Sessions are cached for ``CHAT_FAST_PATH_SESSION_TTL`` seconds and users
+for ``CHAT_FAST_PATH_USER_TTL``.  A logout in this process evicts the
+session and saving or deleting a user evicts the user; other processes
+pick up the change within the TTL.  Anything the fast path cannot vouch for
+(no session, an unknown backend, an inactive user, a stale hash) takes the
+regular path.
+"""
+import threading
+import time
+from importlib import import_module
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+from django.urls import Resolver404, resolve
+from django.utils.crypto import constant_time_compare
+
+DEFAULT_VIEWS = ('get_messages', 'get_unread_counts', 'wait_messages')
+
+# Sessions kept at once; expired ones are dropped when it fills up.
+MAX_SESSIONS = 10000
+
+_users = {}
+_users_lock = threading.Lock()
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def forget(user_id):
+    """Drop a user from this process's identity cache."""
+    with _users_lock:
+        _users.pop(user_id, None)
+
+
+def forget_session(session_key):
+    """Drop a session from this process's session cache."""
+    with _sessions_lock:
+        _sessions.pop(session_key, None)
+
+
+def clear():
+    with _users_lock:
+        _users.clear()
+    with _sessions_lock:
+        _sessions.clear()
+
+
+def _cached_session(store, session_key):
+    """A ``store`` for ``session_key`` and whether its data came from the session cache."""
+    session = store(session_key)
+    with _sessions_lock:
+        entry = _sessions.get(session_key)
+    if entry is None or entry[1] <= time.monotonic():
+        return session, False
+    # What SessionBase.load() would have filled in; the engine is not asked.
+    session._session_cache = dict(entry[0])
+    return session, True
+
+
+def _remember_session(session):
+    now = time.monotonic()
+    with _sessions_lock:
+        if len(_sessions) >= MAX_SESSIONS:
+            for key in [key for key, entry in _sessions.items() if entry[1] <= now]:
+                del _sessions[key]
+            if len(_sessions) >= MAX_SESSIONS:
+                _sessions.clear()
+        _sessions[session.session_key] = (
+            dict(session.items()), now + getattr(settings, 'CHAT_FAST_PATH_SESSION_TTL', 30),
+        )
+
+
+def _cached_user(user_id):
+    now = time.monotonic()
+    with _users_lock:
+        entry = _users.get(user_id)
+    if entry is not None and entry[2] > now:
+        return entry[0], entry[1]
+    user = get_user_model()._default_manager.filter(pk=user_id).first()
+    if user is None:
+        return None, None
+    auth_hash = user.get_session_auth_hash()
+    with _users_lock:
+        _users[user_id] = (user, auth_hash, now + getattr(settings, 'CHAT_FAST_PATH_USER_TTL', 30))
+    return user, auth_hash
+
+
+def authenticate_session(session):
+    """The active user the session belongs to, or None if the regular path should decide."""
+    user_id = session.get(SESSION_KEY)
+    if user_id is None or session.get(BACKEND_SESSION_KEY) not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    user, auth_hash = _cached_user(get_user_model()._meta.pk.to_python(user_id))
+    if user is None or not user.is_active:
+        return None
+    if not constant_time_compare(session.get(HASH_SESSION_KEY, ''), auth_hash):
+        return None
+    return user
+
+
+class PollingFastPathMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        self.view_names = set(getattr(settings, 'CHAT_FAST_PATH_VIEWS', DEFAULT_VIEWS))
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _prepare(self, request):
+        """Resolve, load the session and authenticate; the view match, or None to take the regular path."""
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return None
+        if match.url_name not in self.view_names:
+            return None
+        # CommonMiddleware is skipped, so validate the Host header here.
+        request.get_host()
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not session_key:
+            return None
+        session, cached = _cached_session(self.session_store, session_key)
+        user = authenticate_session(session)
+        if user is None:
+            forget_session(session_key)
+            return None
+        if not cached:
+            _remember_session(session)
+
+        async def auser():
+            return user
+
+        request.session = session
+        request.user = user
+        request.auser = auser
+        request.resolver_match = match
+        return match
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        match = self._prepare(request)
+        if match is None:
+            return self.get_response(request)
+        view = async_to_sync(match.func) if iscoroutinefunction(match.func) else match.func
+        return view(request, *match.args, **match.kwargs)
+
+    async def __acall__(self, request):
+        match = await sync_to_async(self._prepare)(request)
+        if match is None:
+            return await self.get_response(request)
+        if iscoroutinefunction(match.func):
+            return await match.func(request, *match.args, **match.kwargs)
+        return await sync_to_async(match.func)(request, *match.args, **match.kwargs)
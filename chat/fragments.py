@@ -0,0 +1,62 @@
+"""
+Cache of rendered message markup.
+
+The body of a message as chat.html shows it (sender picture and name,
+content, attachment markup, time) is the same for every viewer, so it is
+rendered from ``templates/chat_message.html`` once and kept in the Django
+cache named by ``CHAT_FRAGMENT_CACHE_ALIAS`` for that cache's timeout.
+Only the surrounding ``<div class="message sent|received">`` depends on the
+viewer; the page template and the client script add it.
+
+A fragment is keyed by the message id and a digest of the fields it is
+rendered from.  Editing the message or changing the sender's name or
+picture changes the digest, so the old fragment is simply never asked for
+again and expires; rows are always current because the message cache is
+invalidated on those same writes.  Bump ``TEMPLATE_VERSION`` when
+chat_message.html changes.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+
+TEMPLATE_VERSION = 1
+
+# Payload fields the fragment is rendered from.
+FRAGMENT_FIELDS = (
+    'sender', 'sender_profile_image', 'content', 'file_url', 'file_name', 'file_type', 'thumbnail_url', 'timestamp',
+)
+
+
+def _cache():
+    return caches[getattr(settings, 'CHAT_FRAGMENT_CACHE_ALIAS', 'default')]
+
+
+def fragment_key(payload):
+    digest = hashlib.blake2b(
+        json.dumps([payload[field] for field in FRAGMENT_FIELDS]).encode(), digest_size=8,
+    ).hexdigest()
+    return f"chat:fragment:{TEMPLATE_VERSION}:{payload['id']}:{digest}"
+
+
+def render(payload):
+    return render_to_string('chat_message.html', {'message': payload})
+
+
+def attach_html(payloads):
+    """Set ``html`` on each message payload, rendering only what the cache lacks."""
+    if not payloads:
+        return payloads
+    cache = _cache()
+    keys = [fragment_key(payload) for payload in payloads]
+    found = cache.get_many(keys)
+    missing = {}
+    for key, payload in zip(keys, payloads):
+        if key not in found:
+            found[key] = missing[key] = render(payload)
+        payload['html'] = found[key]
+    if missing:
+        cache.set_many(missing)
+    return payloads
@@ -0,0 +1,73 @@
+"""
+In-process fan-out hub for new-message notifications.
+
+Publishers (``send_message_view``) run in worker threads while subscribers
+(WebSocket connections) live on an asyncio event loop, so every delivery is
+handed over with ``loop.call_soon_threadsafe``.  No external broker is needed;
+each process only notifies the connections it holds itself.
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+
+class Subscription:
+    def __init__(self, key, loop, maxsize):
+        self.key = key
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        # Set when the queue overflowed and the subscriber should resync.
+        self.overflowed = False
+
+    def _deliver(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class MessageHub:
+    def __init__(self, queue_size=256):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, key):
+        """Register a subscriber for ``key``; must be called on the event loop."""
+        subscription = Subscription(key, asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscribers[key].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.key)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.key]
+
+    def publish(self, key, payload):
+        """Deliver ``payload`` to every subscriber of ``key``; safe from any thread."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._deliver, payload)
+            except RuntimeError:
+                # The subscriber's loop has been closed underneath us.
+                self.unsubscribe(subscription)
+        return len(subscribers)
+
+    def subscriber_count(self, key=None):
+        with self._lock:
+            if key is not None:
+                return len(self._subscribers.get(key, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+hub = MessageHub()
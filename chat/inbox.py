@@ -0,0 +1,297 @@
+"""
+Maintenance of the per-user conversation summaries (``InboxEntry``).
+
+Every new message updates the summary rows of its conversation with a couple
+of indexed UPDATEs, so the home page can list a user's conversations by
+recency from one query instead of scanning their message history.
+Deleting or archiving messages recomputes the summaries of the affected
+conversations once the transaction commits (``refresh_on_commit``).
+``rebuild()`` recomputes everything from ``Message`` and the read cursors.
+"""
+import threading
+from bisect import bisect_right
+from collections import Counter, defaultdict
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, F, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import ChannelMembership, InboxEntry, Message, PrivateReadCursor
+
+BROADCAST_BATCH_SIZE = getattr(settings, 'CHAT_BROADCAST_BATCH_SIZE', 1000)
+EMPTY_SUMMARY = {'last_message_id': 0, 'last_timestamp': None, 'preview': ''}
+
+# Conversations waiting for a refresh when this thread's transaction commits.
+_pending = threading.local()
+
+
+def _upsert(filters, values, unread=0):
+    update = dict(values)
+    if unread:
+        update['unread_count'] = F('unread_count') + unread
+    # Only move forward: a late-committing older message must not win.
+    if InboxEntry.objects.filter(last_message_id__lt=values['last_message_id'], **filters).update(**update):
+        return
+    if InboxEntry.objects.filter(**filters).exists():
+        if unread:
+            InboxEntry.objects.filter(**filters).update(unread_count=F('unread_count') + unread)
+        return
+    try:
+        with transaction.atomic():
+            InboxEntry.objects.create(unread_count=unread, **filters, **values)
+    except IntegrityError:
+        # Somebody else created the row concurrently; apply our update on top.
+        _upsert(filters, values, unread)
+
+
+def _summary(message):
+    return {
+        'last_message_id': message.id,
+        'last_timestamp': message.timestamp,
+        'preview': message.preview,
+    }
+
+
+def fan_out(channel, values, sent_by, batch_size=None):
+    """Apply new channel messages to every member's summary.
+
+    ``sent_by`` maps sender id to how many of the new messages they sent, so
+    each member's unread count grows by the messages they did not send.
+    Broadcast channels are updated ``batch_size`` members at a time, creating
+    summaries that members added in bulk (without signals) are missing.
+    """
+    total = sum(sent_by.values())
+    unread = Value(total) - Case(
+        *[When(user_id=sender_id, then=Value(count)) for sender_id, count in sent_by.items()], default=Value(0)
+    )
+    entries = InboxEntry.objects.filter(channel_id=channel.id, last_message_id__lt=values['last_message_id'])
+    if not channel.is_broadcast:
+        entries.update(unread_count=F('unread_count') + unread, **values)
+        return
+
+    batch_size = batch_size or BROADCAST_BATCH_SIZE
+    members = ChannelMembership.objects.filter(channel_id=channel.id).order_by('user_id').values_list('user_id', flat=True)
+    after = 0
+    while True:
+        user_ids = list(members.filter(user_id__gt=after)[:batch_size])
+        if not user_ids:
+            break
+        after = user_ids[-1]
+        missing = set(user_ids) - set(
+            InboxEntry.objects.filter(channel_id=channel.id, user_id__in=user_ids).values_list('user_id', flat=True)
+        )
+        InboxEntry.objects.bulk_create(
+            [InboxEntry(user_id=user_id, channel_id=channel.id) for user_id in missing], ignore_conflicts=True,
+        )
+        entries.filter(user_id__in=user_ids).update(unread_count=F('unread_count') + unread, **values)
+
+
+def record_message(message):
+    """Fold a newly created message into its conversation summaries."""
+    values = _summary(message)
+    if message.channel_id:
+        fan_out(message.channel, values, {message.sender_id: 1})
+        return
+    _upsert({'user_id': message.sender_id, 'peer_id': message.recipient_id}, values)
+    if message.recipient_id != message.sender_id:
+        _upsert({'user_id': message.recipient_id, 'peer_id': message.sender_id}, values, unread=1)
+
+
+def record_messages(messages):
+    """Fold a batch of new messages (e.g. from ``bulk_create``) in with a few statements per conversation."""
+    conversations = defaultdict(list)
+    for message in messages:
+        conversations[message.conversation_key].append(message)
+    for group in conversations.values():
+        newest = max(group, key=lambda message: message.id)
+        values = _summary(newest)
+        if newest.channel_id:
+            fan_out(newest.channel, values, Counter(message.sender_id for message in group))
+            continue
+        sent = Counter((message.sender_id, message.recipient_id) for message in group)
+        for user_id, peer_id in {(newest.sender_id, newest.recipient_id), (newest.recipient_id, newest.sender_id)}:
+            unread = sent[(peer_id, user_id)] if user_id != peer_id else 0
+            _upsert({'user_id': user_id, 'peer_id': peer_id}, values, unread)
+
+
+def mark_caught_up(user, up_to, channel_id=None, peer_id=None):
+    """Clear the unread badge once ``user`` has read up to the conversation's newest message; returns whether it was set."""
+    conversation = {'channel_id': channel_id} if channel_id else {'peer_id': peer_id}
+    return InboxEntry.objects.filter(
+        user=user, last_message_id__lte=up_to, unread_count__gt=0, **conversation
+    ).update(unread_count=0)
+
+
+def _refresh_private(key, summary):
+    low, high = (int(part) for part in key.split(':')[1:])
+    pairs = {(low, high), (high, low)}
+    if summary is EMPTY_SUMMARY:
+        # Like rebuild(): a private conversation without messages has no summary.
+        InboxEntry.objects.filter(Q(user_id=low, peer_id=high) | Q(user_id=high, peer_id=low)).delete()
+        return
+    for user_id, peer_id in pairs:
+        unread = 0
+        if user_id != peer_id:
+            read_up_to = PrivateReadCursor.objects.filter(user_id=user_id, peer_id=peer_id).values_list(
+                'last_read_message_id', flat=True
+            ).first() or 0
+            unread = Message.objects.filter(
+                conversation=key, sender_id=peer_id, recipient_id=user_id, id__gt=read_up_to,
+            ).count()
+        InboxEntry.objects.update_or_create(
+            user_id=user_id, peer_id=peer_id, defaults={**summary, 'unread_count': unread},
+        )
+
+
+def _refresh_channel(channel_id, summary, batch_size):
+    cursors = dict(ChannelMembership.objects.filter(channel_id=channel_id).values_list('user_id', 'last_read_message_id'))
+    # Only messages after the oldest cursor can be unread for anybody.
+    recent = Message.objects.filter(channel_id=channel_id, id__gt=min(cursors.values(), default=0)).order_by('id')
+    ids, sent = [], defaultdict(list)
+    for message_id, sender_id in recent.values_list('id', 'sender_id'):
+        ids.append(message_id)
+        sent[sender_id].append(message_id)
+
+    def unread(user_id):
+        read_up_to = cursors.get(user_id, 0)
+        own = sent.get(user_id, ())
+        return len(ids) - bisect_right(ids, read_up_to) - (len(own) - bisect_right(own, read_up_to))
+
+    entries = list(InboxEntry.objects.filter(channel_id=channel_id))
+    for entry in entries:
+        entry.unread_count = unread(entry.user_id)
+        for field, value in summary.items():
+            setattr(entry, field, value)
+    InboxEntry.objects.bulk_update(entries, ['unread_count', *summary], batch_size=batch_size)
+
+
+def refresh(keys, batch_size=None):
+    """Recompute the summaries of the conversations ``keys`` the way ``rebuild()`` would."""
+    for key in keys:
+        newest = Message.objects.for_key(key).order_by('-id').first()
+        summary = _summary(newest) if newest is not None else EMPTY_SUMMARY
+        if key.startswith('channel:'):
+            _refresh_channel(int(key.split(':')[1]), summary, batch_size or BROADCAST_BATCH_SIZE)
+        else:
+            _refresh_private(key, summary)
+
+
+def _refresh_pending():
+    keys, _pending.keys = getattr(_pending, 'keys', set()), set()
+    if keys:
+        refresh(keys)
+
+
+def refresh_on_commit(keys):
+    """Refresh the conversations ``keys`` once, however many deletes queue them, after the commit."""
+    # A rolled-back transaction leaves its keys behind; the next commit
+    # refreshes them too, which only repeats what rebuild() would write.
+    if not hasattr(_pending, 'keys'):
+        _pending.keys = set()
+    _pending.keys.update(keys)
+    transaction.on_commit(_refresh_pending)
+
+
+def inbox_for(user):
+    """The user's contacts and channels, most recent first, from a single query."""
+    entries = InboxEntry.objects.filter(user=user).select_related('peer', 'channel').order_by(
+        F('last_timestamp').desc(nulls_last=True), '-id'
+    )
+    users, channels = [], []
+    for entry in entries:
+        item = entry.peer or entry.channel
+        item.unread_count = entry.unread_count
+        item.inbox = entry
+        (users if entry.peer_id else channels).append(item)
+    return users, channels
+
+
+def add_channel_member(membership):
+    channel_id = membership.channel_id
+    last = InboxEntry.objects.filter(channel_id=channel_id).order_by('-last_message_id').values(
+        'last_message_id', 'last_timestamp', 'preview'
+    ).first() or {}
+    InboxEntry.objects.get_or_create(user_id=membership.user_id, channel_id=channel_id, defaults=last)
+
+
+def remove_channel_member(membership):
+    InboxEntry.objects.filter(user_id=membership.user_id, channel_id=membership.channel_id).delete()
+
+
+def add_channel_members(channel_id, user_ids):
+    """Bulk counterpart of ``add_channel_member`` for memberships created without signals."""
+    last = InboxEntry.objects.filter(channel_id=channel_id).order_by('-last_message_id').values(
+        'last_message_id', 'last_timestamp', 'preview'
+    ).first() or {}
+    InboxEntry.objects.bulk_create(
+        [InboxEntry(user_id=user_id, channel_id=channel_id, **last) for user_id in user_ids], ignore_conflicts=True,
+    )
+
+
+def remove_channel_members(channel_id, user_ids):
+    InboxEntry.objects.filter(channel_id=channel_id, user_id__in=user_ids).delete()
+
+
+def rebuild(apps=global_apps, batch_size=1000):
+    """Recompute every inbox entry from the message table and read cursors."""
+    Message = apps.get_model('chat', 'Message')
+    ChannelMembership = apps.get_model('chat', 'ChannelMembership')
+    PrivateReadCursor = apps.get_model('chat', 'PrivateReadCursor')
+    Entry = apps.get_model('chat', 'InboxEntry')
+
+    def last_messages(newest_ids):
+        summaries = {}
+        ids = list(newest_ids)
+        for start in range(0, len(ids), batch_size):
+            for message in Message.objects.filter(id__in=ids[start:start + batch_size]).only('id', 'timestamp', 'content'):
+                summaries[message.id] = {
+                    'last_message_id': message.id,
+                    'last_timestamp': message.timestamp,
+                    'preview': message.content[:100] if message.content else 'File message',
+                }
+        return summaries
+
+    cursor = PrivateReadCursor.objects.filter(user=OuterRef('recipient'), peer=OuterRef('sender')).values('last_read_message_id')[:1]
+    private_unread = dict(
+        ((recipient_id, sender_id), unread)
+        for recipient_id, sender_id, unread in Message.objects.filter(channel__isnull=True, recipient__isnull=False)
+        .annotate(last_read=Coalesce(Subquery(cursor), Value(0)))
+        .filter(id__gt=F('last_read'))
+        .values('recipient', 'sender')
+        .annotate(unread=Count('id'))
+        .values_list('recipient', 'sender', 'unread')
+    )
+    private_newest = {
+        key: newest for key, newest in Message.objects.filter(conversation__isnull=False)
+        .values('conversation').annotate(newest=Max('id')).values_list('conversation', 'newest')
+    }
+    channel_newest = dict(
+        Message.objects.filter(channel__isnull=False).values('channel').annotate(newest=Max('id')).values_list('channel', 'newest')
+    )
+    summaries = last_messages(list(private_newest.values()) + list(channel_newest.values()))
+
+    entries = []
+    for key, newest in private_newest.items():
+        low, high = (int(part) for part in key.split(':')[1:])
+        for user_id, peer_id in {(low, high), (high, low)}:
+            entries.append(Entry(
+                user_id=user_id, peer_id=peer_id,
+                unread_count=private_unread.get((user_id, peer_id), 0), **summaries[newest],
+            ))
+    memberships = ChannelMembership.objects.annotate(unread=Count(
+        'channel__message',
+        filter=Q(channel__message__id__gt=F('last_read_message_id')) & ~Q(channel__message__sender=F('user')),
+    )).values_list('user', 'channel', 'unread')
+    for user_id, channel_id, unread in memberships:
+        newest = channel_newest.get(channel_id)
+        entries.append(Entry(
+            user_id=user_id, channel_id=channel_id, unread_count=unread,
+            **(summaries[newest] if newest else {}),
+        ))
+
+    with transaction.atomic():
+        Entry.objects.all().delete()
+        Entry.objects.bulk_create(entries, batch_size=batch_size)
+    return len(entries)
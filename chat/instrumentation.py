@@ -0,0 +1,271 @@
+"""
+Per-view request metrics: latency histograms, database queries and response sizes.
+
+``InstrumentationMiddleware`` times every request and counts its response
+bytes.  A sample of them (``CHAT_INSTRUMENTATION_SAMPLE_RATE``) also has its
+SQL wrapped, to count queries and their time and to flag statements run
+``CHAT_INSTRUMENTATION_REPEAT_THRESHOLD`` or more times with the same text
+in one request, the usual sign of a query per row (N+1).
+
+Counters live in one shard per thread.  Only the owning thread writes to a
+shard and the report sums them on read, so recording takes no lock.  The
+shards of finished threads are folded into a retired total, so a server
+that starts a thread per request does not grow the list.  Like the message
+hub the numbers are per process; scrape every worker.
+"""
+import bisect
+import random
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MAX_REPEATED_STATEMENTS = 200
+
+_local = threading.local()
+# Live threads' shards by thread; finished ones are folded into ``_retired``.
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+class ViewStats:
+    __slots__ = ('requests', 'errors', 'seconds', 'buckets', 'response_bytes', 'sampled', 'queries', 'query_seconds')
+
+    def __init__(self):
+        self.requests = self.errors = self.response_bytes = self.sampled = self.queries = 0
+        self.seconds = self.query_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def merge(self, other):
+        for name in self.__slots__:
+            if name != 'buckets':
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the ``fraction`` quantile; None past the last bound."""
+        rank, seen = fraction * self.requests, 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class _Shard:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Rebinding rather than clearing keeps a concurrent reader's copy intact.
+        self.views = {}
+        self.repeats = {}
+
+
+_retired = _Shard()
+
+
+def _fold(views, repeats, shard):
+    for view, stats in list(shard.views.items()):
+        views.setdefault(view, ViewStats()).merge(stats)
+    for key, (flagged, most) in list(shard.repeats.items()):
+        total = repeats.setdefault(key, [0, 0])
+        total[0] += flagged
+        total[1] = max(total[1], most)
+
+
+def _retire_finished():
+    # Called with the lock held; a finished thread no longer writes to its shard.
+    for thread in [thread for thread in _shards if not thread.is_alive()]:
+        _fold(_retired.views, _retired.repeats, _shards.pop(thread))
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = _Shard()
+        with _shards_lock:
+            _retire_finished()
+            _shards[threading.current_thread()] = shard
+    return shard
+
+
+class QueryCollector:
+    """``execute_wrapper`` that counts and times the statements of one request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - start
+            self.statements[sql] = self.statements.get(sql, 0) + 1
+
+
+def _install(collector):
+    connection.execute_wrappers.append(collector)
+
+
+def _uninstall(collector):
+    connection.execute_wrappers.remove(collector)
+
+
+def record(view, seconds, status, response_bytes, collector=None):
+    shard = _shard()
+    stats = shard.views.get(view)
+    if stats is None:
+        stats = shard.views[view] = ViewStats()
+    stats.requests += 1
+    stats.errors += status >= 500
+    stats.seconds += seconds
+    stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    stats.response_bytes += response_bytes
+    if collector is None:
+        return
+    stats.sampled += 1
+    stats.queries += collector.queries
+    stats.query_seconds += collector.seconds
+    threshold = getattr(settings, 'CHAT_INSTRUMENTATION_REPEAT_THRESHOLD', 5)
+    for sql, count in collector.statements.items():
+        if count < threshold:
+            continue
+        key = (view, sql)
+        repeat = shard.repeats.get(key)
+        if repeat is None:
+            if len(shard.repeats) >= MAX_REPEATED_STATEMENTS:
+                continue
+            repeat = shard.repeats[key] = [0, 0]
+        repeat[0] += 1
+        repeat[1] = max(repeat[1], count)
+
+
+def snapshot():
+    """``(views, repeats)`` summed over every thread.
+
+    ``views`` maps view names to ``ViewStats``; ``repeats`` maps
+    ``(view, sql)`` to ``[requests flagged, most executions in one request]``.
+    """
+    views, repeats = {}, {}
+    with _shards_lock:
+        _retire_finished()
+        _fold(views, repeats, _retired)
+        shards = list(_shards.values())
+    for shard in shards:
+        _fold(views, repeats, shard)
+    return views, repeats
+
+
+def reset():
+    with _shards_lock:
+        _retired.reset()
+        for shard in _shards.values():
+            shard.reset()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(extra=None):
+    """The metrics in the Prometheus text exposition format.
+
+    ``extra`` is a list of ``(name, type, help, value)`` for process-wide gauges and counters.
+    """
+    views, repeats = snapshot()
+    lines = [
+        '# HELP chat_request_duration_seconds Request latency by view.',
+        '# TYPE chat_request_duration_seconds histogram',
+    ]
+    for view, stats in sorted(views.items()):
+        label = f'view="{_label(view)}"'
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+            cumulative += count
+            lines.append(f'chat_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'chat_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats.requests}')
+        lines.append(f'chat_request_duration_seconds_sum{{{label}}} {stats.seconds}')
+        lines.append(f'chat_request_duration_seconds_count{{{label}}} {stats.requests}')
+
+    counters = [
+        ('chat_request_errors_total', 'Responses with a 5xx status.', 'errors'),
+        ('chat_response_bytes_total', 'Response body bytes sent.', 'response_bytes'),
+        ('chat_sampled_requests_total', 'Requests whose queries were recorded.', 'sampled'),
+        ('chat_db_queries_total', 'Queries run by sampled requests.', 'queries'),
+        ('chat_db_query_seconds_total', 'Time spent in queries by sampled requests.', 'query_seconds'),
+    ]
+    for name, help_text, attr in counters:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        lines += [f'{name}{{view="{_label(view)}"}} {getattr(stats, attr)}' for view, stats in sorted(views.items())]
+
+    flagged = {}
+    for (view, _), (count, _) in repeats.items():
+        flagged[view] = flagged.get(view, 0) + count
+    lines += [
+        '# HELP chat_repeated_query_requests_total Sampled requests that repeated one statement past the threshold.',
+        '# TYPE chat_repeated_query_requests_total counter',
+    ]
+    lines += [f'chat_repeated_query_requests_total{{view="{_label(view)}"}} {count}' for view, count in sorted(flagged.items())]
+
+    for name, kind, help_text, value in extra or []:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'CHAT_INSTRUMENTATION_SAMPLE_RATE', 0.1)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _collector(self):
+        return QueryCollector() if self.sample_rate and random.random() < self.sample_rate else None
+
+    def _record(self, request, response, start, collector):
+        match = request.resolver_match
+        if response.streaming:
+            size = int(response.get('Content-Length') or 0)
+        else:
+            size = len(response.content)
+        record(match.view_name if match else '<unresolved>', time.perf_counter() - start, response.status_code, size, collector)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        collector = self._collector()
+        if collector is None:
+            response = self.get_response(request)
+        else:
+            with connection.execute_wrapper(collector):
+                response = self.get_response(request)
+        self._record(request, response, start, collector)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        collector = self._collector()
+        if collector is None:
+            response = await self.get_response(request)
+        else:
+            # Connections are per thread and an async view's queries run in
+            # its request's sync_to_async thread, so the wrapper goes there.
+            await sync_to_async(_install)(collector)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(_uninstall)(collector)
+        self._record(request, response, start, collector)
+        return response
@@ -0,0 +1,81 @@
+"""
+Chunked background jobs for bulk changes, such as admin actions.
+
+``submit`` walks a queryset in primary-key order, ``CHAT_JOB_CHUNK_SIZE``
+rows at a time, and applies a function to each chunk in its own transaction
+(through the write queue when it is enabled).  A change over a million rows
+therefore never holds the SQLite write lock for long, and the request that
+started it returns at once.  Jobs run on a small thread pool after the
+submitting transaction commits.  ``CHAT_JOB_WORKERS = 0`` runs them inline.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from . import writes
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def chunks(queryset, size=None):
+    """Primary keys of ``queryset`` in ascending lists of up to ``size``."""
+    size = size or getattr(settings, 'CHAT_JOB_CHUNK_SIZE', 1000)
+    keys = queryset.order_by('pk').values_list('pk', flat=True)
+    after = None
+    while True:
+        ids = list((keys.filter(pk__gt=after) if after is not None else keys)[:size])
+        if not ids:
+            return
+        yield ids
+        after = ids[-1]
+
+
+def _apply(func, model, ids):
+    with transaction.atomic():
+        return func(model._default_manager.filter(pk__in=ids))
+
+
+def run(queryset, func, chunk_size=None):
+    """Apply ``func`` to ``queryset`` chunk by chunk; returns how many rows were visited."""
+    done = 0
+    for ids in chunks(queryset, chunk_size):
+        writes.run(_apply, func, queryset.model, ids)
+        done += len(ids)
+    return done
+
+
+def _run_logged(queryset, func, description, chunk_size):
+    try:
+        done = run(queryset, func, chunk_size)
+    except Exception:
+        logger.exception('Background job failed: %s', description)
+    else:
+        logger.info('Background job finished: %s (%d rows)', description, done)
+    finally:
+        connections.close_all()
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'CHAT_JOB_WORKERS', 1), thread_name_prefix='jobs',
+            )
+    return _executor
+
+
+def submit(queryset, func, description, chunk_size=None):
+    """Queue ``func`` over ``queryset`` in chunks for after the current transaction commits."""
+    def start():
+        if getattr(settings, 'CHAT_JOB_WORKERS', 1):
+            _pool().submit(_run_logged, queryset, func, description, chunk_size)
+        else:
+            run(queryset, func, chunk_size)
+    transaction.on_commit(start)
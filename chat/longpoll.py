@@ -0,0 +1,96 @@
+"""
+Long-poll waits for new messages, woken by the message hub.
+
+A request that finds nothing new parks on a future instead of returning.  All
+requests waiting on the same conversation (on the same event loop) share one
+hub subscription; when it fires, a single query reads everything past the
+oldest waiter's ``last_message_id`` and each waiter takes the rows it has not
+seen.  Messages saved by other processes arrive as bus hints and wake the
+group the same way.  Run under ASGI so parked requests do not each hold a
+worker thread.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import bus
+from .hub import hub
+from .message_cache import rows_since
+
+TIMEOUT = getattr(settings, 'CHAT_LONG_POLL_TIMEOUT', 25)
+
+_groups = {}
+
+
+def fetch_rows(key, after_id):
+    """``(rows, has_more)`` for the conversation ``key`` past ``after_id``."""
+    return rows_since(key, after_id)
+
+
+class _Waiters:
+    """The requests on one event loop that are waiting for one conversation."""
+
+    def __init__(self, key, loop):
+        self.key = key
+        self.loop = loop
+        self.pending = {}
+        bus.start()
+        self.subscription = hub.subscribe(key)
+        self.task = loop.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        try:
+            while True:
+                await self.subscription.get()
+                # One read answers every notification that is already queued.
+                while not self.subscription.queue.empty():
+                    self.subscription.queue.get_nowait()
+                self.subscription.overflowed = False
+                waiting = {future: after for future, after in self.pending.items() if not future.done()}
+                if not waiting:
+                    continue
+                try:
+                    rows, has_more = await sync_to_async(fetch_rows)(self.key, min(waiting.values()))
+                except Exception as exc:
+                    for future in waiting:
+                        if not future.done():
+                            future.set_exception(exc)
+                    continue
+                for future, after in waiting.items():
+                    unseen = [row for row in rows if row['id'] > after]
+                    # A waiter already past these rows keeps waiting for the next wakeup.
+                    if unseen and not future.done():
+                        future.set_result((unseen, has_more))
+        finally:
+            hub.unsubscribe(self.subscription)
+
+    def join(self, after_id):
+        future = self.loop.create_future()
+        self.pending[future] = after_id
+        return future
+
+    def leave(self, future):
+        self.pending.pop(future, None)
+        if not self.pending:
+            self.task.cancel()
+            _groups.pop((self.loop, self.key), None)
+
+
+async def wait_for_messages(key, after_id, timeout=None):
+    """Rows past ``after_id``, waiting up to ``timeout`` seconds for the first to arrive."""
+    loop = asyncio.get_running_loop()
+    group = _groups.get((loop, key))
+    if group is None:
+        group = _groups[(loop, key)] = _Waiters(key, loop)
+    # Join before the first read so a message saved in between still wakes us.
+    future = group.join(after_id)
+    try:
+        rows, has_more = await sync_to_async(fetch_rows)(key, after_id)
+        if rows:
+            return rows, has_more
+        return await asyncio.wait_for(future, TIMEOUT if timeout is None else timeout)
+    except asyncio.TimeoutError:
+        return [], False
+    finally:
+        group.leave(future)
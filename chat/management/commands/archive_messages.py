@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from chat.archive import archive_expired
+
+
+class Command(BaseCommand):
+    help = 'Move messages past their retention policy into the compressed archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Messages read per batch (default: CHAT_ARCHIVE_BATCH_SIZE).')
+
+    def handle(self, *args, **options):
+        moved = archive_expired(batch_size=options['batch_size'])
+        for policy, count in moved.items():
+            self.stdout.write(f'{policy}: {count} messages archived')
+        self.stdout.write(self.style.SUCCESS(f'Archived {sum(moved.values())} messages.'))
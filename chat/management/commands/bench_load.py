@@ -0,0 +1,95 @@
+import json
+import os
+import subprocess
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import benchmark_database
+from chat.benchmarks.data import generate
+from chat.benchmarks.load import DEFAULT_MIX, parse_mix, run
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Run simulated polling and posting clients against the chat views and report latency and throughput.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--channels', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--clients', type=int, default=8, help='Concurrent simulated clients.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per client.')
+        parser.add_argument('--mix', default=','.join(f'{name}={weight}' for name, weight in DEFAULT_MIX.items()),
+                            help='Relative weights of the client actions.')
+        parser.add_argument('--think-ms', type=float, default=0, help='Pause between requests of one client.')
+        parser.add_argument('--db-path', default=os.path.join(tempfile.gettempdir(), 'chat_bench_load.sqlite3'),
+                            help='SQLite file holding the generated data.')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse previously generated data.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the results as JSON to this file.')
+        parser.add_argument('--compare', help='JSON results of an earlier run to show the change against.')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(e)
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        with benchmark_database(options['db_path'], options['keepdb']):
+            self.stdout.write(f"Generating {options['users']:,} users, {options['channels']:,} channels, "
+                              f"{options['messages']:,} messages...")
+            user_ids, channel_ids = generate(
+                options['users'], options['channels'], options['messages'], seed=options['seed'],
+                progress=lambda done: self.stdout.write(f'  {done:,}', ending='\r'),
+            )
+            self.stdout.write('')
+            results = run(
+                user_ids, channel_ids, clients=options['clients'], requests=options['requests'],
+                mix=mix, think_time=options['think_ms'] / 1000, seed=options['seed'],
+            )
+
+        results['parameters'] = {
+            name: options[name] for name in ('users', 'channels', 'messages', 'clients', 'requests', 'think_ms', 'seed')
+        }
+        results['parameters']['mix'] = mix
+        results['commit'] = _commit()
+        self.report(results, baseline)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def report(self, results, baseline=None):
+        if baseline and baseline.get('parameters') != results['parameters']:
+            self.stdout.write(self.style.WARNING('The baseline was run with different parameters.'))
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f"{'action':<8} {'count':>7} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}"
+        ))
+        rows = list(results['actions'].items()) + [('all', results['total'])]
+        for name, stats in rows:
+            line = (f"{name:<8} {stats['count']:>7} {stats['errors']:>6} {stats['p50']:>9.2f} "
+                    f"{stats['p95']:>9.2f} {stats['p99']:>9.2f} {stats['queries']:>8.1f}")
+            before = (baseline or {}).get('actions', {}).get(name) if name != 'all' else (baseline or {}).get('total')
+            if before:
+                line += f"   p95 {self._change(before['p95'], stats['p95'])}, queries {stats['queries'] - before['queries']:+.1f}"
+            self.stdout.write(line)
+        throughput = results['total']['throughput']
+        line = f"throughput {throughput:.1f} req/s over {results['elapsed']:.2f} s"
+        if baseline:
+            line += f" ({self._change(baseline['total']['throughput'], throughput)} vs {baseline.get('commit') or 'baseline'})"
+        self.stdout.write(line)
+
+    def _change(self, before, after):
+        return f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
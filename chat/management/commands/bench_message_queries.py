@@ -0,0 +1,88 @@
+import os
+import random
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chat.benchmarks import benchmark_database, summarize, time_call
+from chat.benchmarks.data import generate
+from chat.models import CustomUser, Message
+from chat.unread import unread_counts
+
+
+class Command(BaseCommand):
+    help = 'Show query plans and latency of the message lookups at increasing table sizes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000000,10000000',
+                            help='Comma-separated message counts to benchmark at (default: 1M and 10M).')
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--channels', type=int, default=500)
+        parser.add_argument('--repeat', type=int, default=200, help='Timed runs per query and size.')
+        parser.add_argument('--db-path', default=os.path.join(tempfile.gettempdir(), 'chat_bench.sqlite3'),
+                            help='SQLite file holding the generated data.')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse previously generated data.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        with benchmark_database(options['db_path'], options['keepdb']):
+            for size in sizes:
+                self.stdout.write(f'Generating {size:,} messages...')
+                user_ids, channel_ids = generate(
+                    options['users'], options['channels'], size, seed=options['seed'],
+                    progress=lambda done: self.stdout.write(f'  {done:,}', ending='\r'),
+                )
+                self.stdout.write('')
+                self.report(size, self.queries(user_ids, channel_ids, options['seed']), options['repeat'])
+
+    def queries(self, user_ids, channel_ids, seed):
+        rng = random.Random(seed)
+        conversations = list(
+            Message.objects.filter(conversation__isnull=False).values_list('sender', 'recipient')[:1000]
+        )
+        users = {user.id: user for user in CustomUser.objects.filter(id__in=user_ids[:200])}
+        active_users = list(users.values())
+
+        def pick_pair():
+            sender_id, recipient_id = rng.choice(conversations)
+            return CustomUser(id=sender_id), recipient_id
+
+        def channel_page():
+            list(Message.objects.filter(channel_id=rng.choice(channel_ids[:20]), id__gt=0).order_by('-id')[:50])
+
+        def private_poll_legacy():
+            user, peer_id = pick_pair()
+            list(Message.objects.filter(
+                Q(sender=user, recipient_id=peer_id) | Q(sender_id=peer_id, recipient=user), id__gt=0
+            ).order_by('timestamp'))
+
+        def private_poll():
+            user, peer_id = pick_pair()
+            list(Message.objects.for_conversation(user, peer_id=peer_id).filter(id__gt=0).order_by('id'))
+
+        def unread():
+            unread_counts(rng.choice(active_users))
+
+        sample_user, sample_peer = conversations[0]
+        sample = CustomUser(id=sample_user)
+        return [
+            ('channel page (channel, id)', channel_page,
+             Message.objects.filter(channel_id=channel_ids[0], id__gt=0).order_by('-id')[:50]),
+            ('private poll, legacy OR', private_poll_legacy,
+             Message.objects.filter(Q(sender=sample, recipient_id=sample_peer) | Q(sender_id=sample_peer, recipient=sample),
+                                    id__gt=0).order_by('timestamp')),
+            ('private poll, conversation key', private_poll,
+             Message.objects.for_conversation(sample, peer_id=sample_peer).filter(id__gt=0).order_by('id')),
+            ('unread counts', unread, None),
+        ]
+
+    def report(self, size, queries, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'== {size:,} messages =='))
+        for name, func, queryset in queries:
+            stats = summarize(time_call(func, repeat))
+            self.stdout.write(f"{name:<34} p50 {stats['p50']:8.2f} ms   p95 {stats['p95']:8.2f} ms")
+            if queryset is not None:
+                for line in queryset.explain().splitlines():
+                    self.stdout.write(f'    {line}')
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from chat import fastpath
+from chat.benchmarks import benchmark_database, summarize
+from chat.benchmarks.data import generate
+from chat.models import CustomUser, Message
+
+FAST_PATH_MIDDLEWARE = 'chat.fastpath.PollingFastPathMiddleware'
+
+
+def _configurations():
+    return [
+        ('full stack, db sessions', {
+            'MIDDLEWARE': [name for name in settings.MIDDLEWARE if name != FAST_PATH_MIDDLEWARE],
+            'SESSION_ENGINE': 'django.contrib.sessions.backends.db',
+        }),
+        ('fast path', {}),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-request overhead of the polling endpoints with and without the fast path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--channels', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=500, help='Timed requests per endpoint and configuration.')
+        parser.add_argument('--db-path', default=os.path.join(tempfile.gettempdir(), 'chat_bench_polling.sqlite3'),
+                            help='SQLite file holding the generated data.')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse previously generated data.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with benchmark_database(options['db_path'], options['keepdb']):
+            self.stdout.write('Generating data...')
+            generate(options['users'], options['channels'], options['messages'], seed=options['seed'])
+            message = Message.objects.filter(recipient__isnull=False).order_by('-id').first()
+            user = CustomUser.objects.get(id=message.recipient_id)
+            requests = [
+                ('messages poll', 'get_messages',
+                 {'recipient_id': message.sender_id, 'last_message_id': message.id}),
+                ('unread counts', 'get_unread_counts', {}),
+            ]
+            for label, overrides in _configurations():
+                self.stdout.write(self.style.MIGRATE_HEADING(f'== {label} =='))
+                with override_settings(ALLOWED_HOSTS=['testserver'], **overrides):
+                    fastpath.clear()
+                    client = Client()
+                    client.force_login(user)
+                    for name, url_name, params in requests:
+                        self.report(client, name, url_name, params, options['repeat'])
+
+    def report(self, client, name, url_name, params, repeat):
+        url = reverse(url_name)
+        etag = client.get(url, params).headers.get('ETag')
+        for variant, headers in (('200', {}), ('304', {'If-None-Match': etag} if etag else None)):
+            if headers is None:
+                continue
+            samples, queries = [], 0
+            for _ in range(repeat):
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    client.get(url, params, headers=headers)
+                    samples.append((time.perf_counter() - start) * 1000)
+                queries += len(captured)
+            stats = summarize(samples)
+            self.stdout.write(
+                f"{name + ' (' + variant + ')':<22} p50 {stats['p50']:7.2f} ms   p95 {stats['p95']:7.2f} ms   "
+                f"mean {stats['mean']:7.2f} ms   {queries / repeat:5.2f} queries/request"
+            )
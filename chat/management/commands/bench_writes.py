@@ -0,0 +1,130 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import override_settings
+
+from chat import writes
+from chat.benchmarks import benchmark_database, summarize
+from chat.benchmarks.data import generate
+from chat.models import CustomUser, Message
+from chat.views import save_message
+
+# The settings before the production profile: rollback journal, SQLite's
+# default busy timeout and a transaction per write.
+PROFILES = {
+    'default': ({'OPTIONS': {}, 'CONN_MAX_AGE': 0}, False),
+    'production': ({'OPTIONS': settings.SQLITE_PRODUCTION_OPTIONS, 'CONN_MAX_AGE': 600}, True),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare message write throughput of the default and production SQLite profiles under concurrent senders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--senders', type=int, default=16, help='Concurrent sending threads.')
+        parser.add_argument('--messages', type=int, default=200, help='Messages per sender.')
+        parser.add_argument('--pollers', type=int, default=4,
+                            help='Threads that poll and mark messages read while the senders run.')
+        parser.add_argument('--poll-interval-ms', type=float, default=20, help='Pause between the polls of one poller.')
+        parser.add_argument('--profiles', default=','.join(PROFILES), help='Profiles to run, in order.')
+        parser.add_argument('--db-dir', default=tempfile.gettempdir(), help='Directory for the benchmark databases.')
+
+    def handle(self, *args, **options):
+        results = {}
+        for name in options['profiles'].split(','):
+            db_settings, queue = PROFILES[name]
+            connection.close()
+            connection.settings_dict.update(db_settings)
+            path = os.path.join(options['db_dir'], f'chat_bench_writes_{name}.sqlite3')
+            with benchmark_database(path), override_settings(CHAT_WRITE_QUEUE=queue):
+                user_ids, _ = generate(2 * options['senders'] + options['pollers'], 0, 0)
+                try:
+                    results[name] = self.run(user_ids, options)
+                finally:
+                    writes.stop()
+            self.report(name, results[name])
+        if len(results) > 1:
+            (first, before), (last, after) = list(results.items())[0], list(results.items())[-1]
+            if before['throughput']:
+                self.stdout.write(f"{last} vs {first}: {after['throughput'] / before['throughput']:.1f}x messages/s")
+
+    def run(self, user_ids, options):
+        users = list(CustomUser.objects.filter(id__in=user_ids).order_by('id'))
+        senders = users[:2 * options['senders']]
+        pollers = users[2 * options['senders']:]
+        latencies, errors, polls = [], [0], [0]
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def send(sender, recipient):
+            mine, failed = [], 0
+            try:
+                for index in range(options['messages']):
+                    message = Message(sender=sender, recipient=recipient, content=f'bench write {index}')
+                    began = time.perf_counter()
+                    try:
+                        writes.run(save_message, message)
+                    except Exception:
+                        failed += 1
+                    mine.append((time.perf_counter() - began) * 1000)
+            finally:
+                connections.close_all()
+                with lock:
+                    latencies.extend(mine)
+                    errors[0] += failed
+
+        def poll(user, peer):
+            count = 0
+            try:
+                while not done.is_set():
+                    newest = Message.objects.for_conversation(user, peer_id=peer.id).order_by('-id').values_list('id', flat=True).first()
+                    try:
+                        writes.mark_read(user, newest, peer_id=peer.id)
+                    except Exception:
+                        pass
+                    count += 1
+                    done.wait(options['poll_interval_ms'] / 1000)
+            finally:
+                connections.close_all()
+                with lock:
+                    polls[0] += count
+
+        send_threads = [
+            threading.Thread(target=send, args=(senders[2 * index], senders[2 * index + 1]))
+            for index in range(options['senders'])
+        ]
+        poll_threads = [
+            threading.Thread(target=poll, args=(user, senders[index % len(senders)]))
+            for index, user in enumerate(pollers)
+        ]
+        began = time.perf_counter()
+        for thread in send_threads + poll_threads:
+            thread.start()
+        for thread in send_threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+        done.set()
+        for thread in poll_threads:
+            thread.join()
+        sent = len(latencies) - errors[0]
+        return {
+            'sent': sent,
+            'errors': errors[0],
+            'elapsed': elapsed,
+            'throughput': sent / elapsed if elapsed else 0.0,
+            'polls': polls[0] / elapsed if elapsed else 0.0,
+            **summarize(latencies),
+        }
+
+    def report(self, name, result):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'== {name} =='))
+        self.stdout.write(
+            f"sent {result['sent']:,} in {result['elapsed']:.2f} s = {result['throughput']:.0f} messages/s, "
+            f"{result['errors']} failed, {result['polls']:.0f} polls/s"
+        )
+        self.stdout.write(f"send latency p50 {result['p50']:.2f} ms   p95 {result['p95']:.2f} ms   p99 {result['p99']:.2f} ms")
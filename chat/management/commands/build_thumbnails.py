@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.thumbnails import backfill
+
+
+class Command(BaseCommand):
+    help = 'Render missing thumbnails for image messages, profile pictures and channel images.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='Rendering threads (default: CHAT_THUMBNAIL_WORKERS).')
+
+    def handle(self, *args, **options):
+        count = backfill(options['workers'])
+        self.stdout.write(self.style.SUCCESS(f'Built {count} thumbnails.'))
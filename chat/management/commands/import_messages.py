@@ -0,0 +1,41 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.bulk import BulkPostError, post_messages
+from chat.models import Channel, CustomUser, Message
+
+
+class Command(BaseCommand):
+    help = (
+        'Import text messages from a JSON Lines file, one object per line: '
+        '{"sender": <username>, "channel_id": <id> | "recipient": <username>, "content": <text>}.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--batch-size', type=int, default=None, help='Messages per transaction.')
+
+    def handle(self, *args, **options):
+        with open(options['path'], encoding='utf-8') as handle:
+            items = [json.loads(line) for line in handle if line.strip()]
+        usernames = {item['sender'] for item in items} | {item['recipient'] for item in items if item.get('recipient')}
+        users = CustomUser.objects.in_bulk(usernames, field_name='username')
+        channels = Channel.objects.in_bulk({item['channel_id'] for item in items if item.get('channel_id')})
+        try:
+            messages = [
+                Message(
+                    sender=users[item['sender']],
+                    channel=channels[item['channel_id']] if item.get('channel_id') else None,
+                    recipient=users[item['recipient']] if item.get('recipient') else None,
+                    content=item.get('content'),
+                )
+                for item in items
+            ]
+        except KeyError as e:
+            raise CommandError(f'Unknown user or channel {e}.')
+        try:
+            post_messages(messages, options['batch_size'])
+        except BulkPostError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Imported {len(messages)} messages.'))
@@ -0,0 +1,16 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from chat.uploads import purge_stale
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked uploads that have not progressed for a while, along with their partial files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help='Age after which an idle upload is stale.')
+
+    def handle(self, *args, **options):
+        count = purge_stale(timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f'Purged {count} stale uploads.'))
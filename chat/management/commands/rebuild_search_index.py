@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat.search import install
+
+
+class Command(BaseCommand):
+    help = 'Create the message full-text index and its sync triggers if missing, then reindex all messages.'
+
+    def handle(self, *args, **options):
+        install(rebuild=True)
+        self.stdout.write(self.style.SUCCESS('Message search index rebuilt.'))
@@ -0,0 +1,164 @@
+"""
+Access-controlled serving of message attachments.
+
+Attachments are served through ``attachment_view`` rather than the public
+``MEDIA_URL`` so that only participants of the conversation can fetch them;
+``public_media_urls`` serves the rest of ``MEDIA_ROOT`` in development.
+Responses carry ETag/Last-Modified validators and honour single ``Range``
+requests, so audio/video seeking works and revalidation is a 304.
+
+Set ``CHAT_MEDIA_SENDFILE`` to hand the byte pushing to the front proxy once
+access has been checked:
+
+* ``'x-accel-redirect'`` (nginx): the response carries
+  ``X-Accel-Redirect: <CHAT_MEDIA_ACCEL_PREFIX><file name>``; map that prefix to
+  ``MEDIA_ROOT`` in an ``internal`` location.
+* ``'x-sendfile'`` (Apache mod_xsendfile, lighttpd): the response carries the
+  absolute path in ``X-Sendfile``.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.conf.urls.static import static
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+from .models import ChannelMembership, Message
+
+SENDFILE_MODE = getattr(settings, 'CHAT_MEDIA_SENDFILE', None)
+ACCEL_PREFIX = getattr(settings, 'CHAT_MEDIA_ACCEL_PREFIX', '/protected-media/')
+CACHE_MAX_AGE = getattr(settings, 'CHAT_MEDIA_MAX_AGE', 7 * 24 * 3600)
+STREAM_BLOCK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+# Upload prefixes anyone may fetch: profile and channel pictures.
+PUBLIC_MEDIA_PREFIXES = ('profiles/', 'channels/')
+
+
+def public_media_urls():
+    """Development ``static()`` routes for the public prefixes; attachments are left out."""
+    return [
+        pattern
+        for prefix in PUBLIC_MEDIA_PREFIXES
+        for pattern in static(settings.MEDIA_URL + prefix, document_root=os.path.join(settings.MEDIA_ROOT, prefix))
+    ]
+
+
+def attachment_url(message_id, thumbnail=False):
+    url = reverse('message_attachment', args=[message_id])
+    return url + '?thumbnail=1' if thumbnail else url
+
+
+def can_access(user, message):
+    if message.channel_id:
+        return user.is_superuser or ChannelMembership.objects.filter(user=user, channel_id=message.channel_id).exists()
+    return user.id in (message.sender_id, message.recipient_id)
+
+
+def parse_range(header, size):
+    """Return ``(start, end)`` (inclusive) for a single byte range, ``None`` to serve it all,
+    or raise ValueError if the range cannot be satisfied."""
+    match = _RANGE.match(header.strip()) if header else None
+    if not match:
+        return None  # Absent, malformed or multi-range: fall back to the whole file.
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Unsatisfiable range')
+    return start, end
+
+
+def _iter_range(path, start, length):
+    with open(path, 'rb') as handle:
+        handle.seek(start)
+        while length > 0:
+            block = handle.read(min(STREAM_BLOCK_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def _not_modified(request, etag, mtime):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return since is not None and int(mtime) <= since
+
+
+def serve_attachment(request, message, name=None):
+    """Serve the message's file, or ``name`` (a derivative stored alongside it)."""
+    name = name or message.file.name
+    path = message.file.storage.path(name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Http404('Attachment is missing')
+    etag = quote_etag(f'{message.id}-{stat.st_size:x}-{int(stat.st_mtime):x}')
+    validators = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': f'private, max-age={CACHE_MAX_AGE}',
+    }
+
+    if _not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+    elif SENDFILE_MODE:
+        response = HttpResponse(content_type=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        if SENDFILE_MODE == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = ACCEL_PREFIX + name
+        else:
+            response['X-Sendfile'] = path
+    else:
+        response = _file_response(request, path, name, stat.st_size, etag, stat.st_mtime)
+
+    for header, value in validators.items():
+        response[header] = value
+    return response
+
+
+def _file_response(request, path, name, size, etag, mtime):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if if_range is None or if_range == etag or parse_http_date_safe(if_range) == int(mtime):
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(_iter_range(path, start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    response['Accept-Ranges'] = 'bytes'
+    if content_type.split('/')[0] not in ('image', 'video', 'audio'):
+        response['Content-Disposition'] = content_disposition_header(True, os.path.basename(name))
+    return response
+
+
+def get_attachment(user, message_id):
+    message = Message.objects.filter(id=message_id).only(
+        'id', 'file', 'thumbnail', 'channel_id', 'sender_id', 'recipient_id'
+    ).first()
+    if message is None or not message.file or not can_access(user, message):
+        raise Http404('No such attachment')
+    return message
@@ -0,0 +1,108 @@
+"""
+Bulk channel membership changes and the member-picker typeahead.
+
+Every change takes a list of user ids and is applied with a handful of
+set-based statements in one transaction, whatever the size of the list.
+Members added here skip the ``ChannelMembership`` signals, so their inbox
+summaries are created in bulk alongside them.
+"""
+import csv
+import io
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, Value
+from django.db.models.functions import Lower
+
+from . import inbox, unread, versions
+from .models import ChannelMembership, CustomUser
+
+MAX_USERS = getattr(settings, 'CHAT_BULK_MAX_MEMBERS', 10000)
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+
+class MembershipError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def can_manage(user, channel):
+    return user.is_superuser or channel.created_by_id == user.id
+
+
+def parse_user_list(text):
+    """Ids or usernames from CSV text; every cell counts, so commas and newlines can be mixed."""
+    return [cell.strip() for row in csv.reader(io.StringIO(text)) for cell in row if cell.strip()]
+
+
+def resolve_user_ids(tokens):
+    """Map ids and usernames to existing user ids with one query; raise on unknown ones."""
+    if len(tokens) > MAX_USERS:
+        raise MembershipError(f'At most {MAX_USERS} users per request.', status=413)
+    ids = {int(token) for token in tokens if str(token).isdigit()}
+    names = {str(token) for token in tokens if not str(token).isdigit()}
+    found = CustomUser.objects.filter(id__in=ids) | CustomUser.objects.filter(username__in=names)
+    rows = list(found.values_list('id', 'username'))
+    missing = (ids - {row[0] for row in rows}) | (names - {row[1] for row in rows})
+    if missing:
+        raise MembershipError(f'Unknown users: {", ".join(sorted(map(str, missing)))[:500]}')
+    return {row[0] for row in rows}
+
+
+def add_members(channel, user_ids, can_send_messages=False):
+    """Add the users who are not members yet; returns how many were added."""
+    with transaction.atomic():
+        existing = set(ChannelMembership.objects.filter(channel=channel, user_id__in=user_ids).values_list('user_id', flat=True))
+        new_ids = sorted(set(user_ids) - existing)
+        # bulk_create skips the pre_save hook that starts new members caught up.
+        head = unread.channel_head(channel.id)
+        ChannelMembership.objects.bulk_create(
+            [
+                ChannelMembership(
+                    channel=channel, user_id=user_id, can_send_messages=can_send_messages, last_read_message_id=head,
+                )
+                for user_id in new_ids
+            ],
+            ignore_conflicts=True,
+        )
+        inbox.add_channel_members(channel.id, new_ids)
+        versions.bump_on_commit(new_ids)
+    return len(new_ids)
+
+
+def remove_members(channel, user_ids):
+    with transaction.atomic():
+        inbox.remove_channel_members(channel.id, user_ids)
+        versions.bump_on_commit(user_ids)
+        removed, _ = ChannelMembership.objects.filter(channel=channel, user_id__in=user_ids).delete()
+    return removed
+
+
+def set_can_send(channel, user_ids, allowed):
+    with transaction.atomic():
+        return ChannelMembership.objects.filter(channel=channel, user_id__in=user_ids).update(can_send_messages=allowed)
+
+
+def search_users(query, exclude_channel=None, after=None, limit=None):
+    """Users whose username starts with ``query``, ignoring case, in username order, a page at a time.
+
+    A range on the lowercase username index (``user_username_lower_idx``)
+    keeps this an index seek however large the user table is; both sides are
+    lowercased by the database, so they agree on what lowercase means.
+    ``after`` is the last username of the previous page.  Returns
+    ``(users, next_after)``.
+    """
+    limit = min(limit or SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE)
+    users = CustomUser.objects.alias(username_lower=Lower('username')).filter(
+        username_lower__gte=Lower(Value(query)), username_lower__lt=Lower(Value(query + '\U0010ffff')),
+    ).order_by('username_lower', 'username')
+    if after:
+        # Usernames differing only in case share a lowercase form; the username breaks the tie.
+        after_lower = Lower(Value(after))
+        users = users.filter(Q(username_lower__gt=after_lower) | Q(username_lower=after_lower, username__gt=after))
+    if exclude_channel is not None:
+        users = users.exclude(channels=exclude_channel)
+    page = list(users.only('id', 'username', 'first_name', 'last_name')[:limit + 1])
+    return page[:limit], (page[limit - 1].username if len(page) > limit else None)
@@ -0,0 +1,293 @@
+"""
+Cache of the newest messages of each conversation, for polling deltas.
+
+Each entry holds the last ``CHAT_MESSAGE_CACHE_SIZE`` message rows (the
+viewer-independent ``values(*MESSAGE_FIELDS)`` form) of one conversation and
+a *floor*: every message with a larger id is in the entry.  A poll whose
+``last_message_id`` is at or above the floor is answered without touching
+the database; one further behind falls back to the regular query.
+
+New messages are written through once their transaction commits; edits,
+deletes and sender profile changes invalidate.  Two implementations:
+
+* ``LocMemMessageCache``: per-process LRU over conversations, bounded by
+  ``CHAT_MESSAGE_CACHE_CONVERSATIONS``.  Like the message hub it only sees
+  writes made by its own process, so it is only correct when one process
+  serves the site (the development server).
+* ``DjangoMessageCache``: stores entries in the Django cache named by
+  ``CHAT_MESSAGE_CACHE_ALIAS`` so several processes can share them; eviction
+  is left to that backend.
+
+``CHAT_MESSAGE_CACHE_BACKEND`` selects one by dotted path; ``None`` disables
+the cache.  Unset, it is ``DjangoMessageCache`` when the alias is a shared
+cache and disabled otherwise.
+"""
+import secrets
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import Message
+from .shared_caches import is_shared
+from .pagination import MAX_PAGE_SIZE, page_after
+from .serializers import MESSAGE_FIELDS
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class MessageCache:
+    # Whether every process sees the same entries.
+    shared = False
+
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, 'CHAT_MESSAGE_CACHE_SIZE', 50)
+        self.hits = self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def rows_since(self, key, after_id, loader):
+        """Cached rows past ``after_id`` (oldest first), or None if the cache cannot answer.
+
+        ``loader(n)`` returns the newest ``n`` rows of the conversation, oldest
+        first; it is called to fill a missing entry.
+        """
+        entry = self._get(key)
+        hit = entry is not None
+        if not hit:
+            entry = self._fill(key, loader)
+        floor, rows = entry
+        if after_id < floor:
+            hit, rows = False, None
+        else:
+            rows = [row for row in rows if row['id'] > after_id]
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return rows
+
+    def stats(self):
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                'backend': type(self).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def _entry(self, rows):
+        # Fewer rows than fit means this is the whole conversation.
+        return (rows[0]['id'] - 1 if len(rows) >= self.size else 0), rows
+
+    def _append(self, entry, row):
+        floor, rows = entry
+        if any(existing['id'] == row['id'] for existing in rows):
+            return entry
+        rows = sorted(rows + [row], key=lambda item: item['id'])
+        if len(rows) > self.size:
+            rows = rows[-self.size:]
+            floor = max(floor, rows[0]['id'] - 1)
+        return floor, rows
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _fill(self, key, loader):
+        raise NotImplementedError
+
+    def record(self, key, row):
+        """Add a committed message to its conversation's entry, if one is cached."""
+        raise NotImplementedError
+
+    def invalidate(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocMemMessageCache(MessageCache):
+    def __init__(self, size=None, max_conversations=None):
+        super().__init__(size)
+        self.max_conversations = max_conversations or getattr(settings, 'CHAT_MESSAGE_CACHE_CONVERSATIONS', 1000)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Bumped by every write to a conversation, so a fill that raced a write
+        # is not stored.  Trimmed like the entries; a trimmed key reports the
+        # newest trimmed version, which still differs from any older snapshot.
+        self._versions = OrderedDict()
+        self._trimmed_version = 0
+        self._clock = 0
+
+    def _version(self, key):
+        return self._versions.get(key, self._trimmed_version)
+
+    def _bump(self, key):
+        self._clock += 1
+        self._versions[key] = self._clock
+        self._versions.move_to_end(key)
+        while len(self._versions) > 4 * self.max_conversations:
+            _, version = self._versions.popitem(last=False)
+            self._trimmed_version = max(self._trimmed_version, version)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _fill(self, key, loader):
+        with self._lock:
+            version = self._version(key)
+        entry = self._entry(loader(self.size))
+        with self._lock:
+            if self._version(key) == version:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_conversations:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def record(self, key, row):
+        with self._lock:
+            self._bump(key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = self._append(entry, row)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._bump(key)
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._clock += 1
+            self._trimmed_version = self._clock
+            self._versions.clear()
+            self._entries.clear()
+
+
+class DjangoMessageCache(MessageCache):
+    """Entries are tagged with a per-conversation version and a global epoch;
+    a write bumps the version, so a stale or racing copy is never served."""
+
+    shared = True
+
+    def __init__(self, size=None, alias=None, timeout=None):
+        super().__init__(size)
+        self.cache = caches[alias or getattr(settings, 'CHAT_MESSAGE_CACHE_ALIAS', 'default')]
+        self.timeout = timeout or getattr(settings, 'CHAT_MESSAGE_CACHE_TIMEOUT', 600)
+        self.prefix = 'chat:messages'
+
+    def _keys(self, key):
+        return f'{self.prefix}:entry:{key}', f'{self.prefix}:version:{key}', f'{self.prefix}:epoch'
+
+    def _get(self, key):
+        entry_key, version_key, epoch_key = self._keys(key)
+        found = self.cache.get_many([entry_key, version_key, epoch_key])
+        entry = found.get(entry_key)
+        tag = [found.get(epoch_key), found.get(version_key)]
+        if entry is None or None in tag or list(entry['tag']) != tag:
+            return None
+        return entry['floor'], entry['rows']
+
+    def _current_tag(self, key):
+        _, version_key, epoch_key = self._keys(key)
+        # Random starting points: a key that was evicted and re-added never
+        # matches a copy tagged before the eviction.
+        self.cache.add(epoch_key, secrets.randbits(48), None)
+        self.cache.add(version_key, secrets.randbits(48), None)
+        found = self.cache.get_many([epoch_key, version_key])
+        return [found.get(epoch_key), found.get(version_key)]
+
+    def _fill(self, key, loader):
+        tag = self._current_tag(key)
+        floor, rows = entry = self._entry(loader(self.size))
+        if None not in tag:
+            self.cache.set(self._keys(key)[0], {'tag': tag, 'floor': floor, 'rows': rows}, self.timeout)
+        return entry
+
+    def record(self, key, row):
+        entry_key, version_key, epoch_key = self._keys(key)
+        try:
+            version = self.cache.incr(version_key)
+        except ValueError:
+            return
+        found = self.cache.get_many([entry_key, epoch_key])
+        entry = found.get(entry_key)
+        # Only extend the copy made right before this write; anything else is stale.
+        if entry is None or list(entry['tag']) != [found.get(epoch_key), version - 1]:
+            return
+        floor, rows = self._append((entry['floor'], entry['rows']), row)
+        self.cache.set(entry_key, {'tag': [entry['tag'][0], version], 'floor': floor, 'rows': rows}, self.timeout)
+
+    def invalidate(self, key):
+        self.cache.delete(self._keys(key)[1])
+
+    def clear(self):
+        self.cache.delete(self._keys('')[2])
+
+
+def default_backend():
+    alias = getattr(settings, 'CHAT_MESSAGE_CACHE_ALIAS', 'default')
+    return 'chat.message_cache.DjangoMessageCache' if is_shared(alias) else None
+
+
+def get_cache():
+    """The configured cache instance, or None when caching is disabled."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            path = getattr(settings, 'CHAT_MESSAGE_CACHE_BACKEND', default_backend())
+            _cache = import_string(path)() if path else False
+    return _cache or None
+
+
+@receiver(setting_changed)
+def _reset(setting, **kwargs):
+    global _cache
+    if setting.startswith('CHAT_MESSAGE_CACHE'):
+        with _cache_lock:
+            _cache = None
+
+
+def _newest_rows(key, count):
+    return list(reversed(Message.objects.for_key(key).order_by('-id').values(*MESSAGE_FIELDS)[:count]))
+
+
+def rows_since(key, after_id, size=None):
+    """``(rows, has_more)`` for the conversation ``key`` past ``after_id``, from the cache when possible."""
+    cache = get_cache()
+    rows = cache.rows_since(key, int(after_id or 0), lambda count: _newest_rows(key, count)) if cache else None
+    if rows is None:
+        return page_after(Message.objects.for_key(key).values(*MESSAGE_FIELDS), after_id, size)
+    size = size or MAX_PAGE_SIZE
+    return rows[:size], len(rows) > size
+
+
+def record(key, row):
+    cache = get_cache()
+    if cache:
+        cache.record(key, row)
+
+
+def invalidate(key):
+    cache = get_cache()
+    if cache:
+        cache.invalidate(key)
+
+
+def clear():
+    cache = get_cache()
+    if cache:
+        cache.clear()
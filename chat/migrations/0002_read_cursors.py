@@ -0,0 +1,85 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max, Min, Q
+
+
+def cursors_from_read_flags(apps, schema_editor):
+    """Place each cursor just before the reader's oldest unread message."""
+    Message = apps.get_model('chat', 'Message')
+    ChannelMembership = apps.get_model('chat', 'ChannelMembership')
+    PrivateReadCursor = apps.get_model('chat', 'PrivateReadCursor')
+
+    for membership in ChannelMembership.objects.all().iterator():
+        bounds = Message.objects.filter(channel_id=membership.channel_id).exclude(
+            sender_id=membership.user_id
+        ).aggregate(newest=Max('id'), first_unread=Min('id', filter=Q(read=False)))
+        if bounds['first_unread'] is not None:
+            membership.last_read_message_id = bounds['first_unread'] - 1
+        else:
+            membership.last_read_message_id = bounds['newest'] or 0
+        membership.save(update_fields=['last_read_message_id'])
+
+    pairs = Message.objects.filter(recipient__isnull=False).values('recipient', 'sender').annotate(
+        newest=Max('id'), first_unread=Min('id', filter=Q(read=False))
+    ).order_by()
+    PrivateReadCursor.objects.bulk_create(
+        [
+            PrivateReadCursor(
+                user_id=pair['recipient'],
+                peer_id=pair['sender'],
+                last_read_message_id=pair['first_unread'] - 1 if pair['first_unread'] is not None else pair['newest'],
+            )
+            for pair in pairs
+            if pair['recipient'] != pair['sender']
+        ],
+        batch_size=1000,
+    )
+
+
+def read_flags_from_cursors(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    ChannelMembership = apps.get_model('chat', 'ChannelMembership')
+    PrivateReadCursor = apps.get_model('chat', 'PrivateReadCursor')
+
+    Message.objects.update(read=False)
+    for cursor in PrivateReadCursor.objects.all().iterator():
+        Message.objects.filter(
+            sender_id=cursor.peer_id, recipient_id=cursor.user_id, id__lte=cursor.last_read_message_id
+        ).update(read=True)
+    for channel_id, up_to in ChannelMembership.objects.values_list('channel').annotate(up_to=Max('last_read_message_id')):
+        Message.objects.filter(channel_id=channel_id, id__lte=up_to).update(read=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channelmembership',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0, help_text='Id of the newest message this member has read'),
+        ),
+        migrations.CreateModel(
+            name='PrivateReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.PositiveBigIntegerField(default=0)),
+                ('peer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'peer')},
+            },
+        ),
+        migrations.RunPython(cursors_from_read_flags, read_flags_from_cursors),
+        migrations.RemoveField(
+            model_name='message',
+            name='read',
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:22
+
+from django.db import migrations, models
+
+
+def backfill_conversation(apps, schema_editor):
+    """One UPDATE per (sender, recipient) pair rather than one per message."""
+    Message = apps.get_model('chat', 'Message')
+    pairs = Message.objects.filter(channel__isnull=True, recipient__isnull=False).values_list(
+        'sender', 'recipient'
+    ).distinct().order_by()
+    for sender_id, recipient_id in pairs.iterator():
+        low, high = sorted((sender_id, recipient_id))
+        Message.objects.filter(sender_id=sender_id, recipient_id=recipient_id, channel__isnull=True).update(
+            conversation=f'private:{low}:{high}'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_read_cursors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.RunPython(backfill_conversation, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['channel', 'id'], name='message_channel_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['recipient', 'sender', 'id'], name='message_recipient_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'recipient'], name='message_sender_recipient_idx'),
+        ),
+    ]
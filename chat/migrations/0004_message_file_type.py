@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:27
+
+from django.db import migrations, models
+
+FILE_TYPES = (
+    (('.jpg', '.png', '.jpeg', '.gif'), 'image'),
+    (('.mp4', '.webm'), 'video'),
+    (('.mp3', '.wav'), 'audio'),
+)
+
+
+def backfill_file_type(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    batch = []
+    for message in Message.objects.exclude(file__isnull=True).exclude(file='').only('id', 'file').iterator():
+        name = message.file.name.lower()
+        message.file_type = next((kind for suffixes, kind in FILE_TYPES if name.endswith(suffixes)), 'file')
+        batch.append(message)
+        if len(batch) >= 1000:
+            Message.objects.bulk_update(batch, ['file_type'])
+            batch = []
+    Message.objects.bulk_update(batch, ['file_type'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_conversation_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='file_type',
+            field=models.CharField(default='file', editable=False, max_length=10),
+        ),
+        migrations.RunPython(backfill_file_type, migrations.RunPython.noop),
+    ]
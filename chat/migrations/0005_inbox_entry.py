@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def build_inbox(apps, schema_editor):
+    from chat.inbox import rebuild
+    rebuild(apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_file_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_id', models.PositiveBigIntegerField(default=0)),
+                ('last_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('preview', models.CharField(blank=True, max_length=100)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('channel', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='chat.channel')),
+                ('peer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'inbox entries',
+                'indexes': [models.Index(fields=['user', '-last_timestamp'], name='inbox_user_recency_idx')],
+                'unique_together': {('user', 'channel'), ('user', 'peer')},
+            },
+        ),
+        migrations.RunPython(build_inbox, migrations.RunPython.noop),
+    ]
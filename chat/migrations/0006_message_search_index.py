@@ -0,0 +1,25 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:31
+
+from django.db import migrations
+
+
+def install_search_index(apps, schema_editor):
+    from chat.search import install
+    install(schema_editor)
+
+
+def uninstall_search_index(apps, schema_editor):
+    from chat.search import get_backend
+    with schema_editor.connection.cursor() as cursor:
+        get_backend(schema_editor.connection.vendor).uninstall(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_inbox_entry'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
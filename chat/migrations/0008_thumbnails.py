@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_upload_session'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='channel_thumbnail',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='profile_thumbnail',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='thumbnail',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='is_broadcast',
+            field=models.BooleanField(default=False, help_text='Only admins post; new messages are fanned out to members in batches'),
+        ),
+    ]
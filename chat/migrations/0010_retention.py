@@ -0,0 +1,45 @@
+# Generated by Django 5.2.4 on 2026-10-18 10:57
+
+import django.db.models.deletion
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_channel_broadcast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation', models.CharField(max_length=64)),
+                ('month', models.DateField()),
+                ('path', models.CharField(max_length=255)),
+                ('first_message_id', models.PositiveBigIntegerField()),
+                ('last_message_id', models.PositiveBigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation', 'last_message_id'], name='archive_conversation_idx'), models.Index(fields=['first_message_id', 'last_message_id'], name='archive_id_range_idx')],
+                'unique_together': {('conversation', 'month')},
+            },
+        ),
+        migrations.CreateModel(
+            name='RetentionPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('archive_after_days', models.PositiveIntegerField()),
+                ('purge_attachments', models.BooleanField(default=False, help_text='Delete the files of archived attachments')),
+                ('channel', models.OneToOneField(blank=True, help_text='Leave empty for the policy of all private conversations.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='retention_policy', to='chat.channel')),
+            ],
+            options={
+                'verbose_name_plural': 'retention policies',
+                'constraints': [models.UniqueConstraint(django.db.models.functions.comparison.Coalesce('channel', models.Value(0)), name='retention_policy_scope_unique')],
+            },
+        ),
+    ]
@@ -1,9 +1,23 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.db.models.functions import Coalesce, Lower
+
+from .thumbnails import current_thumbnail
+
+
+def conversation_key(channel_id=None, user_ids=None):
+    """Stable key for a conversation: ``channel:<id>`` or ``private:<low>:<high>``."""
+    if channel_id:
+        return f'channel:{channel_id}'
+    low, high = sorted(int(user_id) for user_id in user_ids)
+    return f'private:{low}:{high}'
 
 class CustomUser(AbstractUser):
     phone_number = models.CharField(max_length=15, blank=True, null=True)
     profile_image = models.ImageField(upload_to='profiles/', blank=True, null=True, default='profiles/default.jpg')
+    profile_thumbnail = models.CharField(max_length=255, blank=True, null=True, editable=False)
 
     groups = models.ManyToManyField(
         'auth.Group',
@@ -20,6 +34,10 @@ class CustomUser(AbstractUser):
         verbose_name='user permissions',
     )
 
+    class Meta(AbstractUser.Meta):
+        # The typeahead matches username prefixes without regard to case.
+        indexes = [models.Index(Lower('username'), name='user_username_lower_idx')]
+
     def __str__(self):
         return self.username
 
@@ -28,8 +46,13 @@ class CustomUser(AbstractUser):
             return self.profile_image.url
         return '/media/profiles/default.jpg'
 
+    def get_profile_thumbnail(self):
+        thumbnail = current_thumbnail(self.profile_image.name, self.profile_thumbnail, 'profile', self.pk)
+        return self.profile_image.storage.url(thumbnail) if thumbnail else self.get_profile_image()
+
     def unread_messages_count(self, user):
-        return Message.objects.filter(sender=self, recipient=user, read=False).count()
+        cursor = PrivateReadCursor.objects.filter(user=user, peer=self).values_list('last_read_message_id', flat=True).first()
+        return Message.objects.filter(sender=self, recipient=user, id__gt=cursor or 0).count()
 
 class Channel(models.Model):
     name = models.CharField(max_length=100)
@@ -38,7 +61,11 @@ class Channel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_group_chat = models.BooleanField(default=False)
     channel_image = models.ImageField(upload_to='channels/', blank=True, null=True, default='channels/default_channel.jpg')
+    channel_thumbnail = models.CharField(max_length=255, blank=True, null=True, editable=False)
     max_file_size = models.PositiveIntegerField(default=10, help_text='Maximum file size in MB')
+    is_broadcast = models.BooleanField(
+        default=False, help_text='Only admins post; new messages are fanned out to members in batches'
+    )
 
     def __str__(self):
         return self.name
@@ -48,13 +75,21 @@ class Channel(models.Model):
             return self.channel_image.url
         return '/media/channels/default_channel.jpg'
 
+    def get_channel_thumbnail(self):
+        thumbnail = current_thumbnail(self.channel_image.name, self.channel_thumbnail, 'channel', self.pk)
+        return self.channel_image.storage.url(thumbnail) if thumbnail else self.get_channel_image()
+
     def unread_messages_count(self, user):
-        return Message.objects.filter(channel=self, read=False).exclude(sender=user).count()
+        cursor = ChannelMembership.objects.filter(user=user, channel=self).values_list('last_read_message_id', flat=True).first()
+        if cursor is None:
+            return 0
+        return Message.objects.filter(channel=self, id__gt=cursor).exclude(sender=user).count()
 
 class ChannelMembership(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE)
     can_send_messages = models.BooleanField(default=False, help_text='Allow this user to send messages in the channel')
+    last_read_message_id = models.PositiveBigIntegerField(default=0, help_text='Id of the newest message this member has read')
 
     class Meta:
         unique_together = ('user', 'channel')
@@ -62,6 +97,49 @@ class ChannelMembership(models.Model):
     def __str__(self):
         return f"{self.user.username} in {self.channel.name}"
 
+class PrivateReadCursor(models.Model):
+    """How far ``user`` has read the private conversation with ``peer``."""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='read_cursors')
+    peer = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'peer')
+
+    def __str__(self):
+        return f"{self.user.username} read {self.peer.username} up to {self.last_read_message_id}"
+
+class InboxEntry(models.Model):
+    """Denormalized summary of one conversation as seen by ``user``; maintained by chat.inbox."""
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='inbox_entries')
+    peer = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, null=True, blank=True, related_name='inbox_entries')
+    last_message_id = models.PositiveBigIntegerField(default=0)
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    preview = models.CharField(max_length=100, blank=True)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('user', 'peer'), ('user', 'channel')]
+        indexes = [models.Index(fields=['user', '-last_timestamp'], name='inbox_user_recency_idx')]
+        verbose_name_plural = 'inbox entries'
+
+    def __str__(self):
+        return f"{self.user.username}: {self.peer or self.channel}"
+
+class MessageQuerySet(models.QuerySet):
+    def for_conversation(self, user, channel_id=None, peer_id=None):
+        if channel_id:
+            return self.filter(channel_id=channel_id)
+        return self.filter(conversation=conversation_key(user_ids=(user.id, peer_id)))
+
+    def for_key(self, key):
+        """Messages of the conversation named by a ``conversation_key()``."""
+        if key.startswith('channel:'):
+            return self.filter(channel_id=int(key.split(':')[1]))
+        return self.filter(conversation=key)
+
+
 class Message(models.Model):
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE, null=True, blank=True)
@@ -69,7 +147,113 @@ class Message(models.Model):
     content = models.TextField(blank=True, null=True)
     file = models.FileField(upload_to='messages/', blank=True, null=True)
     timestamp = models.DateTimeField(auto_now_add=True)
-    read = models.BooleanField(default=False)
+    # Derived from the file name once at save time; see get_file_type().
+    file_type = models.CharField(max_length=10, default='file', editable=False)
+    # conversation_key() of private messages; NULL for channel messages.
+    conversation = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    # Resized derivative of an image attachment; filled in by chat.thumbnails.
+    thumbnail = models.CharField(max_length=255, null=True, blank=True, editable=False)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['channel', 'id'], name='message_channel_id_idx'),
+            models.Index(fields=['conversation', 'id'], name='message_conversation_id_idx'),
+            models.Index(fields=['recipient', 'sender', 'id'], name='message_recipient_sender_idx'),
+            models.Index(fields=['sender', 'recipient'], name='message_sender_recipient_idx'),
+            models.Index(fields=['timestamp'], name='message_timestamp_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.sender} to {self.recipient or self.channel}: {self.content[:50] if self.content else 'File message'}"
+
+    @property
+    def preview(self):
+        return self.content[:100] if self.content else 'File message'
+
+    def set_derived_fields(self):
+        """Fill the denormalized columns; ``save()`` does this, ``bulk_create`` callers must."""
+        if self.recipient_id and not self.channel_id:
+            self.conversation = conversation_key(user_ids=(self.sender_id, self.recipient_id))
+        self.file_type = self.get_file_type()
+
+    def save(self, *args, **kwargs):
+        self.set_derived_fields()
+        super().save(*args, **kwargs)
+
+    @property
+    def conversation_key(self):
+        if self.channel_id:
+            return conversation_key(channel_id=self.channel_id)
+        return conversation_key(user_ids=(self.sender_id, self.recipient_id))
+
+    def get_file_type(self):
+        if not self.file:
+            return 'file'
+        name = self.file.name.lower()
+        if name.endswith(('.jpg', '.png', '.jpeg', '.gif')):
+            return 'image'
+        if name.endswith(('.mp4', '.webm')):
+            return 'video'
+        if name.endswith(('.mp3', '.wav')):
+            return 'audio'
+        return 'file'
+
+
+class UploadSession(models.Model):
+    """A resumable, chunked attachment upload that becomes a Message once complete."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='upload_sessions')
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, null=True, blank=True)
+    recipient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    content = models.TextField(blank=True)
+    filename = models.CharField(max_length=255)
+    total_size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.total_size})"
+
+
+class RetentionPolicy(models.Model):
+    """Move messages older than ``archive_after_days`` out of the Message table; applied by chat.archive."""
+    channel = models.OneToOneField(
+        Channel, on_delete=models.CASCADE, null=True, blank=True, related_name='retention_policy',
+        help_text='Leave empty for the policy of all private conversations.',
+    )
+    archive_after_days = models.PositiveIntegerField()
+    purge_attachments = models.BooleanField(default=False, help_text='Delete the files of archived attachments')
+
+    class Meta:
+        verbose_name_plural = 'retention policies'
+        constraints = [
+            # One policy per channel and one for private conversations (channel NULL).
+            models.UniqueConstraint(Coalesce('channel', models.Value(0)), name='retention_policy_scope_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.channel or 'Private conversations'}: archive after {self.archive_after_days} days"
+
+
+class ArchiveSegment(models.Model):
+    """Index entry for one archive file: the archived messages of a conversation in one month."""
+    conversation = models.CharField(max_length=64)
+    month = models.DateField()
+    path = models.CharField(max_length=255)
+    first_message_id = models.PositiveBigIntegerField()
+    last_message_id = models.PositiveBigIntegerField()
+    message_count = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('conversation', 'month')
+        indexes = [
+            models.Index(fields=['conversation', 'last_message_id'], name='archive_conversation_idx'),
+            models.Index(fields=['first_message_id', 'last_message_id'], name='archive_id_range_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.sender} to {self.recipient or self.channel}: {self.content[:50] if self.content else 'File message'}"
\ No newline at end of file
+        return f"{self.conversation} {self.month:%Y-%m} ({self.message_count} messages)"
@@ -0,0 +1,43 @@
+"""
+Keyset pagination over message ids.
+
+Pages are addressed by message id rather than offset, so fetching any page is
+a bounded range scan on the (channel, id) / (conversation, id) indexes no
+matter how long the conversation is.
+"""
+from django.conf import settings
+
+PAGE_SIZE = getattr(settings, 'CHAT_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = getattr(settings, 'CHAT_MAX_PAGE_SIZE', 200)
+
+
+def page_size(value):
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+
+
+def page_before(queryset, before_id=None, size=None):
+    """The ``size`` newest messages older than ``before_id``, oldest first, plus a has-more flag."""
+    size = size or PAGE_SIZE
+    if before_id:
+        queryset = queryset.filter(id__lt=before_id)
+    rows = list(queryset.order_by('-id')[:size + 1])
+    return rows[:size][::-1], len(rows) > size
+
+
+async def apage_before(queryset, before_id=None, size=None):
+    """Async ``page_before``."""
+    size = size or PAGE_SIZE
+    if before_id:
+        queryset = queryset.filter(id__lt=before_id)
+    rows = [row async for row in queryset.order_by('-id')[:size + 1]]
+    return rows[:size][::-1], len(rows) > size
+
+
+def page_after(queryset, after_id=0, size=None):
+    """Up to ``size`` messages newer than ``after_id``, oldest first, plus a has-more flag."""
+    size = size or MAX_PAGE_SIZE
+    rows = list(queryset.filter(id__gt=after_id or 0).order_by('id')[:size + 1])
+    return rows[:size], len(rows) > size
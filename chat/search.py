@@ -0,0 +1,190 @@
+"""
+Full-text search over message content.
+
+The index is maintained by the database itself so it stays in sync with every
+insert, edit and delete, including bulk writes:
+
+* SQLite: an external-content FTS5 table (``chat_message_fts``) fed by triggers.
+* PostgreSQL: a GIN index on ``to_tsvector('simple', content)``.
+
+``install()`` creates those objects and is idempotent; it runs from migration
+0006 and ``manage.py rebuild_search_index``.  SQLite drops triggers when Django
+remakes a table, so migrations that alter ``chat_message`` must call it again.
+
+Which backend answers queries is chosen by ``CHAT_SEARCH_BACKEND`` (a dotted
+path) or, by default, from the database vendor.  Results are always limited
+to conversations the user can read.
+"""
+import re
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+# Control characters cannot appear in HTML-escaped text, so they are safe
+# placeholders for the highlight markup until the snippet has been escaped.
+_START, _STOP = '\x02', '\x03'
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+SQLITE_SETUP = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(content, content='chat_message', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_ai AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_ad AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS chat_message_fts_au AFTER UPDATE OF content ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+SQLITE_TEARDOWN = [
+    'DROP TRIGGER IF EXISTS chat_message_fts_ai',
+    'DROP TRIGGER IF EXISTS chat_message_fts_ad',
+    'DROP TRIGGER IF EXISTS chat_message_fts_au',
+    'DROP TABLE IF EXISTS chat_message_fts',
+]
+POSTGRES_SETUP = [
+    "CREATE INDEX IF NOT EXISTS chat_message_content_fts ON chat_message USING GIN (to_tsvector('simple', coalesce(content, '')))",
+]
+POSTGRES_TEARDOWN = ['DROP INDEX IF EXISTS chat_message_content_fts']
+
+# Messages in the user's channels or private conversations; params: user id x3.
+ACCESS_SQL = """(
+    m.channel_id IN (SELECT channel_id FROM chat_channelmembership WHERE user_id = %s)
+    OR (m.channel_id IS NULL AND (m.sender_id = %s OR m.recipient_id = %s))
+)"""
+
+
+@dataclass
+class SearchHit:
+    message_id: int
+    channel_id: int
+    peer_id: int
+    snippet: str
+    rank: float
+
+
+def _highlight(snippet):
+    return escape(snippet or '').replace(_START, '<mark>').replace(_STOP, '</mark>')
+
+
+def _peer_id(user, sender_id, recipient_id, channel_id):
+    if channel_id:
+        return None
+    return recipient_id if sender_id == user.id else sender_id
+
+
+class SearchBackend:
+    setup_sql = []
+    teardown_sql = []
+
+    def install(self, cursor, rebuild=True):
+        for statement in self.setup_sql:
+            cursor.execute(statement)
+
+    def uninstall(self, cursor):
+        for statement in self.teardown_sql:
+            cursor.execute(statement)
+
+    def search(self, user, query, page=1, page_size=20):
+        """Return ``(hits, has_more)`` for the 1-based ``page``."""
+        terms = _WORD.findall(query or '')
+        if not terms:
+            return [], False
+        offset = (max(page, 1) - 1) * page_size
+        with connection.cursor() as cursor:
+            cursor.execute(*self.build_query(user, terms, page_size + 1, offset))
+            rows = cursor.fetchall()
+        hits = [
+            SearchHit(message_id, channel_id, _peer_id(user, sender_id, recipient_id, channel_id), _highlight(snippet), rank)
+            for message_id, channel_id, sender_id, recipient_id, snippet, rank in rows[:page_size]
+        ]
+        return hits, len(rows) > page_size
+
+    def build_query(self, user, terms, limit, offset):
+        raise NotImplementedError
+
+
+class SQLiteFTS5Backend(SearchBackend):
+    setup_sql = SQLITE_SETUP
+    teardown_sql = SQLITE_TEARDOWN
+
+    def install(self, cursor, rebuild=True):
+        super().install(cursor)
+        if rebuild:
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+
+    def build_query(self, user, terms, limit, offset):
+        # Every term is quoted so user input can never be parsed as FTS syntax;
+        # the last one is a prefix match to support search-as-you-type.
+        quoted = ['"%s"' % term.replace('"', '""') for term in terms]
+        quoted[-1] += '*'
+        sql = f"""
+            SELECT m.id, m.channel_id, m.sender_id, m.recipient_id,
+                   snippet(chat_message_fts, 0, '{_START}', '{_STOP}', '…', 12),
+                   bm25(chat_message_fts) AS rank
+            FROM chat_message_fts JOIN chat_message m ON m.id = chat_message_fts.rowid
+            WHERE chat_message_fts MATCH %s AND {ACCESS_SQL}
+            ORDER BY rank, m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        return sql, [' '.join(quoted), user.id, user.id, user.id, limit, offset]
+
+
+class PostgresSearchBackend(SearchBackend):
+    setup_sql = POSTGRES_SETUP
+    teardown_sql = POSTGRES_TEARDOWN
+
+    def build_query(self, user, terms, limit, offset):
+        sql = f"""
+            SELECT m.id, m.channel_id, m.sender_id, m.recipient_id,
+                   ts_headline('simple', m.content, q, 'StartSel={_START}, StopSel={_STOP}, MaxWords=20, MinWords=5'),
+                   ts_rank(to_tsvector('simple', coalesce(m.content, '')), q) AS rank
+            FROM chat_message m, plainto_tsquery('simple', %s) q
+            WHERE to_tsvector('simple', coalesce(m.content, '')) @@ q AND {ACCESS_SQL}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        return sql, [' '.join(terms), user.id, user.id, user.id, limit, offset]
+
+
+class BasicSearchBackend(SearchBackend):
+    """Unindexed ``LIKE`` fallback for databases without a full-text engine."""
+
+    def build_query(self, user, terms, limit, offset):
+        like = ' AND '.join(['m.content LIKE %s'] * len(terms))
+        sql = f"""
+            SELECT m.id, m.channel_id, m.sender_id, m.recipient_id, m.content, 0
+            FROM chat_message m
+            WHERE {like} AND {ACCESS_SQL}
+            ORDER BY m.id DESC
+            LIMIT %s OFFSET %s
+        """
+        return sql, [f'%{term}%' for term in terms] + [user.id, user.id, user.id, limit, offset]
+
+
+VENDOR_BACKENDS = {
+    'sqlite': SQLiteFTS5Backend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend(vendor=None):
+    path = getattr(settings, 'CHAT_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    return VENDOR_BACKENDS.get(vendor or connection.vendor, BasicSearchBackend)()
+
+
+def install(schema_editor=None, rebuild=True):
+    target = schema_editor.connection if schema_editor else connection
+    with target.cursor() as cursor:
+        get_backend(target.vendor).install(cursor, rebuild=rebuild)
+
+
+def search_messages(user, query, page=1, page_size=20):
+    return get_backend().search(user, query, page, page_size)
@@ -0,0 +1,85 @@
+"""
+JSON serialization of messages for the polling, history and push endpoints.
+
+Rows are fetched with ``values()`` so the sender columns come back in the same
+query as the message; nothing here touches a related object lazily.  The
+viewer-dependent fields (``is_sent``/``read``) are filled in per request from
+ids alone.  Each payload carries ``html``, the viewer-independent markup
+chat.html shows, from the fragment cache.
+"""
+import os
+
+from django.core.files.storage import default_storage
+
+from .fragments import attach_html
+from .media import attachment_url
+from .thumbnails import current_thumbnail
+
+DEFAULT_PROFILE_IMAGE = '/media/profiles/default.jpg'
+
+MESSAGE_FIELDS = (
+    'id', 'sender_id', 'sender__username', 'sender__first_name', 'sender__last_name',
+    'sender__profile_image', 'sender__profile_thumbnail', 'content', 'file', 'file_type', 'thumbnail', 'timestamp',
+)
+
+
+def _media_url(name, default=''):
+    return default_storage.url(name) if name else default
+
+
+def serialize_row(row, viewer_id=None, read_up_to=0):
+    """Turn one ``values(*MESSAGE_FIELDS)`` row into the public message payload.
+
+    ``read`` says whether another participant has read a message the viewer
+    sent.  It is None when ``read_up_to`` is None, meaning the conversation
+    keeps no read receipts (broadcast channels).
+    """
+    full_name = f"{row['sender__first_name']} {row['sender__last_name']}".strip()
+    is_sent = row['sender_id'] == viewer_id
+    return {
+        'id': row['id'],
+        'sender_id': row['sender_id'],
+        'sender': full_name or row['sender__username'],
+        'sender_profile_image': _media_url(
+            current_thumbnail(
+                row['sender__profile_image'], row['sender__profile_thumbnail'], 'profile', row['sender_id'],
+            )
+            or row['sender__profile_image'], DEFAULT_PROFILE_IMAGE,
+        ),
+        'content': row['content'] or '',
+        'file_url': attachment_url(row['id']) if row['file'] else '',
+        'file_name': os.path.basename(row['file']) if row['file'] else '',
+        'file_type': row['file_type'],
+        'thumbnail_url': attachment_url(row['id'], thumbnail=True) if row['thumbnail'] else '',
+        'timestamp': row['timestamp'].strftime('%Y-%m-%d %H:%M'),
+        'is_sent': is_sent,
+        'read': None if read_up_to is None else not is_sent or row['id'] <= read_up_to,
+    }
+
+
+def serialize_rows(rows, viewer_id=None, read_up_to=0):
+    return attach_html([serialize_row(row, viewer_id, read_up_to) for row in rows])
+
+
+def message_row(message):
+    """The ``values(*MESSAGE_FIELDS)`` row of a message instance whose ``sender`` is loaded."""
+    sender = message.sender
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'sender__username': sender.username,
+        'sender__first_name': sender.first_name,
+        'sender__last_name': sender.last_name,
+        'sender__profile_image': sender.profile_image.name if sender.profile_image else '',
+        'sender__profile_thumbnail': sender.profile_thumbnail,
+        'content': message.content,
+        'file': message.file.name if message.file else '',
+        'file_type': message.file_type,
+        'thumbnail': message.thumbnail,
+        'timestamp': message.timestamp,
+    }
+
+
+def serialize_message(message, viewer_id=None, read_up_to=0):
+    """Payload for a message instance whose ``sender`` is already loaded (e.g. right after save)."""
+    return attach_html([serialize_row(message_row(message), viewer_id, read_up_to)])[0]
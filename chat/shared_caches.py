@@ -0,0 +1,20 @@
+"""
+Which Django caches every worker process sees.
+
+Several features keep cross-request state in a Django cache (message rows,
+change versions, sessions).  That is only correct with more than one worker
+when the cache is shared, e.g. Redis or memcached; ``LocMemCache`` lives in
+one process and ``DummyCache`` keeps nothing.
+"""
+from django.conf import settings
+
+PER_PROCESS_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def is_shared(alias):
+    """Whether the cache named ``alias`` is the same for every process."""
+    backend = settings.CACHES.get(alias, {}).get('BACKEND', '')
+    return bool(backend) and backend not in PER_PROCESS_BACKENDS
@@ -0,0 +1,89 @@
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import fastpath, inbox, message_cache, thumbnails, unread, versions
+from .models import Channel, ChannelMembership, CustomUser, Message
+from .serializers import message_row
+
+# Sender columns that cached message rows carry.
+SENDER_FIELDS = {'username', 'first_name', 'last_name', 'profile_image', 'profile_thumbnail'}
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    key = instance.conversation_key
+    if created:
+        inbox.record_message(instance)
+        versions.record_messages([instance])
+        row = message_row(instance)
+        transaction.on_commit(lambda: message_cache.record(key, row))
+        if instance.file_type == 'image':
+            thumbnails.schedule('message', instance.pk)
+    else:
+        transaction.on_commit(lambda: message_cache.invalidate(key))
+        versions.bump_on_commit(conversations=[key])
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    key = instance.conversation_key
+    transaction.on_commit(lambda: message_cache.invalidate(key))
+    inbox.refresh_on_commit([key])
+    versions.bump_on_commit(conversations=[key])
+
+
+@receiver(post_save, sender=CustomUser)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    fastpath.forget(instance.pk)
+    if thumbnails.needs_thumbnail(instance, 'profile', update_fields):
+        thumbnails.schedule('profile', instance.pk)
+    if not created and (update_fields is None or SENDER_FIELDS & set(update_fields)):
+        transaction.on_commit(message_cache.clear)
+
+
+@receiver(post_delete, sender=CustomUser)
+def user_deleted(sender, instance, **kwargs):
+    fastpath.forget(instance.pk)
+
+
+@receiver(user_logged_out)
+def logged_out(sender, request, **kwargs):
+    fastpath.forget_session(request.session.session_key)
+
+
+@receiver(thumbnails.thumbnail_ready)
+def thumbnail_ready(sender, kind, instance_id, **kwargs):
+    if kind == 'message':
+        message = Message.objects.filter(id=instance_id).only('channel_id', 'sender_id', 'recipient_id').first()
+        if message is not None:
+            message_cache.invalidate(message.conversation_key)
+    elif kind == 'profile':
+        message_cache.clear()
+
+
+@receiver(post_save, sender=Channel)
+def channel_saved(sender, instance, update_fields=None, **kwargs):
+    if thumbnails.needs_thumbnail(instance, 'channel', update_fields):
+        thumbnails.schedule('channel', instance.pk)
+
+
+@receiver(pre_save, sender=ChannelMembership)
+def membership_saving(sender, instance, **kwargs):
+    # A new member starts caught up rather than with the whole history unread.
+    if instance._state.adding and not instance.last_read_message_id:
+        instance.last_read_message_id = unread.channel_head(instance.channel_id)
+
+
+@receiver(post_save, sender=ChannelMembership)
+def membership_saved(sender, instance, created, **kwargs):
+    if created:
+        inbox.add_channel_member(instance)
+        versions.bump_on_commit([instance.user_id])
+
+
+@receiver(post_delete, sender=ChannelMembership)
+def membership_deleted(sender, instance, **kwargs):
+    inbox.remove_channel_member(instance)
+    versions.bump_on_commit([instance.user_id])
@@ -0,0 +1,122 @@
+"""
+Date drill-down for large admin changelists.
+
+Same links and template as the admin's ``date_hierarchy`` tag, but the
+listed years, months and days are found by skipping through an index on the
+field: one ``ORDER BY field LIMIT 1`` probe per period shown, instead of
+aggregating every row.
+"""
+import datetime
+
+from django import template
+from django.conf import settings
+from django.contrib.admin.utils import get_fields_from_path
+from django.db import models
+from django.utils import formats, timezone
+from django.utils.text import capfirst
+from django.utils.translation import gettext as _
+
+register = template.Library()
+
+
+def _start(value, kind):
+    if isinstance(value, datetime.datetime):
+        value = timezone.localtime(value).date() if timezone.is_aware(value) else value.date()
+    if kind == 'year':
+        return value.replace(month=1, day=1)
+    if kind == 'month':
+        return value.replace(day=1)
+    return value
+
+
+def _next(start, kind):
+    if kind == 'year':
+        return start.replace(year=start.year + 1)
+    if kind == 'month':
+        return (start + datetime.timedelta(days=32)).replace(day=1)
+    return start + datetime.timedelta(days=1)
+
+
+def _bound(day, is_datetime):
+    if not is_datetime:
+        return day
+    value = datetime.datetime.combine(day, datetime.time.min)
+    return timezone.make_aware(value) if settings.USE_TZ else value
+
+
+def periods(queryset, field_name, kind):
+    """Start dates of the ``kind`` periods that have rows, oldest first."""
+    is_datetime = isinstance(get_fields_from_path(queryset.model, field_name)[-1], models.DateTimeField)
+    values = queryset.exclude(**{f'{field_name}__isnull': True}).order_by(field_name).values_list(field_name, flat=True)
+    found = []
+    value = values.first()
+    while value is not None:
+        start = _start(value, kind)
+        found.append(start)
+        value = values.filter(**{f'{field_name}__gte': _bound(_next(start, kind), is_datetime)}).first()
+    return found
+
+
+@register.inclusion_tag('admin/date_hierarchy.html')
+def indexed_date_hierarchy(cl):
+    field_name = cl.date_hierarchy
+    year_field, month_field, day_field = (f'{field_name}__{part}' for part in ('year', 'month', 'day'))
+    year_lookup = cl.params.get(year_field)
+    month_lookup = cl.params.get(month_field)
+    day_lookup = cl.params.get(day_field)
+
+    def link(filters):
+        return cl.get_query_string(filters, [f'{field_name}__'])
+
+    if not (year_lookup or month_lookup or day_lookup):
+        values = cl.queryset.exclude(**{f'{field_name}__isnull': True}).order_by(field_name).values_list(field_name, flat=True)
+        first, last = values.first(), values.last()
+        if first is not None:
+            first, last = _start(first, 'day'), _start(last, 'day')
+            if first.year == last.year:
+                year_lookup = first.year
+                if first.month == last.month:
+                    month_lookup = first.month
+
+    if year_lookup and month_lookup and day_lookup:
+        day = datetime.date(int(year_lookup), int(month_lookup), int(day_lookup))
+        return {
+            'show': True,
+            'back': {
+                'link': link({year_field: year_lookup, month_field: month_lookup}),
+                'title': capfirst(formats.date_format(day, 'YEAR_MONTH_FORMAT')),
+            },
+            'choices': [{'title': capfirst(formats.date_format(day, 'MONTH_DAY_FORMAT'))}],
+        }
+    if year_lookup and month_lookup:
+        return {
+            'show': True,
+            'back': {'link': link({year_field: year_lookup}), 'title': str(year_lookup)},
+            'choices': [
+                {
+                    'link': link({year_field: year_lookup, month_field: month_lookup, day_field: day.day}),
+                    'title': capfirst(formats.date_format(day, 'MONTH_DAY_FORMAT')),
+                }
+                for day in periods(cl.queryset, field_name, 'day')
+            ],
+        }
+    if year_lookup:
+        return {
+            'show': True,
+            'back': {'link': link({}), 'title': _('All dates')},
+            'choices': [
+                {
+                    'link': link({year_field: year_lookup, month_field: month.month}),
+                    'title': capfirst(formats.date_format(month, 'YEAR_MONTH_FORMAT')),
+                }
+                for month in periods(cl.queryset, field_name, 'month')
+            ],
+        }
+    return {
+        'show': True,
+        'back': None,
+        'choices': [
+            {'link': link({year_field: str(year.year)}), 'title': str(year.year)}
+            for year in periods(cl.queryset, field_name, 'year')
+        ],
+    }
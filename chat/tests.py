@@ -1,3 +1,1264 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.apps import apps as django_apps
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test import AsyncClient, Client, TransactionTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    admin as chat_admin, archive, bus, fastpath, fragments, instrumentation, longpoll, media, message_cache, versions,
+    writes,
+)
+from .benchmarks import data as bench_data, load as bench_load
+from .hub import MessageHub, hub
+from .inbox import rebuild
+from .models import (
+    ArchiveSegment, Channel, ChannelMembership, CustomUser, InboxEntry, Message, PrivateReadCursor, RetentionPolicy,
+    conversation_key,
+)
+from .thumbnails import build as build_thumbnail, pending, thumbnail_name
+from .unread import unread_counts
+from .websocket import websocket_application
+
+
+class MessageHubTests(TestCase):
+    def test_publish_reaches_subscribers_of_key_only(self):
+        async def scenario():
+            hub = MessageHub()
+            first = hub.subscribe('channel:1')
+            other = hub.subscribe('channel:2')
+            self.assertEqual(hub.publish('channel:1', {'id': 1}), 1)
+            self.assertEqual(await asyncio.wait_for(first.get(), 1), {'id': 1})
+            self.assertTrue(other.queue.empty())
+            hub.unsubscribe(first)
+            hub.unsubscribe(other)
+            self.assertEqual(hub.subscriber_count(), 0)
+
+        asyncio.run(scenario())
+
+
+class NotificationBusTests(TestCase):
+    def setUp(self):
+        self.socket_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.socket_dir, ignore_errors=True)
+
+    def test_burst_reaches_other_processes_as_one_hint(self):
+        async def scenario():
+            receiving_hub = MessageHub()
+            listener = bus.LocalSocketBus(socket_dir=self.socket_dir, hub=receiving_hub)
+            publisher = bus.LocalSocketBus(socket_dir=self.socket_dir, flush_interval=0.05)
+            first = receiving_hub.subscribe('channel:1')
+            second = receiving_hub.subscribe('channel:1')
+            listener.start()
+            while not os.path.exists(listener.path):
+                await asyncio.sleep(0.01)
+            for message_id in range(1, 51):
+                publisher.notify('channel:1', message_id)
+            publisher.notify('channel:2', 7)
+            for subscription in (first, second):
+                payload = await asyncio.wait_for(subscription.get(), 2)
+                self.assertEqual(payload, {'conversation': 'channel:1', 'last_id': 50})
+            await asyncio.sleep(0.1)
+            self.assertTrue(first.queue.empty() and second.queue.empty())
+            await sync_to_async(publisher.close)()
+            await sync_to_async(listener.close)()
+            self.assertFalse(os.path.exists(listener.path))
+
+        asyncio.run(scenario())
+
+    def test_large_batches_are_split_and_own_batches_ignored(self):
+        notifications = bus.NotificationBus(hub=MessageHub())
+        notifications.max_payload = 200
+        conversations = {f'channel:{index}': index for index in range(50)}
+        batches = notifications._encode(conversations)
+        self.assertGreater(len(batches), 1)
+        self.assertTrue(all(len(data) <= 200 for data in batches))
+        merged = {}
+        for data in batches:
+            merged.update(json.loads(data)['conversations'])
+        self.assertEqual(merged, conversations)
+        with mock.patch.object(notifications.hub, 'publish') as publish:
+            notifications.receive(batches[0])
+            notifications.receive(json.dumps({'origin': 'elsewhere', 'conversations': {'channel:1': 3}}))
+        publish.assert_called_once_with('channel:1', {'conversation': 'channel:1', 'last_id': 3})
+
+    def test_other_processes_messages_bump_local_versions(self):
+        alice = CustomUser.objects.create_user('alice')
+        bob = CustomUser.objects.create_user('bob')
+        channel = Channel.objects.create(name='general', created_by=alice)
+        ChannelMembership.objects.create(user=bob, channel=channel)
+        keys = [
+            versions.conversation_version_key(conversation_key(channel_id=channel.id)),
+            versions.user_version_key(bob.id),
+            versions.user_version_key(alice.id),
+        ]
+        before = versions.versions(keys)
+        notifications = bus.NotificationBus(hub=MessageHub())
+        notifications.receive(json.dumps({
+            'origin': 'elsewhere', 'conversations': {conversation_key(channel_id=channel.id): 3},
+        }))
+        after = versions.versions(keys)
+        self.assertGreater(after[0], before[0])
+        self.assertGreater(after[1], before[1])
+        # Alice created the channel but never joined it.
+        self.assertEqual(after[2], before[2])
+
+    def test_polls_start_the_listener(self):
+        user = CustomUser.objects.create_user('carol')
+        self.client.force_login(user)
+        with override_settings(CHAT_BUS_BACKEND='chat.bus.LocalSocketBus', CHAT_BUS_SOCKET_DIR=self.socket_dir):
+            self.client.get(reverse('get_unread_counts'))
+            listener = bus.get_bus()
+            for _ in range(200):
+                if os.path.exists(listener.path):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(listener.path))
+
+
+class WebSocketPushTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice', password='pw')
+        self.bob = CustomUser.objects.create_user('bob', password='pw')
+        self.channel = Channel.objects.create(name='general', created_by=self.alice)
+        ChannelMembership.objects.create(user=self.alice, channel=self.channel, can_send_messages=True)
+        ChannelMembership.objects.create(user=self.bob, channel=self.channel)
+
+    def _scope(self, user, query):
+        self.client.force_login(user)
+        cookie = f'sessionid={self.client.cookies["sessionid"].value}'
+        return {
+            'type': 'websocket',
+            'path': '/ws/chat/',
+            'query_string': query.encode(),
+            'headers': [(b'cookie', cookie.encode()), (b'origin', b'http://testserver')],
+        }
+
+    def test_send_message_is_pushed_to_channel_member(self):
+        scope = self._scope(self.bob, f'channel_id={self.channel.id}')
+
+        async def scenario():
+            communicator = ApplicationCommunicator(websocket_application, scope)
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual((await communicator.receive_output(2))['type'], 'websocket.accept')
+
+            await sync_to_async(self.client.force_login)(self.alice)
+            await sync_to_async(self.client.post)(
+                reverse('send_message'), {'channel_id': self.channel.id, 'content': 'hello'}
+            )
+            event = await communicator.receive_output(2)
+            payload = json.loads(event['text'])
+            self.assertEqual([m['content'] for m in payload['messages']], ['hello'])
+            self.assertFalse(payload['messages'][0]['is_sent'])
+
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(2)
+
+        asyncio.run(scenario())
+
+    def test_bus_hint_pushes_messages_saved_by_another_process(self):
+        scope = self._scope(self.bob, f'channel_id={self.channel.id}')
+        key = conversation_key(channel_id=self.channel.id)
+        version_keys = [versions.conversation_version_key(key), versions.user_version_key(self.bob.id)]
+
+        async def scenario():
+            communicator = ApplicationCommunicator(websocket_application, scope)
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual((await communicator.receive_output(2))['type'], 'websocket.accept')
+
+            message = await Message.objects.acreate(sender=self.alice, channel=self.channel, content='from afar')
+            before = await sync_to_async(versions.versions)(version_keys)
+            remote = json.dumps({'origin': 'elsewhere', 'conversations': {key: message.id}})
+            # The listener thread calls receive, outside the event loop.
+            with mock.patch.object(bus.logger, 'exception') as log_exception:
+                await sync_to_async(bus.NotificationBus().receive, thread_sensitive=False)(remote)
+            log_exception.assert_not_called()
+            after = await sync_to_async(versions.versions)(version_keys)
+            self.assertTrue(all(new > old for old, new in zip(before, after)))
+            payload = json.loads((await communicator.receive_output(2))['text'])
+            self.assertEqual([m['content'] for m in payload['messages']], ['from afar'])
+
+            await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(2)
+
+        asyncio.run(scenario())
+
+    def test_foreign_origin_is_rejected(self):
+        scope = self._scope(self.bob, f'channel_id={self.channel.id}')
+        scope['headers'] = [(b'cookie', dict(scope['headers'])[b'cookie']), (b'origin', b'https://evil.example')]
+
+        async def scenario():
+            communicator = ApplicationCommunicator(websocket_application, scope)
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual(await communicator.receive_output(2), {'type': 'websocket.close', 'code': 4403})
+
+        asyncio.run(scenario())
+
+    def test_non_member_is_rejected(self):
+        outsider = CustomUser.objects.create_user('carol', password='pw')
+        scope = self._scope(outsider, f'channel_id={self.channel.id}')
+
+        async def scenario():
+            communicator = ApplicationCommunicator(websocket_application, scope)
+            await communicator.send_input({'type': 'websocket.connect'})
+            event = await communicator.receive_output(2)
+            self.assertEqual(event, {'type': 'websocket.close', 'code': 4403})
+
+        asyncio.run(scenario())
+
+
+class UnreadCountsTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user('alice')
+        self.client.force_login(self.user)
+
+    def _populate(self, peers):
+        for index in range(peers):
+            peer = CustomUser.objects.create_user(f'peer{index}')
+            Message.objects.create(sender=peer, recipient=self.user, content='hi')
+            channel = Channel.objects.create(name=f'c{index}', created_by=peer)
+            ChannelMembership.objects.create(user=self.user, channel=channel)
+            Message.objects.create(sender=peer, channel=channel, content='hi')
+        CustomUser.objects.create_user('stranger')
+
+    def test_counts_only_conversation_peers(self):
+        self._populate(2)
+        data = self.client.get(reverse('get_unread_counts')).json()
+        self.assertEqual(len(data['users']), 2)
+        self.assertEqual({u['unread_count'] for u in data['users']}, {1})
+        self.assertEqual({c['unread_count'] for c in data['channels']}, {1})
+
+    def test_query_count_does_not_grow_with_contacts(self):
+        self._populate(2)
+        self.client.get(reverse('get_unread_counts'))  # Caches the session and its user.
+        with self.assertNumQueries(1) as small:
+            self.client.get(reverse('get_unread_counts'))
+        for index in range(2, 10):
+            peer = CustomUser.objects.create_user(f'more{index}')
+            Message.objects.create(sender=peer, recipient=self.user, content='hi')
+        with self.assertNumQueries(len(small.captured_queries)):
+            self.client.get(reverse('get_unread_counts'))
+
+
+    def test_new_members_start_caught_up(self):
+        peer = CustomUser.objects.create_user('peer')
+        channel = Channel.objects.create(name='history', created_by=peer)
+        for _ in range(3):
+            Message.objects.create(sender=peer, channel=channel, content='old')
+        ChannelMembership.objects.create(user=self.user, channel=channel)
+        self.assertEqual(channel.unread_messages_count(self.user), 0)
+        self.assertEqual(unread_counts(self.user)['channels'].get(channel.id, 0), 0)
+        rebuild()
+        self.assertEqual(InboxEntry.objects.get(user=self.user, channel=channel).unread_count, 0)
+        Message.objects.create(sender=peer, channel=channel, content='new')
+        self.assertEqual(channel.unread_messages_count(self.user), 1)
+
+
+class ConversationKeyTests(TestCase):
+    def test_private_key_is_symmetric(self):
+        self.assertEqual(conversation_key(user_ids=(7, 3)), conversation_key(user_ids=(3, 7)))
+        self.assertEqual(conversation_key(user_ids=('10', 9)), 'private:9:10')
+        self.assertEqual(conversation_key(channel_id=4), 'channel:4')
+
+    def test_migration_backfills_existing_private_messages(self):
+        backfill = import_module('chat.migrations.0003_message_conversation_indexes').backfill_conversation
+        alice = CustomUser.objects.create_user('alice')
+        bob = CustomUser.objects.create_user('bob')
+        channel = Channel.objects.create(name='general', created_by=alice)
+        Message.objects.create(sender=bob, recipient=alice, content='one')
+        Message.objects.create(sender=alice, recipient=bob, content='two')
+        Message.objects.create(sender=alice, channel=channel, content='three')
+        Message.objects.update(conversation=None)
+
+        backfill(django_apps, None)
+        low, high = sorted((alice.id, bob.id))
+        self.assertEqual(
+            list(Message.objects.order_by('id').values_list('conversation', flat=True)),
+            [f'private:{low}:{high}', f'private:{low}:{high}', None],
+        )
+
+
+class ReadCursorTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.carol = CustomUser.objects.create_user('carol')
+        self.channel = Channel.objects.create(name='general', created_by=self.alice)
+        for user in (self.alice, self.bob, self.carol):
+            ChannelMembership.objects.create(user=user, channel=self.channel)
+
+    def test_reading_a_channel_only_advances_the_readers_cursor(self):
+        Message.objects.create(sender=self.alice, channel=self.channel, content='hi')
+        self.client.force_login(self.bob)
+        self.client.get(reverse('channel_chat', args=[self.channel.id]))
+        self.assertEqual(self.channel.unread_messages_count(self.bob), 0)
+        self.assertEqual(self.channel.unread_messages_count(self.carol), 1)
+
+    def test_idle_poll_does_not_write(self):
+        Message.objects.create(sender=self.alice, recipient=self.bob, content='hi')
+        self.client.force_login(self.bob)
+        url = reverse('get_messages')
+        first = self.client.get(url, {'recipient_id': self.alice.id}).json()['messages']
+        self.assertEqual(self.alice.unread_messages_count(self.bob), 0)
+        # The peer lookup; session, user and the delta itself come from caches.
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'recipient_id': self.alice.id, 'last_message_id': first[-1]['id']})
+        self.assertEqual(response.json()['messages'], [])
+
+
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.ids = [
+            Message.objects.create(sender=self.alice, recipient=self.bob, content=str(index)).id
+            for index in range(7)
+        ]
+        self.client.force_login(self.bob)
+
+    def test_chat_page_renders_only_newest_page(self):
+        with mock.patch('chat.pagination.PAGE_SIZE', 3):
+            response = self.client.get(reverse('private_chat', args=[self.alice.id]))
+        self.assertEqual([m['id'] for m in response.context['messages']], self.ids[-3:])
+        self.assertTrue(response.context['has_more'])
+
+    def test_history_walks_backwards_by_before_id(self):
+        url = reverse('get_history')
+        page = self.client.get(url, {'recipient_id': self.alice.id, 'before_id': self.ids[-3], 'limit': 3}).json()
+        self.assertEqual([m['id'] for m in page['messages']], self.ids[1:4])
+        self.assertTrue(page['has_more'])
+        page = self.client.get(url, {'recipient_id': self.alice.id, 'before_id': self.ids[1], 'limit': 3}).json()
+        self.assertEqual([m['id'] for m in page['messages']], self.ids[:1])
+        self.assertFalse(page['has_more'])
+
+
+@override_settings(CHAT_MESSAGE_CACHE_BACKEND=None)
+class MessageSerializationTests(TestCase):
+    def setUp(self):
+        self.viewer = CustomUser.objects.create_user('viewer')
+        self.channel = Channel.objects.create(name='general', created_by=self.viewer)
+        ChannelMembership.objects.create(user=self.viewer, channel=self.channel)
+        self.client.force_login(self.viewer)
+
+    def _post_from_new_senders(self, count):
+        for index in range(count):
+            sender = CustomUser.objects.create_user(f'sender{CustomUser.objects.count()}', first_name='S')
+            Message.objects.create(sender=sender, channel=self.channel, content=str(index), file='messages/a.PNG')
+
+    def _poll(self):
+        return self.client.get(reverse('get_messages'), {'channel_id': self.channel.id}).json()['messages']
+
+    def test_query_count_is_independent_of_batch_size(self):
+        self._post_from_new_senders(2)
+        self.client.get(reverse('get_unread_counts'))  # Caches the session and its user.
+        with self.assertNumQueries(5) as small:
+            self._poll()
+        self._post_from_new_senders(20)
+        with self.assertNumQueries(len(small.captured_queries)):
+            messages = self._poll()
+        self.assertEqual(len(messages), 22)
+
+    def test_payload_uses_precomputed_file_type(self):
+        self._post_from_new_senders(1)
+        message = self._poll()[0]
+        self.assertEqual(message['file_type'], 'image')
+        self.assertEqual(message['sender'], 'S')
+        self.assertFalse(message['is_sent'])
+
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        caches['fragments'].clear()
+        self.alice = CustomUser.objects.create_user('alice', first_name='Alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.message = Message.objects.create(sender=self.alice, recipient=self.bob, content='<b>hi</b>')
+        self.client.force_login(self.bob)
+
+    def _poll(self):
+        return self.client.get(reverse('get_messages'), {'recipient_id': self.alice.id}).json()['messages'][0]
+
+    def test_page_and_poll_share_one_rendering(self):
+        with mock.patch('chat.fragments.render', wraps=fragments.render) as render:
+            response = self.client.get(reverse('private_chat', args=[self.alice.id]))
+            payload = self._poll()
+        self.assertEqual(render.call_count, 1)
+        self.assertIn('&lt;b&gt;hi&lt;/b&gt;', payload['html'])
+        self.assertContains(response, f'<div class="message received" data-message-id="{self.message.id}">{payload["html"]}</div>', html=True)
+
+    def test_edits_and_profile_changes_render_again(self):
+        self._poll()
+        self.message.content = 'edited'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.message.save()
+        self.assertIn('edited', self._poll()['html'])
+        self.alice.first_name = 'Alicia'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.save()
+        self.assertIn('Alicia', self._poll()['html'])
+
+
+class ConditionalPollTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        caches['default'].clear()
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.client.force_login(self.bob)
+
+    def _send(self, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(sender=self.alice, recipient=self.bob, content=content)
+
+    def _get(self, name, etag=None, **params):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get(reverse(name), params, headers=headers)
+
+    def test_unchanged_unread_counts_are_a_304_without_user_queries(self):
+        etag = self._get('get_unread_counts')['ETag']
+        with self.assertNumQueries(0):
+            response = self._get('get_unread_counts', etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+        self._send('hi')
+        response = self._get('get_unread_counts', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['users'], [{'id': self.alice.id, 'unread_count': 1}])
+
+    def test_messages_etag_follows_sends_and_reads(self):
+        self._send('hi')
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self._get('get_messages', recipient_id=self.alice.id)
+        self.assertEqual(len(first.json()['messages']), 1)
+        # Bob's poll marked the message read, which is a change of its own.
+        newest = first.json()['messages'][-1]['id']
+        etag = self._get('get_messages', first['ETag'], recipient_id=self.alice.id, last_message_id=newest)['ETag']
+        self.assertNotEqual(etag, first['ETag'])
+        response = self._get('get_messages', etag, recipient_id=self.alice.id, last_message_id=newest)
+        self.assertEqual(response.status_code, 304)
+        self._send('again')
+        response = self._get('get_messages', etag, recipient_id=self.alice.id, last_message_id=newest)
+        self.assertEqual([m['content'] for m in response.json()['messages']], ['again'])
+
+    @override_settings(CHAT_CONDITIONAL_POLLING=None)
+    def test_per_process_version_cache_disables_304s(self):
+        # Another worker's LocMem cache would never see this process's bumps.
+        response = self._get('get_unread_counts')
+        self.assertNotIn('ETag', response)
+        response = self._get('get_unread_counts', '"u%d.1"' % self.bob.id)
+        self.assertEqual(response.status_code, 200)
+
+
+class FastPathTests(TestCase):
+    def setUp(self):
+        fastpath.clear()
+        self.bob = CustomUser.objects.create_user('bob', password='secret')
+        self.client.force_login(self.bob)
+
+    def test_polls_skip_the_middleware_stack(self):
+        response = self.client.get(reverse('get_unread_counts'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Frame-Options', response)
+        self.assertIn('X-Frame-Options', self.client.get(reverse('home')))
+
+    def test_saved_users_are_checked_again(self):
+        self.assertEqual(self.client.get(reverse('get_unread_counts')).status_code, 200)
+        self.bob.set_password('changed')
+        self.bob.save()
+        # The session hash no longer matches, so the regular path logs the session out.
+        self.assertEqual(self.client.get(reverse('get_unread_counts')).status_code, 302)
+        self.client.force_login(self.bob)
+        self.bob.is_active = False
+        self.bob.save()
+        self.assertEqual(self.client.get(reverse('get_unread_counts')).status_code, 302)
+
+    def test_sessions_are_cached_until_logout(self):
+        self.client.get(reverse('get_unread_counts'))
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.get(reverse('get_unread_counts')).status_code, 200)
+        self.assertFalse([query for query in captured if 'django_session' in query['sql']])
+        session_key = self.client.cookies['sessionid'].value
+        self.client.get(reverse('logout'))
+        # The logged-out session must not outlive the logout in this process.
+        self.client.cookies['sessionid'] = session_key
+        self.assertEqual(self.client.get(reverse('get_unread_counts')).status_code, 302)
+
+    def test_unknown_hosts_are_rejected(self):
+        response = self.client.get(reverse('get_unread_counts'), headers={'Host': 'evil.example'})
+        self.assertEqual(response.status_code, 400)
+
+class InboxTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.channel = Channel.objects.create(name='general', created_by=self.alice)
+        ChannelMembership.objects.create(user=self.alice, channel=self.channel)
+        ChannelMembership.objects.create(user=self.bob, channel=self.channel)
+
+    def _snapshot(self):
+        return sorted(InboxEntry.objects.values_list(
+            'user', 'peer', 'channel', 'last_message_id', 'preview', 'unread_count'
+        ), key=str)
+
+    def test_entries_follow_sends_and_reads(self):
+        Message.objects.create(sender=self.alice, recipient=self.bob, content='hi bob')
+        last = Message.objects.create(sender=self.alice, channel=self.channel, content='hi all')
+        bob_private = InboxEntry.objects.get(user=self.bob, peer=self.alice)
+        self.assertEqual((bob_private.preview, bob_private.unread_count), ('hi bob', 1))
+        self.assertEqual(InboxEntry.objects.get(user=self.bob, channel=self.channel).unread_count, 1)
+        self.assertEqual(InboxEntry.objects.get(user=self.alice, channel=self.channel).last_message_id, last.id)
+
+        self.client.force_login(self.bob)
+        self.client.get(reverse('channel_chat', args=[self.channel.id]))
+        self.assertEqual(InboxEntry.objects.get(user=self.bob, channel=self.channel).unread_count, 0)
+
+    def test_rebuild_matches_incremental_state(self):
+        Message.objects.create(sender=self.alice, recipient=self.bob, content='one')
+        Message.objects.create(sender=self.bob, recipient=self.alice, content='two')
+        Message.objects.create(sender=self.bob, channel=self.channel, content='three')
+        incremental = self._snapshot()
+        rebuild()
+        self.assertEqual(self._snapshot(), incremental)
+
+    def test_deletes_recompute_the_affected_entries(self):
+        kept = Message.objects.create(sender=self.alice, recipient=self.bob, content='kept')
+        latest = Message.objects.create(sender=self.alice, recipient=self.bob, content='deleted')
+        Message.objects.create(sender=self.bob, channel=self.channel, content='first')
+        channel_latest = Message.objects.create(sender=self.alice, channel=self.channel, content='second')
+        with self.captureOnCommitCallbacks(execute=True):
+            latest.delete()
+            channel_latest.delete()
+        bob_private = InboxEntry.objects.get(user=self.bob, peer=self.alice)
+        self.assertEqual((bob_private.last_message_id, bob_private.preview, bob_private.unread_count), (kept.id, 'kept', 1))
+        bob_channel = InboxEntry.objects.get(user=self.bob, channel=self.channel)
+        self.assertEqual((bob_channel.preview, bob_channel.unread_count), ('first', 0))
+        self.assertEqual(InboxEntry.objects.get(user=self.alice, channel=self.channel).unread_count, 1)
+        incremental = self._snapshot()
+        rebuild()
+        self.assertEqual(self._snapshot(), incremental)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(recipient=self.bob).delete()
+        self.assertFalse(InboxEntry.objects.filter(peer__isnull=False).exists())
+
+    def test_home_lists_conversations_in_one_query(self):
+        Message.objects.create(sender=self.bob, recipient=self.alice, content='hey')
+        self.client.force_login(self.alice)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('home'))
+        self.assertEqual([user.id for user in response.context['users']], [self.bob.id])
+        self.assertEqual(response.context['users'][0].unread_count, 1)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.carol = CustomUser.objects.create_user('carol')
+        self.channel = Channel.objects.create(name='general', created_by=self.alice)
+        ChannelMembership.objects.create(user=self.alice, channel=self.channel)
+        self.client.force_login(self.alice)
+
+    def _search(self, query):
+        return self.client.get(reverse('search_messages'), {'q': query}).json()['results']
+
+    def test_results_are_scoped_highlighted_and_follow_edits(self):
+        mine = Message.objects.create(sender=self.bob, recipient=self.alice, content='lunch at <noon>?')
+        Message.objects.create(sender=self.bob, recipient=self.carol, content='lunch tomorrow')
+        Message.objects.create(sender=self.carol, channel=self.channel, content='team lunch')
+
+        results = self._search('lunch')
+        self.assertEqual(len(results), 2)
+        private = next(r for r in results if r['message_id'] == mine.id)
+        self.assertIn('<mark>lunch</mark>', private['snippet'])
+        self.assertIn('&lt;noon&gt;', private['snippet'])
+        self.assertEqual(private['user_id'], self.bob.id)
+
+        mine.content = 'dinner instead'
+        mine.save()
+        self.assertEqual(len(self._search('lunch')), 1)
+        self.assertEqual(len(self._search('dinn')), 1)
+        mine.delete()
+        self.assertEqual(self._search('dinner'), [])
+
+    def test_fts_syntax_in_query_is_treated_as_text(self):
+        Message.objects.create(sender=self.bob, recipient=self.alice, content='AND OR NOT')
+        self.assertEqual(len(self._search('"AND OR')), 1)
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        override = self.settings(MEDIA_ROOT=self.media, CHAT_UPLOAD_TEMP_DIR=f'{self.media}/tmp')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = CustomUser.objects.create_user('alice')
+        self.channel = Channel.objects.create(name='general', created_by=self.alice, max_file_size=1)
+        ChannelMembership.objects.create(user=self.alice, channel=self.channel, can_send_messages=True)
+        self.client.force_login(self.alice)
+
+    def _start(self, size):
+        return self.client.post(reverse('upload_start'), {
+            'channel_id': self.channel.id, 'filename': 'clip.mp4', 'size': size, 'content': 'look',
+        })
+
+    def _put(self, upload_id, offset, data):
+        return self.client.put(
+            reverse('upload_chunk', args=[upload_id]), data, content_type='application/octet-stream',
+            headers={'Content-Range': f'bytes {offset}-{offset + len(data) - 1}/*'},
+        )
+
+    def test_declared_size_over_channel_limit_is_rejected_up_front(self):
+        response = self._start(2 * 1024 * 1024)
+        self.assertEqual(response.status_code, 413)
+
+    def test_resumed_upload_becomes_a_message(self):
+        upload_id = self._start(10).json()['upload_id']
+        self.assertEqual(self._put(upload_id, 0, b'01234').json(), {'offset': 5, 'complete': False})
+        # A retried chunk at a stale offset is refused with the offset to resume from.
+        self.assertEqual(self._put(upload_id, 0, b'01234').json()['offset'], 5)
+        self.assertEqual(self.client.get(reverse('upload_chunk', args=[upload_id])).json()['offset'], 5)
+        done = self._put(upload_id, 5, b'56789').json()
+        self.assertTrue(done['complete'])
+        message = Message.objects.get(id=done['message_id'])
+        self.assertEqual((message.content, message.file_type), ('look', 'video'))
+        with message.file.open('rb') as attached:
+            self.assertEqual(attached.read(), b'0123456789')
+
+    def test_form_post_over_limit_is_refused_from_content_length(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.alice)
+        # Refused before the CSRF check gets to parse the body.
+        with mock.patch('django.http.HttpRequest._load_post_and_files') as parse:
+            response = client.post(
+                reverse('send_message') + f'?channel_id={self.channel.id}',
+                {'channel_id': self.channel.id, 'content': 'x' * (2 * 1024 * 1024)},
+            )
+        self.assertEqual(response.status_code, 302)
+        parse.assert_not_called()
+        self.assertFalse(Message.objects.exists())
+
+
+class AttachmentServingTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        override = self.settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.message = Message(sender=self.alice, recipient=self.bob)
+        self.message.file.save('clip.mp3', ContentFile(b'0123456789'), save=False)
+        self.message.save()
+        self.url = reverse('message_attachment', args=[self.message.id])
+        self.client.force_login(self.bob)
+
+    def test_range_request_returns_partial_content(self):
+        response = self.client.get(self.url, headers={'Range': 'bytes=2-5'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+        self.assertEqual(self.client.get(self.url, headers={'Range': 'bytes=20-'}).status_code, 416)
+
+    def test_revalidation_is_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, headers={'If-None-Match': etag}).status_code, 304)
+
+    def test_non_participants_get_404(self):
+        self.client.force_login(CustomUser.objects.create_user('carol'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    @override_settings(DEBUG=True)
+    def test_attachments_are_not_served_from_media_url(self):
+        patterns = media.public_media_urls()
+        self.assertTrue(any(pattern.resolve('media/profiles/default.jpg') for pattern in patterns))
+        for name in (self.message.file.name, 'messages/thumbs/clip_480.webp'):
+            self.assertFalse(any(pattern.resolve(f'media/{name}') for pattern in patterns))
+
+    @mock.patch('chat.media.SENDFILE_MODE', 'x-accel-redirect')
+    def test_accel_redirect_hands_off_to_the_proxy(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.message.file.name)
+        self.assertEqual(response.content, b'')
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        override = self.settings(MEDIA_ROOT=self.media, CHAT_THUMBNAIL_WORKERS=0)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.client.force_login(self.bob)
+
+    def _png(self, size):
+        output = io.BytesIO()
+        Image.new('RGB', size, 'red').save(output, 'PNG')
+        return ContentFile(output.getvalue())
+
+    def test_image_message_gets_a_thumbnail_after_commit(self):
+        message = Message(sender=self.alice, recipient=self.bob)
+        message.file.save('photo.png', self._png((1600, 1200)), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            message.save()
+        message.refresh_from_db()
+        self.assertEqual(message.thumbnail, thumbnail_name(message.file.name, 'message', message.pk))
+
+        payload = self.client.get(reverse('get_messages'), {'recipient_id': self.alice.id}).json()['messages'][0]
+        self.assertEqual(payload['file_url'], reverse('message_attachment', args=[message.id]))
+        response = self.client.get(payload['thumbnail_url'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as thumb:
+            self.assertEqual(thumb.size, (480, 360))
+
+    def test_messages_never_share_a_thumbnail(self):
+        carol = CustomUser.objects.create_user('carol')
+        first = Message(sender=self.alice, recipient=self.bob)
+        first.file.save('photo.png', self._png((1600, 1200)), save=False)
+        second = Message(sender=carol, recipient=self.alice)
+        second.file.save('photo.jpg', self._png((1200, 1600)), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.save()
+            second.save()
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertNotEqual(first.thumbnail, second.thumbnail)
+
+        # A file under the name that the row does not record is rendered again, not served.
+        name = first.thumbnail
+        default_storage.delete(name)
+        default_storage.save(name, ContentFile(b'somebody else'))
+        Message.objects.filter(pk=first.pk).update(thumbnail=None)
+        self.assertEqual(build_thumbnail('message', first.pk), name)
+        with default_storage.open(name, 'rb') as handle, Image.open(handle) as thumb:
+            self.assertEqual(thumb.size, (480, 360))
+
+    def test_replaced_profile_image_falls_back_until_rebuilt(self):
+        self.alice.profile_image.save('me.png', self._png((300, 300)), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.save()
+        self.alice.refresh_from_db()
+        self.assertIn('/thumbs/', self.alice.get_profile_thumbnail())
+
+        self.alice.profile_image.save('me-again.png', self._png((300, 300)), save=False)
+        with self.captureOnCommitCallbacks(execute=False):
+            self.alice.save()
+        self.assertEqual(self.alice.get_profile_thumbnail(), self.alice.profile_image.url)
+        self.assertEqual(pending('profile'), [self.alice.pk])
+
+
+class LongPollTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.key = conversation_key(user_ids=(self.alice.id, self.bob.id))
+
+    def _send(self, content):
+        # Runs the commit hooks (message cache write-through) the view would.
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.create(sender=self.alice, recipient=self.bob, content=content)
+
+    async def _client(self, user):
+        client = AsyncClient()
+        await client.aforce_login(user)
+        return client
+
+    async def test_times_out_with_no_messages(self):
+        client = await self._client(self.bob)
+        response = await client.get(reverse('wait_messages'), {'recipient_id': self.alice.id, 'timeout': 0.05})
+        self.assertEqual(response.json(), {'messages': [], 'has_more': False})
+        self.assertEqual(hub.subscriber_count(self.key), 0)
+
+    async def test_timeout_must_be_finite_and_is_clamped(self):
+        client = await self._client(self.bob)
+        url = reverse('wait_messages')
+        for bad in ('nan', 'inf'):
+            response = await client.get(url, {'recipient_id': self.alice.id, 'timeout': bad})
+            self.assertEqual(response.status_code, 400)
+        response = await client.get(url, {'recipient_id': self.alice.id, 'timeout': -5})
+        self.assertEqual(response.json(), {'messages': [], 'has_more': False})
+
+    async def test_waiters_share_one_wakeup_and_one_query(self):
+        alice, bob = await self._client(self.alice), await self._client(self.bob)
+        url = reverse('wait_messages')
+        with mock.patch('chat.longpoll.fetch_rows', wraps=longpoll.fetch_rows) as fetch_rows:
+            waits = [
+                asyncio.ensure_future(alice.get(url, {'recipient_id': self.bob.id})),
+                asyncio.ensure_future(bob.get(url, {'recipient_id': self.alice.id})),
+            ]
+            while fetch_rows.call_count < 2:
+                await asyncio.sleep(0.01)
+            self.assertEqual(hub.subscriber_count(self.key), 1)
+
+            message = await sync_to_async(self._send)('hi')
+            hub.publish(self.key, {'id': message.id})
+            responses = await asyncio.wait_for(asyncio.gather(*waits), 5)
+        self.assertEqual(fetch_rows.call_count, 3)
+        for response in responses:
+            self.assertEqual([m['content'] for m in response.json()['messages']], ['hi'])
+        self.assertTrue(responses[0].json()['messages'][0]['is_sent'])
+
+
+class MessageCacheTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.key = conversation_key(user_ids=(self.alice.id, self.bob.id))
+        self.client.force_login(self.bob)
+
+    def _send(self, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.create(sender=self.alice, recipient=self.bob, content=content)
+
+    def _poll(self, last_message_id=0):
+        response = self.client.get(reverse('get_messages'), {'recipient_id': self.alice.id, 'last_message_id': last_message_id})
+        return [message['content'] for message in response.json()['messages']]
+
+    def test_deltas_are_written_through_and_edits_invalidate(self):
+        before = message_cache.get_cache().stats()
+        first = self._send('one')
+        self.assertEqual(self._poll(), ['one'])
+        second = self._send('two')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._poll(first.id), ['two'])
+        self.assertFalse([q for q in queries if 'FROM "chat_message"' in q['sql']])
+
+        second.content = 'edited'
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        self.assertEqual(self._poll(first.id), ['edited'])
+        after = message_cache.get_cache().stats()
+        self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']), (1, 2))
+
+    def test_lru_evicts_least_recently_used_conversation(self):
+        cache = message_cache.LocMemMessageCache(size=2, max_conversations=2)
+        rows = {key: [{'id': 1}] for key in 'abc'}
+        for key in 'abc':
+            cache.rows_since(key, 0, lambda count, key=key: rows[key])
+            if key == 'b':
+                cache.rows_since('a', 0, None)
+        self.assertEqual(list(cache._entries), ['a', 'c'])
+        cache.record('a', {'id': 2})
+        cache.record('a', {'id': 3})
+        self.assertIsNone(cache.rows_since('a', 0, None))
+        self.assertEqual(cache.rows_since('a', 1, None), [{'id': 2}, {'id': 3}])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_django_adapter_drops_fills_that_raced_a_write(self):
+        cache = message_cache.DjangoMessageCache(size=10)
+        cache.rows_since('k', 0, lambda count: [{'id': 1}])
+        cache.record('k', {'id': 2})
+        self.assertEqual(cache.rows_since('k', 0, None), [{'id': 1}, {'id': 2}])
+
+        def racing_loader(count):
+            cache.record('k', {'id': 4})
+            return [{'id': 1}, {'id': 2}]
+        cache.invalidate('k')
+        self.assertEqual(cache.rows_since('k', 0, racing_loader), [{'id': 1}, {'id': 2}])
+        self.assertIsNone(cache._get('k'))
+
+
+    def test_default_backend_needs_a_shared_cache(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertIsNone(message_cache.default_backend())
+        shared = {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache', 'LOCATION': '127.0.0.1:11211'}
+        with override_settings(CACHES={'default': shared}):
+            self.assertEqual(message_cache.default_backend(), 'chat.message_cache.DjangoMessageCache')
+
+
+class BroadcastTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_user('admin', is_staff=True)
+        self.channel = Channel.objects.create(name='news', created_by=self.admin, is_broadcast=True)
+        ChannelMembership.objects.create(user=self.admin, channel=self.channel, can_send_messages=True)
+        # Members added in bulk skip the signals and so start without inbox entries.
+        self.members = CustomUser.objects.bulk_create([CustomUser(username=f'member{i}') for i in range(5)])
+        ChannelMembership.objects.bulk_create([ChannelMembership(user=user, channel=self.channel) for user in self.members])
+
+    def _unread(self):
+        return dict(InboxEntry.objects.filter(channel=self.channel).values_list('user__username', 'unread_count'))
+
+    @mock.patch('chat.inbox.BROADCAST_BATCH_SIZE', 2)
+    def test_post_is_fanned_out_to_every_member_in_batches(self):
+        Message.objects.create(sender=self.admin, channel=self.channel, content='hello')
+        expected = {user.username: 1 for user in self.members}
+        self.assertEqual(self._unread(), dict(expected, admin=0))
+
+    def test_bulk_post_writes_each_conversation_once(self):
+        self.client.force_login(self.admin)
+        peer = self.members[0]
+        payload = {'messages': [{'channel_id': self.channel.id, 'content': f'update {i}'} for i in range(3)]}
+        payload['messages'] += [{'recipient_id': peer.id, 'content': 'psst'}] * 2
+        with self.assertNumQueries(23):
+            response = self.client.post(reverse('bulk_post_messages'), payload, content_type='application/json')
+        self.assertEqual(len(response.json()['ids']), 5)
+        self.assertEqual(self._unread()[peer.username], 3)
+        self.assertEqual(peer.unread_messages_count(self.admin), 0)
+        self.assertEqual(InboxEntry.objects.get(user=peer, peer=self.admin).unread_count, 2)
+        self.assertEqual(Message.objects.filter(conversation__isnull=False).count(), 2)
+
+    def test_broadcasts_report_no_read_receipts(self):
+        Message.objects.create(sender=self.admin, channel=self.channel, content='hello')
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('get_messages'), {'channel_id': self.channel.id})
+        self.assertEqual([message['read'] for message in response.json()['messages']], [None])
+
+    def test_only_staff_may_bulk_post(self):
+        self.client.force_login(self.members[0])
+        response = self.client.post(reverse('bulk_post_messages'), {'messages': []}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class MembershipBulkTests(TestCase):
+    def setUp(self):
+        self.owner = CustomUser.objects.create_user('owner')
+        self.channel = Channel.objects.create(name='team', created_by=self.owner)
+        ChannelMembership.objects.create(user=self.owner, channel=self.channel, can_send_messages=True)
+        self.users = CustomUser.objects.bulk_create([CustomUser(username=f'user{i:02}') for i in range(30)])
+        self.url = reverse('channel_members', args=[self.channel.id])
+        self.client.force_login(self.owner)
+
+    def _members(self):
+        return set(self.channel.members.values_list('username', flat=True))
+
+    def test_add_from_ids_and_csv_then_change_permissions_and_remove(self):
+        response = self.client.post(self.url, {
+            'action': 'add', 'user_ids': [self.users[0].id, self.users[1].id], 'csv': 'user02,user03\nuser01',
+        })
+        self.assertEqual(response.json(), {'action': 'add', 'requested': 4, 'changed': 4})
+        self.assertEqual(self._members(), {'owner', 'user00', 'user01', 'user02', 'user03'})
+        self.assertEqual(InboxEntry.objects.filter(channel=self.channel).count(), 5)
+
+        response = self.client.post(self.url, {'action': 'allow', 'csv': 'user02,user03'})
+        self.assertEqual(response.json()['changed'], 2)
+        self.assertEqual(self.channel.channelmembership_set.filter(can_send_messages=True).count(), 3)
+
+        response = self.client.post(
+            self.url, {'action': 'remove', 'user_ids': [self.users[0].id]}, content_type='application/json',
+        )
+        self.assertEqual(response.json()['changed'], 1)
+        self.assertFalse(InboxEntry.objects.filter(channel=self.channel, user=self.users[0]).exists())
+
+    def test_added_members_start_caught_up(self):
+        Message.objects.create(sender=self.owner, channel=self.channel, content='before')
+        self.client.post(self.url, {'action': 'add', 'user_ids': [self.users[0].id]})
+        self.assertEqual(self.channel.unread_messages_count(self.users[0]), 0)
+        rebuild()
+        self.assertEqual(InboxEntry.objects.get(user=self.users[0], channel=self.channel).unread_count, 0)
+
+    def test_unknown_users_reject_the_whole_batch(self):
+        response = self.client.post(self.url, {'action': 'add', 'csv': 'user00,nobody'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._members(), {'owner'})
+
+    def test_only_the_owner_manages_members(self):
+        self.client.force_login(self.users[0])
+        self.assertEqual(self.client.post(self.url, {'action': 'add', 'csv': 'user01'}).status_code, 403)
+
+    def test_typeahead_pages_through_non_members(self):
+        ChannelMembership.objects.create(user=self.users[10], channel=self.channel)
+        url = reverse('user_search')
+        page = self.client.get(url, {'q': 'user1', 'channel_id': self.channel.id, 'limit': 5}).json()
+        self.assertEqual([user['username'] for user in page['users']], ['user11', 'user12', 'user13', 'user14', 'user15'])
+        page = self.client.get(url, {'q': 'user1', 'channel_id': self.channel.id, 'limit': 5, 'after': page['next']}).json()
+        self.assertEqual([user['username'] for user in page['users']], ['user16', 'user17', 'user18', 'user19'])
+        self.assertIsNone(page['next'])
+
+    def test_typeahead_ignores_case(self):
+        CustomUser.objects.bulk_create([CustomUser(username='User100'), CustomUser(username='USER101')])
+        url = reverse('user_search')
+        page = self.client.get(url, {'q': 'User10', 'limit': 2}).json()
+        self.assertEqual([user['username'] for user in page['users']], ['user10', 'User100'])
+        page = self.client.get(url, {'q': 'User10', 'limit': 2, 'after': page['next']}).json()
+        self.assertEqual([user['username'] for user in page['users']], ['USER101'])
+
+
+@override_settings(CHAT_INSTRUMENTATION_SAMPLE_RATE=1.0, CHAT_METRICS_TOKEN='secret')
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        instrumentation.reset()
+        self.alice = CustomUser.objects.create_user('alice')
+        self.staff = CustomUser.objects.create_user('staff', is_staff=True)
+        self.client.force_login(self.alice)
+
+    def test_requests_are_timed_and_sampled_per_view(self):
+        self.client.get(reverse('get_unread_counts'))
+        self.client.get(reverse('get_unread_counts'))
+        stats = instrumentation.snapshot()[0]['get_unread_counts']
+        self.assertEqual((stats.requests, stats.sampled, sum(stats.buckets)), (2, 2, 2))
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.response_bytes, 0)
+
+    async def test_async_view_queries_are_counted(self):
+        client = AsyncClient()
+        await client.aforce_login(self.alice)
+        await client.get(reverse('wait_messages'), {'recipient_id': self.staff.id, 'timeout': 0})
+        stats = instrumentation.snapshot()[0]['wait_messages']
+        self.assertEqual(stats.sampled, 1)
+        self.assertGreater(stats.queries, 0)
+
+    def test_repeated_statements_are_flagged(self):
+        channels = [Channel.objects.create(name=f'c{i}', created_by=self.alice) for i in range(5)]
+        collector = instrumentation.QueryCollector()
+        with connection.execute_wrapper(collector):
+            for channel in channels:
+                channel.unread_messages_count(self.alice)
+        instrumentation.record('home', 0.01, 200, 10, collector)
+        (view, sql), (flagged, most) = next(iter(instrumentation.snapshot()[1].items()))
+        self.assertEqual((view, flagged, most), ('home', 1, 5))
+        self.assertIn('chat_repeated_query_requests_total{view="home"} 1', instrumentation.prometheus_text())
+
+    def test_finished_threads_are_folded_into_the_totals(self):
+        for _ in range(20):
+            thread = threading.Thread(target=instrumentation.record, args=('home', 0.01, 200, 10))
+            thread.start()
+            thread.join()
+        self.assertEqual(instrumentation.snapshot()[0]['home'].requests, 20)
+        self.assertLessEqual(len(instrumentation._shards), threading.active_count())
+
+    def test_metrics_and_dashboard_are_staff_only(self):
+        self.client.get(reverse('home'))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('instrumentation')).status_code, 302)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertContains(response, 'chat_request_duration_seconds_count{view="home"} 1')
+
+        self.client.force_login(self.staff)
+        self.assertContains(self.client.get(reverse('instrumentation')), '<td>home</td>')
+
+
+class LoadBenchmarkTests(TransactionTestCase):
+    def test_simulated_clients_run_the_whole_mix(self):
+        user_ids, channel_ids = bench_data.generate(20, 3, 200)
+        results = bench_load.run(user_ids, channel_ids, clients=2, requests=20, seed=1)
+        self.assertEqual(results['total']['count'], 40)
+        self.assertEqual(results['total']['errors'], 0)
+        self.assertEqual(set(results['actions']), set(bench_load.DEFAULT_MIX))
+        self.assertGreater(results['total']['queries'], 0)
+        self.assertGreater(results['total']['throughput'], 0)
+
+
+@override_settings(CHAT_WRITE_QUEUE=True)
+class WriteQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.client.force_login(self.alice)
+        self.addCleanup(writes.stop)
+
+    def _hold_writer(self):
+        """Keep the writer busy so the next jobs queue up behind it."""
+        started, release = threading.Event(), threading.Event()
+        writes.get_queue().submit(lambda: (started.set(), release.wait()))
+        started.wait(5)
+        return release
+
+    def test_waiting_writes_share_one_transaction(self):
+        release = self._hold_writer()
+        messages = [Message(sender=self.alice, recipient=self.bob, content=str(i)) for i in range(3)]
+        for message in messages:
+            writes.get_queue().submit(message.save)
+        release.set()
+        writer = writes.get_queue()
+        writes.stop()
+        self.assertEqual((writer.batches, writer.jobs), (2, 4))
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_failing_write_does_not_fail_its_batch(self):
+        release = self._hold_writer()
+        good = writes.get_queue().submit(Message(sender=self.alice, recipient=self.bob, content='ok').save)
+        bad = writes.get_queue().submit(Message(sender=self.alice, content='no conversation').save)
+        release.set()
+        good.result(5)
+        self.assertIsNotNone(bad.exception(5))
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['ok'])
+
+    def test_read_marks_collapse_and_sends_go_through_the_queue(self):
+        self.client.post(reverse('send_message'), {'recipient_id': self.bob.id, 'content': 'hi'})
+        message = Message.objects.get()
+        self.assertEqual(writes.get_queue().jobs, 1)
+
+        release = self._hold_writer()
+        writes.mark_read(self.bob, message.id - 1, peer_id=self.alice.id)
+        writes.mark_read(self.bob, message.id, peer_id=self.alice.id)
+        release.set()
+        writes.stop()
+        self.assertEqual(PrivateReadCursor.objects.get(user=self.bob).last_read_message_id, message.id)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        override = self.settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+
+    async def test_send_poll_and_open_over_asgi(self):
+        alice, bob = AsyncClient(), AsyncClient()
+        await alice.aforce_login(self.alice)
+        await bob.aforce_login(self.bob)
+
+        upload = ContentFile(b'hello', name='note.txt')
+        response = await alice.post(reverse('send_message'), {'recipient_id': self.bob.id, 'content': 'hi', 'file': upload})
+        self.assertEqual(response.status_code, 302)
+        message = await Message.objects.aget()
+        self.assertEqual((message.content, message.file.read()), ('hi', b'hello'))
+
+        response = await bob.get(reverse('get_unread_counts'))
+        self.assertEqual(response.json()['users'], [{'id': self.alice.id, 'unread_count': 1}])
+        response = await bob.get(reverse('get_messages'), {'recipient_id': self.alice.id})
+        self.assertEqual([m['content'] for m in response.json()['messages']], ['hi'])
+        response = await bob.get(reverse('private_chat', args=[self.alice.id]))
+        self.assertContains(response, 'note.txt')
+        self.assertEqual((await bob.get(reverse('get_unread_counts'))).json()['users'][0]['unread_count'], 0)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        message_cache.clear()
+        archive._read.cache_clear()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        override = self.settings(MEDIA_ROOT=f'{self.root}/media', CHAT_ARCHIVE_ROOT=f'{self.root}/archive')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.client.force_login(self.bob)
+        self.policy = RetentionPolicy.objects.create(archive_after_days=30)
+
+    def _send(self, content, old=False, file=None):
+        message = Message(sender=self.alice, recipient=self.bob, content=content)
+        if file:
+            message.file.save(file, ContentFile(b'data'), save=False)
+        message.save()
+        if old:
+            Message.objects.filter(id=message.id).update(timestamp='2020-01-15T12:00:00Z')
+        return message
+
+    def _history(self, **params):
+        response = self.client.get(reverse('get_history'), {'recipient_id': self.alice.id, **params})
+        data = response.json()
+        return [m['content'] for m in data['messages']], data['has_more']
+
+    def test_history_continues_into_the_archive(self):
+        for i in range(5):
+            self._send(f'old {i}', old=True)
+        newest = [self._send(f'new {i}') for i in range(2)]
+        moved = archive.archive_expired()
+        self.assertEqual(moved[self.policy], 5)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(ArchiveSegment.objects.get().message_count, 5)
+
+        self.assertEqual(self._history(limit=4), (['old 3', 'old 4', 'new 0', 'new 1'], True))
+        oldest_id = Message.objects.order_by('id').first().id - 2
+        self.assertEqual(self._history(before_id=oldest_id, limit=4), (['old 0', 'old 1', 'old 2'], False))
+        response = self.client.get(reverse('private_chat', args=[self.alice.id]))
+        self.assertTrue(response.context['has_more'])
+        self.assertEqual([m['id'] for m in response.context['messages']], [m.id for m in newest])
+
+    def test_archiving_recomputes_the_inbox(self):
+        for i in range(3):
+            self._send(f'old {i}', old=True)
+        self._send('new')
+        self.assertEqual(InboxEntry.objects.get(user=self.bob, peer=self.alice).unread_count, 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            archive.archive_expired()
+        entry = InboxEntry.objects.get(user=self.bob, peer=self.alice)
+        self.assertEqual((entry.preview, entry.unread_count), ('new', 1))
+
+    def test_archived_attachments_are_served_unless_purged(self):
+        kept = self._send('kept', old=True, file='kept.txt')
+        archive.archive_expired()
+        response = self.client.get(reverse('message_attachment', args=[kept.id]))
+        self.assertEqual(b''.join(response.streaming_content), b'data')
+        self.client.force_login(CustomUser.objects.create_user('carol'))
+        self.assertEqual(self.client.get(reverse('message_attachment', args=[kept.id])).status_code, 404)
+
+        self.policy.purge_attachments = True
+        self.policy.save()
+        purged = self._send('purged', old=True, file='purged.txt')
+        name = purged.file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            archive.archive_expired()
+        self.assertFalse(purged.file.storage.exists(name))
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(reverse('message_attachment', args=[purged.id])).status_code, 404)
+
+
+class AdminScalingTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_superuser('root', password='pw')
+        self.alice = CustomUser.objects.create_user('alice')
+        self.bob = CustomUser.objects.create_user('bob')
+        self.ids = [
+            Message.objects.create(sender=self.alice, recipient=self.bob, content=str(index)).id for index in range(7)
+        ]
+        self.client.force_login(self.admin)
+
+    def _changelist(self, **params):
+        with mock.patch.object(chat_admin.MessageAdmin, 'list_per_page', 3):
+            return self.client.get(reverse('admin:chat_message_changelist'), params)
+
+    def test_message_changelist_pages_by_key(self):
+        first = self._changelist()
+        self.assertEqual([m.id for m in first.context['cl'].result_list], self.ids[:-4:-1])
+        older = self._changelist(before=self.ids[-3])
+        cl = older.context['cl']
+        self.assertEqual([m.id for m in cl.result_list], self.ids[-4:-7:-1])
+        self.assertEqual((cl.older_link, cl.newer_link), (f'?before={self.ids[1]}', f'?after={self.ids[3]}'))
+        self.assertEqual([m.id for m in self._changelist(after=self.ids[3]).context['cl'].result_list], self.ids[:-4:-1])
+        self.assertContains(first, str(timezone.now().year))
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self._changelist()
+        with CaptureQueriesContext(connection) as before:
+            self._changelist()
+        Message.objects.bulk_create([Message(sender=self.bob, channel=None, recipient=self.alice, content='x')] * 20)
+        with CaptureQueriesContext(connection) as after:
+            self._changelist()
+        self.assertEqual(len(after), len(before))
+
+    @override_settings(CHAT_JOB_WORKERS=0)
+    def test_bulk_actions_run_as_chunked_jobs(self):
+        channel = Channel.objects.create(name='big', created_by=self.admin)
+        ChannelMembership.objects.bulk_create([ChannelMembership(user=user, channel=channel) for user in (self.alice, self.bob)])
+        with mock.patch('chat.jobs.writes.run', wraps=writes.run) as chunk, self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:chat_channelmembership_changelist'), {
+                'action': 'allow_sending_messages', 'select_across': 1, 'index': 0,
+                '_selected_action': ChannelMembership.objects.values_list('pk', flat=True),
+            })
+        self.assertEqual(ChannelMembership.objects.filter(can_send_messages=True).count(), 2)
+        self.assertEqual(chunk.call_count, 1)
+        with mock.patch('chat.admin.INLINE_MEMBER_LIMIT', 1):
+            response = self.client.get(reverse('admin:chat_channel_change', args=[channel.id]))
+        self.assertEqual(response.context['inline_admin_formsets'], [])
+        self.assertContains(response, 'Manage members (more than 1)')
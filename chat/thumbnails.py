@@ -0,0 +1,171 @@
+"""
+Resized derivatives of message images, profile pictures and channel images.
+
+Thumbnails are rendered by a small thread pool once the uploading transaction
+commits, so requests never wait on Pillow.  Each derivative is stored next to
+its source under ``thumbs/`` with a name derived from the full source name
+and the owning row's primary key, so two rows never share a derivative.  The
+name is recorded on the owning row (``Message.thumbnail``,
+``CustomUser.profile_thumbnail``, ``Channel.channel_thumbnail``).  A recorded
+name only counts while it still matches the current source, so a replaced
+image falls back to the original until its new thumbnail is ready.
+
+Settings: ``CHAT_THUMBNAIL_SIZES`` (longest edge per kind),
+``CHAT_THUMBNAIL_WORKERS`` (0 renders inline) and ``CHAT_THUMBNAIL_QUALITY``.
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.dispatch import Signal
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = {'message': 480, 'profile': 96, 'channel': 128}
+# kind -> (model, source field, thumbnail field)
+FIELDS = {
+    'message': ('chat.Message', 'file', 'thumbnail'),
+    'profile': ('chat.CustomUser', 'profile_image', 'profile_thumbnail'),
+    'channel': ('chat.Channel', 'channel_image', 'channel_thumbnail'),
+}
+FORMAT, EXTENSION = ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+# Sent with ``kind`` and ``instance_id`` once a thumbnail has been recorded on its row.
+thumbnail_ready = Signal()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def thumbnail_size(kind):
+    return {**DEFAULT_SIZES, **getattr(settings, 'CHAT_THUMBNAIL_SIZES', {})}[kind]
+
+
+def thumbnail_name(source, kind, pk):
+    directory, filename = os.path.split(source)
+    stem = os.path.splitext(filename)[0]
+    # The stem alone is shared by photo.png and photo.jpg; the digest covers the full name.
+    digest = hashlib.blake2b(source.encode(), digest_size=4).hexdigest()
+    return f'{directory}/thumbs/{stem}_{digest}_{pk}_{thumbnail_size(kind)}.{EXTENSION}'
+
+
+def current_thumbnail(source, stored, kind, pk):
+    """``stored`` if it is the derivative of ``source`` for row ``pk``, else None."""
+    return stored if source and stored and stored == thumbnail_name(source, kind, pk) else None
+
+
+def render(source, kind, pk, stored=None, storage=default_storage):
+    """Write the derivative of ``source`` for row ``pk``; returns its name or None.
+
+    An existing file is reused only when it is the one ``stored`` on the row;
+    anything else under that name is a leftover of an interrupted build and is
+    rendered again.
+    """
+    name = thumbnail_name(source, kind, pk)
+    if storage.exists(name):
+        if stored == name:
+            return name
+        storage.delete(name)
+    size = thumbnail_size(kind)
+    try:
+        with storage.open(source, 'rb') as handle, Image.open(handle) as image:
+            # Lets the JPEG decoder downscale while decoding instead of after.
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha and FORMAT == 'WEBP' else 'RGB')
+            output = ContentFile(b'')
+            image.save(output, FORMAT, quality=getattr(settings, 'CHAT_THUMBNAIL_QUALITY', 80))
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError) as exc:
+        logger.warning('Cannot render thumbnail for %s: %s', source, exc)
+        return None
+    return storage.save(name, output)
+
+
+def build(kind, pk):
+    """Render and record the thumbnail for one row; safe to call repeatedly."""
+    model_label, source_field, thumbnail_field = FIELDS[kind]
+    model = apps.get_model(model_label)
+    row = model._default_manager.filter(pk=pk).values_list(source_field, thumbnail_field).first()
+    if row is None or not row[0]:
+        return None
+    source, stored = row
+    name = render(source, kind, pk, stored)
+    if name:
+        # Conditional on the source so a newer upload is not given this derivative.
+        if model._default_manager.filter(pk=pk, **{source_field: source}).update(**{thumbnail_field: name}):
+            thumbnail_ready.send(sender=model, kind=kind, instance_id=pk)
+    return name
+
+
+def _run(kind, pk):
+    try:
+        return build(kind, pk) is not None
+    except Exception:
+        logger.exception('Thumbnail job failed for %s %s', kind, pk)
+        return False
+    finally:
+        connections.close_all()
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'CHAT_THUMBNAIL_WORKERS', 2), thread_name_prefix='thumbnails',
+            )
+    return _executor
+
+
+def schedule(kind, pk):
+    """Queue a thumbnail build for after the current transaction commits."""
+    def submit():
+        if getattr(settings, 'CHAT_THUMBNAIL_WORKERS', 2):
+            _pool().submit(_run, kind, pk)
+        else:
+            build(kind, pk)
+    transaction.on_commit(submit)
+
+
+def needs_thumbnail(instance, kind, update_fields=None):
+    _, source_field, thumbnail_field = FIELDS[kind]
+    if update_fields is not None and source_field not in update_fields:
+        return False
+    source = getattr(instance, source_field)
+    # The shared default images are small and cached by every browser already.
+    if not source or source.name == instance._meta.get_field(source_field).default:
+        return False
+    return getattr(instance, thumbnail_field) != thumbnail_name(source.name, kind, instance.pk)
+
+
+def pending(kind):
+    """Primary keys of rows whose thumbnail is missing or stale."""
+    model_label, source_field, thumbnail_field = FIELDS[kind]
+    model = apps.get_model(model_label)
+    default = model._meta.get_field(source_field).default
+    rows = model._default_manager.exclude(**{f'{source_field}__isnull': True})
+    if kind == 'message':
+        rows = rows.filter(file_type='image')
+    return [
+        pk for pk, source, stored in rows.values_list('pk', source_field, thumbnail_field).iterator()
+        if source and source != default and not current_thumbnail(source, stored, kind, pk)
+    ]
+
+
+def backfill(workers=None):
+    """Build every missing thumbnail, ``workers`` at a time; returns how many were built."""
+    jobs = [(kind, pk) for kind in FIELDS for pk in pending(kind)]
+    workers = workers or getattr(settings, 'CHAT_THUMBNAIL_WORKERS', 2) or 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnails') as pool:
+        built = list(pool.map(lambda job: _run(*job), jobs))
+    return sum(built)
@@ -0,0 +1,122 @@
+"""
+Read cursors and aggregated unread-count queries.
+
+Read state is a per-member "last read message id" cursor: unread counts are
+range counts above the cursor, and marking a conversation read is a single-row
+write.  Everything here runs a fixed number of grouped queries per user
+regardless of how many contacts or channels they have.
+"""
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from . import versions
+from .inbox import mark_caught_up
+from .models import Channel, ChannelMembership, CustomUser, InboxEntry, Message, PrivateReadCursor
+
+
+def conversation_peer_ids(user):
+    """Ids of every user ``user`` has exchanged a private message with."""
+    sent_to = Message.objects.filter(sender=user, recipient__isnull=False).values_list('recipient', flat=True)
+    received_from = Message.objects.filter(recipient=user).values_list('sender', flat=True)
+    return set(sent_to.union(received_from)) - {user.id}
+
+
+def private_unread_counts(user, peer_ids=None):
+    """``{peer_id: unread}`` for private messages addressed to ``user``."""
+    cursor = PrivateReadCursor.objects.filter(user=user, peer=OuterRef('sender')).values('last_read_message_id')[:1]
+    queryset = Message.objects.filter(recipient=user)
+    if peer_ids is not None:
+        queryset = queryset.filter(sender_id__in=peer_ids)
+    rows = (
+        queryset.annotate(last_read=Coalesce(Subquery(cursor), Value(0)))
+        .filter(id__gt=F('last_read'))
+        .values('sender')
+        .annotate(unread=Count('id'))
+        .values_list('sender', 'unread')
+    )
+    return dict(rows)
+
+
+def channels_with_unread(user, channels=None):
+    """``channels`` (default: the user's channels) annotated with ``unread_count``."""
+    if channels is None:
+        channels = Channel.objects.filter(members=user)
+    cursor = ChannelMembership.objects.filter(user=user, channel=OuterRef('pk')).values('last_read_message_id')[:1]
+    return channels.annotate(last_read=Subquery(cursor)).annotate(
+        unread_count=Count('message', filter=Q(message__id__gt=F('last_read')) & ~Q(message__sender=user))
+    ).order_by('id')
+
+
+def users_with_unread(user, users=None):
+    """Conversation peers (or the given ``users``) with ``unread_count`` attached."""
+    if users is None:
+        users = CustomUser.objects.filter(id__in=conversation_peer_ids(user))
+    users = list(users)
+    counts = private_unread_counts(user, [peer.id for peer in users])
+    for peer in users:
+        peer.unread_count = counts.get(peer.id, 0)
+    return users
+
+
+def _inbox_counts(user):
+    return InboxEntry.objects.filter(user=user).values_list('peer', 'channel', 'unread_count')
+
+
+def _split_counts(rows):
+    counts = {'users': {}, 'channels': {}}
+    for peer_id, channel_id, unread in rows:
+        if peer_id:
+            counts['users'][peer_id] = unread
+        else:
+            counts['channels'][channel_id] = unread
+    return counts
+
+
+def unread_counts(user):
+    """Per-peer and per-channel unread counts from the user's inbox summaries."""
+    return _split_counts(_inbox_counts(user))
+
+
+async def aunread_counts(user):
+    return _split_counts([row async for row in _inbox_counts(user)])
+
+
+def channel_head(channel_id):
+    """Id of the channel's newest message: where a new member's read cursor starts."""
+    return Message.objects.filter(channel_id=channel_id).aggregate(head=Max('id'))['head'] or 0
+
+
+def mark_read(user, up_to, channel_id=None, peer_id=None):
+    """Advance ``user``'s cursor for the conversation to ``up_to``; never moves it back."""
+    if not up_to:
+        return
+    if channel_id:
+        moved = ChannelMembership.objects.filter(
+            user=user, channel_id=channel_id, last_read_message_id__lt=up_to
+        ).update(last_read_message_id=up_to)
+    else:
+        moved = PrivateReadCursor.objects.filter(
+            user=user, peer_id=peer_id, last_read_message_id__lt=up_to
+        ).update(last_read_message_id=up_to)
+        if not moved:
+            _, moved = PrivateReadCursor.objects.get_or_create(user=user, peer_id=peer_id, defaults={'last_read_message_id': up_to})
+    caught_up = mark_caught_up(user, up_to, channel_id=channel_id, peer_id=peer_id)
+    if moved or caught_up:
+        versions.record_read(user, channel_id=channel_id, peer_id=peer_id)
+
+
+def _others_cursors(user, channel_id=None, peer_id=None):
+    if channel_id:
+        return ChannelMembership.objects.filter(channel_id=channel_id).exclude(user=user)
+    return PrivateReadCursor.objects.filter(user_id=peer_id, peer=user)
+
+
+def others_read_up_to(user, channel_id=None, peer_id=None):
+    """Newest message id some other participant of the conversation has read."""
+    cursors = _others_cursors(user, channel_id, peer_id)
+    return cursors.aggregate(up_to=Max('last_read_message_id'))['up_to'] or 0
+
+
+async def aothers_read_up_to(user, channel_id=None, peer_id=None):
+    cursors = _others_cursors(user, channel_id, peer_id)
+    return (await cursors.aaggregate(up_to=Max('last_read_message_id')))['up_to'] or 0
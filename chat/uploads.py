@@ -0,0 +1,185 @@
+"""
+Chunked, resumable attachment uploads.
+
+A client declares the file size up front, so oversized uploads are refused
+before a single byte is sent.  Chunks are then appended to a temporary file
+by offset (streamed straight from the request, never held in memory), an
+interrupted upload resumes from the offset reported by the status endpoint,
+and the last chunk turns the session into a ``Message`` with the file attached.
+
+Plain form posts to ``send_message`` are checked by
+``UploadSizeLimitMiddleware`` against their declared length instead.
+"""
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.core.files import File
+from django.shortcuts import redirect
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+
+from .models import Channel, ChannelMembership, Message, UploadSession
+
+CHUNK_SIZE = getattr(settings, 'CHAT_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+READ_SIZE = 64 * 1024
+# Private chats have no per-conversation limit; this caps them instead (MB).
+PRIVATE_MAX_FILE_SIZE = getattr(settings, 'CHAT_PRIVATE_MAX_FILE_SIZE', 100)
+# Allowance for the text fields and multipart framing around an attachment.
+FORM_OVERHEAD = 256 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+
+def temp_dir():
+    path = Path(getattr(settings, 'CHAT_UPLOAD_TEMP_DIR', Path(settings.BASE_DIR) / 'uploads_tmp'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def temp_path(session):
+    return temp_dir() / f'{session.id}.part'
+
+
+def max_file_size_bytes(channel=None):
+    return (channel.max_file_size if channel else PRIVATE_MAX_FILE_SIZE) * 1024 * 1024
+
+
+def check_can_send(user, channel):
+    if channel and not (
+        user.is_superuser
+        or ChannelMembership.objects.filter(user=user, channel=channel, can_send_messages=True).exists()
+    ):
+        raise UploadError('You do not have permission to send messages in this channel.', status=403)
+
+
+def check_size(size, channel=None):
+    limit = max_file_size_bytes(channel)
+    if size > limit:
+        raise UploadError(f'File size exceeds the limit of {limit // (1024 * 1024)}MB.', status=413)
+
+
+def start_upload(user, filename, size, channel=None, recipient=None, content=''):
+    if not filename or size <= 0:
+        raise UploadError('A file name and a positive size are required.')
+    if not channel and not recipient:
+        raise UploadError('Invalid chat context.')
+    check_can_send(user, channel)
+    check_size(size, channel)
+    session = UploadSession.objects.create(
+        user=user, channel=channel, recipient=recipient, content=content,
+        filename=os.path.basename(filename)[:255], total_size=size,
+    )
+    temp_path(session).touch()
+    return session
+
+
+def append_chunk(session, offset, stream, length):
+    """Write ``length`` bytes from ``stream`` at ``offset``; returns the new received size."""
+    if offset != session.received:
+        raise UploadError('Chunk does not continue the upload.', status=409, offset=session.received)
+    if length <= 0 or offset + length > session.total_size:
+        raise UploadError('Chunk exceeds the declared file size.', status=413, offset=session.received)
+
+    path = temp_path(session)
+    written = 0
+    with open(path, 'r+b') as part:
+        # Truncate anything a previous, interrupted attempt left past the committed offset.
+        part.truncate(offset)
+        part.seek(offset)
+        while written < length:
+            data = stream.read(min(READ_SIZE, length - written))
+            if not data:
+                break
+            part.write(data)
+            written += len(data)
+    if written != length:
+        raise UploadError('Chunk was shorter than its Content-Length.', offset=session.received)
+
+    session.received = offset + written
+    session.save(update_fields=['received', 'updated_at'])
+    return session.received
+
+
+def finalize(session):
+    """Attach the completed file to a new Message and discard the session."""
+    if session.received != session.total_size:
+        raise UploadError('Upload is not complete.', status=409, offset=session.received)
+    message = Message(
+        sender=session.user, channel=session.channel, recipient=session.recipient,
+        content=session.content or None,
+    )
+    path = temp_path(session)
+    with open(path, 'rb') as part:
+        message.file.save(session.filename, File(part), save=False)
+    message.save()
+    path.unlink(missing_ok=True)
+    session.delete()
+    return message
+
+
+def purge_stale(max_age=timedelta(days=1)):
+    """Delete sessions (and their partial files) that have not progressed for ``max_age``."""
+    stale = list(UploadSession.objects.filter(updated_at__lt=timezone.now() - max_age))
+    for session in stale:
+        temp_path(session).unlink(missing_ok=True)
+        session.delete()
+    return len(stale)
+
+
+class UploadSizeLimitMiddleware:
+    """Refuse message posts whose declared length is over the attachment limit.
+
+    The check runs in the request phase, before any ``process_view``, so
+    ``CsrfViewMiddleware`` never gets to parse (and spool to disk) an
+    oversized body.  It has to sit after ``MessageMiddleware`` to report the
+    error the way the view does.
+    """
+    sync_capable = True
+    async_capable = True
+    view_names = ('send_message',)
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def _applies(self, request):
+        if request.method != 'POST':
+            return False
+        try:
+            return resolve(request.path_info).url_name in self.view_names
+        except Resolver404:
+            return False
+
+    def _refuse(self, request):
+        """A redirect back with an error for an oversized post, else None."""
+        back = redirect(request.META.get('HTTP_REFERER', 'home'))
+        try:
+            channel_id = request.GET.get('channel_id')
+            limit = max_file_size_bytes(Channel.objects.filter(id=channel_id).first() if channel_id else None)
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return back
+        if length <= limit + FORM_OVERHEAD:
+            return None
+        messages.error(request, f'File size exceeds the limit of {limit // (1024 * 1024)}MB.')
+        return back
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        refused = self._refuse(request) if self._applies(request) else None
+        return refused or self.get_response(request)
+
+    async def __acall__(self, request):
+        refused = await sync_to_async(self._refuse)(request) if self._applies(request) else None
+        return refused or await self.get_response(request)
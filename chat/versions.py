@@ -0,0 +1,140 @@
+"""
+Change versions for conditional polling.
+
+Every user and every conversation has a version in the Django cache named
+by ``CHAT_VERSION_CACHE_ALIAS``.  Whatever changes a user's unread counts
+(a message to them, their own reads, joining or leaving a channel) bumps
+the user's version.  Whatever changes what a poll of a conversation returns
+(a new or edited message, somebody reading it) bumps the conversation's
+version.  The polling views put the versions in their ETags, so an
+unchanged poll is answered from the cache alone.
+
+Versions come from one shared counter, so they only ever increase, and a
+bump of many keys is a single ``set_many``.  A version that is missing (never
+bumped, or evicted) reads as the current counter.  No change has happened
+since that value was issued, so an old ETag can match it only when the data
+really is unchanged.  Bumps run after commit, so a poll that sees the new
+data never carries the old version.
+
+A process only sees the bumps made in its own cache, so with a per-process
+cache (``LocMemCache``) other workers would keep answering 304 for a
+changed conversation.  ``enabled()`` therefore turns conditional polling on
+only for a shared cache, unless ``CHAT_CONDITIONAL_POLLING`` says otherwise.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import ChannelMembership, conversation_key
+from .shared_caches import is_shared
+
+CLOCK_KEY = 'chat:versions:clock'
+
+
+def _alias():
+    return getattr(settings, 'CHAT_VERSION_CACHE_ALIAS', 'default')
+
+
+def _cache():
+    return caches[_alias()]
+
+
+def shared():
+    """Whether every worker sees the same versions."""
+    return is_shared(_alias())
+
+
+def enabled():
+    """Whether polls may be answered from versions: by default only when they are shared."""
+    setting = getattr(settings, 'CHAT_CONDITIONAL_POLLING', None)
+    return shared() if setting is None else setting
+
+
+def user_version_key(user_id):
+    return f'chat:versions:user:{user_id}'
+
+
+def conversation_version_key(key):
+    return f'chat:versions:conversation:{key}'
+
+
+def _clock(cache, advance):
+    # Seeded from the time, so a counter lost to eviction restarts above the
+    # versions it handed out.
+    cache.add(CLOCK_KEY, time.time_ns() // 1000, None)
+    try:
+        return cache.incr(CLOCK_KEY) if advance else cache.get(CLOCK_KEY)
+    except ValueError:
+        return time.time_ns() // 1000
+
+
+def bump(user_ids=(), conversations=()):
+    """Give the users and conversation keys a new version; call once the change is committed."""
+    keys = [user_version_key(user_id) for user_id in user_ids]
+    keys += [conversation_version_key(key) for key in conversations]
+    if keys:
+        cache = _cache()
+        version = _clock(cache, advance=True)
+        cache.set_many(dict.fromkeys(keys, version), None)
+
+
+def bump_on_commit(user_ids=(), conversations=()):
+    user_ids, conversations = set(user_ids), set(conversations)
+    transaction.on_commit(lambda: bump(user_ids, conversations))
+
+
+def versions(keys):
+    """Current versions of ``keys``; missing ones are stored as the current counter."""
+    cache = _cache()
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        version = _clock(cache, advance=False)
+        for key in missing:
+            cache.add(key, version, None)
+        found.update(cache.get_many(missing))
+    return [found.get(key) for key in keys]
+
+
+def participants(messages):
+    """User ids whose unread counts ``messages`` change, and their conversation keys."""
+    user_ids, conversations, channel_ids = set(), set(), set()
+    for message in messages:
+        conversations.add(message.conversation_key)
+        if message.channel_id:
+            channel_ids.add(message.channel_id)
+        else:
+            user_ids.update((message.sender_id, message.recipient_id))
+    if channel_ids:
+        user_ids.update(ChannelMembership.objects.filter(channel_id__in=channel_ids).values_list('user_id', flat=True))
+    return user_ids, conversations
+
+
+def conversation_participants(keys):
+    """User ids whose unread counts new messages in the conversations ``keys`` change."""
+    user_ids, channel_ids = set(), set()
+    for key in keys:
+        kind, *ids = key.split(':')
+        if kind == 'channel':
+            channel_ids.add(int(ids[0]))
+        else:
+            user_ids.update(int(user_id) for user_id in ids)
+    if channel_ids:
+        user_ids.update(ChannelMembership.objects.filter(channel_id__in=channel_ids).values_list('user_id', flat=True))
+    return user_ids
+
+
+def record_messages(messages):
+    """Bump everything new ``messages`` change, once they are committed."""
+    # Members are looked up after the commit, outside the write transaction.
+    transaction.on_commit(lambda: bump(*participants(messages)))
+
+
+def record_read(user, channel_id=None, peer_id=None):
+    if channel_id:
+        key = conversation_key(channel_id=channel_id)
+    else:
+        key = conversation_key(user_ids=(user.id, peer_id))
+    bump_on_commit([user.id], [key])
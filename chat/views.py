@@ -1,8 +1,38 @@
+import hmac
+import json
+import math
+from functools import wraps
+
 from django.shortcuts import render, redirect
-from django.contrib.auth import login, logout, authenticate
+from django.contrib.auth import SESSION_KEY, login, logout, authenticate
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
-from .models import CustomUser, Channel, Message, ChannelMembership
+from django.conf import settings
+from django.contrib import admin
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse
+from django.urls import reverse
+from django.db import transaction
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from asgiref.sync import sync_to_async
+from .bulk import BulkPostError, post_messages
+from .hub import hub
+from .inbox import inbox_for
+from . import archive, bus, instrumentation, versions, writes
+from .longpoll import TIMEOUT as LONG_POLL_TIMEOUT, wait_for_messages
+from .message_cache import get_cache as get_message_cache, rows_since
+from .media import get_attachment, serve_attachment
+from .memberships import (
+    MembershipError, add_members, can_manage, parse_user_list, remove_members, resolve_user_ids, search_users,
+    set_can_send,
+)
+from .search import search_messages
+from .serializers import MESSAGE_FIELDS, serialize_message, serialize_rows
+from .pagination import apage_before, page_size
+from .uploads import (
+    CHUNK_SIZE as UPLOAD_CHUNK_SIZE, UploadError, append_chunk, finalize, start_upload,
+)
+from .unread import aothers_read_up_to, aunread_counts, channels_with_unread, users_with_unread
+from .models import CustomUser, Channel, Message, ChannelMembership, UploadSession, conversation_key
 from .forms import CustomUserCreationForm, CustomUserUpdateForm, CustomPasswordChangeForm
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib import messages
@@ -61,37 +91,16 @@ def change_password_view(request):
     return render(request, 'change_password.html', {'form': form})
 @login_required
 def home_view(request):
-    message_user_ids = Message.objects.filter(
-        Q(sender=request.user) | Q(recipient=request.user)
-    ).values_list('sender', 'recipient')
-
-    # Flatten and remove duplicates & self
-    user_ids = set()
-    for sender_id, recipient_id in message_user_ids:
-        if sender_id != request.user.id:
-            user_ids.add(sender_id)
-        if recipient_id != request.user.id:
-            user_ids.add(recipient_id)
-
-    users = CustomUser.objects.filter(id__in=user_ids)
-
-    channels = request.user.channels.all()
-    for user in users:
-        user.unread_count = user.unread_messages_count(request.user)
-    for channel in channels:
-        channel.unread_count = channel.unread_messages_count(request.user)
+    users, channels = inbox_for(request.user)
     return render(request, 'home.html', {'users': users, 'channels': channels})
 
-from django.contrib.auth.decorators import login_required
-from django.db.models import Q
-from django.shortcuts import render
-from .models import CustomUser  # adjust if your user model import is different
-
 @login_required
 def search_view(request):
     query = request.GET.get('q', '').strip()
     users = []
     channels = []
+    message_hits, has_more_hits = [], False
+    page = _page_number(request)
 
     if query:
         # Match username, email or phone exactly (case-insensitive)
@@ -103,42 +112,90 @@ def search_view(request):
 
         channels = request.user.channels.filter(name__icontains=query)
 
-        # Optional: attach unread count
-        for user in users:
-            user.unread_count = user.unread_messages_count(request.user)
-
-        for channel in channels:
-            channel.unread_count = channel.unread_messages_count(request.user)
+        users = users_with_unread(request.user, users)
+        channels = channels_with_unread(request.user, channels)
+        message_hits, has_more_hits = search_messages(request.user, query, page)
 
     return render(request, 'home.html', {
         'users': users,
         'channels': channels,
         'query': query,
+        'message_hits': message_hits,
+        'page': page,
+        'has_more_hits': has_more_hits,
     })
 
+def _page_number(request):
+    try:
+        return max(1, int(request.GET.get('page', 1)))
+    except ValueError:
+        return 1
+
 @login_required
-def private_chat_view(request, user_id):
-    recipient = CustomUser.objects.get(id=user_id)
-    messages = Message.objects.filter(
-        Q(sender=request.user, recipient=recipient) | Q(sender=recipient, recipient=request.user)
-    ).order_by('timestamp')
-    Message.objects.filter(sender=recipient, recipient=request.user, read=False).update(read=True)
-    return render(request, 'chat.html', {'recipient': recipient, 'messages': messages})
+def search_messages_view(request):
+    query = request.GET.get('q', '').strip()
+    try:
+        hits, has_more = search_messages(request.user, query, _page_number(request))
+        return JsonResponse({
+            'results': [
+                {
+                    'message_id': hit.message_id,
+                    'channel_id': hit.channel_id,
+                    'user_id': hit.peer_id,
+                    'snippet': hit.snippet,
+                    'url': reverse('channel_chat', args=[hit.channel_id]) if hit.channel_id else reverse('private_chat', args=[hit.peer_id]),
+                }
+                for hit in hits
+            ],
+            'has_more': has_more,
+        })
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
 @login_required
-def channel_chat_view(request, channel_id):
-    channel = Channel.objects.get(id=channel_id)
-    messages = Message.objects.filter(channel=channel).order_by('timestamp')
-    Message.objects.filter(channel=channel, read=False).exclude(sender=request.user).update(read=True)
-    return render(request, 'chat.html', {'channel': channel, 'messages': messages})
+async def private_chat_view(request, user_id):
+    # Also hand the user to the template context, which would load it again.
+    request.user = user = await request.auser()
+    recipient = await CustomUser.objects.aget(id=user_id)
+    rows, has_more = await apage_before(
+        Message.objects.for_conversation(user, peer_id=recipient.id).values(*MESSAGE_FIELDS)
+    )
+    if not has_more:
+        key = conversation_key(user_ids=(user.id, recipient.id))
+        has_more = await sync_to_async(archive.has_older)(key, rows[0]['id'] if rows else None)
+    if rows:
+        await sync_to_async(writes.mark_read)(user, rows[-1]['id'], peer_id=recipient.id)
+    # Templates and context processors are sync code, so render in a thread.
+    return await sync_to_async(_render_chat)(request, rows, has_more, recipient=recipient)
+
+@login_required
+async def channel_chat_view(request, channel_id):
+    request.user = user = await request.auser()
+    channel = await Channel.objects.aget(id=channel_id)
+    rows, has_more = await apage_before(Message.objects.filter(channel=channel).values(*MESSAGE_FIELDS))
+    if not has_more:
+        key = conversation_key(channel_id=channel.id)
+        has_more = await sync_to_async(archive.has_older)(key, rows[0]['id'] if rows else None)
+    if rows:
+        await sync_to_async(writes.mark_read)(user, rows[-1]['id'], channel_id=channel.id)
+    return await sync_to_async(_render_chat)(request, rows, has_more, channel=channel)
+
+def _render_chat(request, rows, has_more, **context):
+    # Message bodies come from the fragment cache rather than the template loop.
+    return render(request, 'chat.html', {'messages': serialize_rows(rows, request.user.id), 'has_more': has_more, **context})
 
 @login_required
 def create_channel_view(request):
     if request.method == 'POST':
         name = request.POST.get('name')
         is_group_chat = request.POST.get('is_group_chat') == 'on'
+        # Broadcast channels are one-to-many by definition.
+        is_broadcast = request.POST.get('is_broadcast') == 'on' and not is_group_chat
         max_file_size = request.POST.get('max_file_size', 10)
-        channel = Channel.objects.create(name=name, created_by=request.user, is_group_chat=is_group_chat, max_file_size=max_file_size)
+        channel = Channel.objects.create(
+            name=name, created_by=request.user, is_group_chat=is_group_chat, is_broadcast=is_broadcast,
+            max_file_size=max_file_size,
+        )
         ChannelMembership.objects.create(user=request.user, channel=channel, can_send_messages=True)
         if request.FILES.get('channel_image'):
             channel.channel_image = request.FILES.get('channel_image')
@@ -154,45 +211,124 @@ def add_channel_member_view(request, channel_id):
         user = CustomUser.objects.get(id=user_id)
         ChannelMembership.objects.create(user=user, channel=channel, can_send_messages=False)
         return redirect('channel_chat', channel_id=channel.id)
-    users = CustomUser.objects.exclude(id__in=channel.members.all())
-    return render(request, 'add_member.html', {'channel': channel, 'users': users})
+    # Candidates come from the paginated user_search typeahead, not a full user list.
+    return render(request, 'add_member.html', {'channel': channel})
+
+MEMBERSHIP_ACTIONS = {
+    'add': add_members,
+    'remove': remove_members,
+    'allow': lambda channel, user_ids: set_can_send(channel, user_ids, True),
+    'disallow': lambda channel, user_ids: set_can_send(channel, user_ids, False),
+}
+
+@login_required
+def channel_members_view(request, channel_id):
+    """Bulk membership change: ``action`` (add/remove/allow/disallow) for ``user_ids``
+    or a CSV of ids/usernames (``csv`` text or upload), as JSON or form data."""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    channel = Channel.objects.filter(id=channel_id).first()
+    if channel is None:
+        return JsonResponse({'error': 'Channel not found'}, status=404)
+    if not can_manage(request.user, channel):
+        return JsonResponse({'error': 'Only the channel owner can manage members.'}, status=403)
+    try:
+        if request.content_type == 'application/json':
+            data = json.loads(request.body)
+            action, tokens, text = data.get('action'), data.get('user_ids', []), data.get('csv', '')
+        else:
+            action, tokens, text = request.POST.get('action'), request.POST.getlist('user_ids'), request.POST.get('csv', '')
+            if request.FILES.get('csv'):
+                text += '\n' + request.FILES['csv'].read().decode('utf-8-sig')
+        if action not in MEMBERSHIP_ACTIONS:
+            raise MembershipError(f'Unknown action {action!r}.')
+        user_ids = resolve_user_ids(list(tokens) + parse_user_list(text))
+        changed = MEMBERSHIP_ACTIONS[action](channel, user_ids)
+        return JsonResponse({'action': action, 'requested': len(user_ids), 'changed': changed})
+    except MembershipError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
 @login_required
-def send_message_view(request):
+def user_search_view(request):
+    """Typeahead for member pickers: username prefix ``q``, optionally excluding ``channel_id``'s members."""
+    channel = None
+    if request.GET.get('channel_id'):
+        channel = Channel.objects.filter(id=request.GET['channel_id']).first()
+    try:
+        limit = int(request.GET.get('limit', 0)) or None
+    except ValueError:
+        limit = None
+    users, next_after = search_users(
+        request.GET.get('q', '').strip(), exclude_channel=channel, after=request.GET.get('after'), limit=limit,
+    )
+    return JsonResponse({
+        'users': [{'id': user.id, 'username': user.username, 'name': user.get_full_name()} for user in users],
+        'next': next_after,
+    })
+
+BULK_MAX_MESSAGES = getattr(settings, 'CHAT_BULK_MAX_MESSAGES', 10000)
+
+def _publish(message):
+    hub.publish(message.conversation_key, serialize_message(message))
+    bus.notify(message.conversation_key, message.id)
+
+def publish_message(message):
+    """Push a freshly saved message to its subscribers, here and in other processes, once it is committed."""
+    transaction.on_commit(lambda: _publish(message))
+
+def save_message(message):
+    message.save()
+    publish_message(message)
+
+def _parse_body(request):
+    return request.POST, request.FILES
+
+@login_required
+async def send_message_view(request):
     if request.method == 'POST':
-        content = request.POST.get('content', '').strip()
-        file = request.FILES.get('file', None)
-        channel_id = request.POST.get('channel_id')
-        recipient_id = request.POST.get('recipient_id')
+        # Oversized bodies were refused by UploadSizeLimitMiddleware.  The CSRF
+        # check has usually parsed the body already; if not, parsing spools
+        # large uploads to disk, so keep it off the event loop.
+        post, files = await sync_to_async(_parse_body, thread_sensitive=False)(request)
+        content = post.get('content', '').strip()
+        file = files.get('file', None)
+        channel_id = post.get('channel_id')
+        recipient_id = post.get('recipient_id')
 
         if not content and not file:
             messages.error(request, 'Please enter a message or select a file.')
             return redirect(request.META.get('HTTP_REFERER', 'home'))
 
         try:
-            message = Message(sender=request.user)
+            user = await request.auser()
+            message = Message(sender=user)
             if content:
                 message.content = content
             if file:
                 if channel_id:
-                    channel = Channel.objects.get(id=channel_id)
+                    channel = await Channel.objects.aget(id=channel_id)
                     file_size_mb = file.size / (1024 * 1024)
                     if file_size_mb > channel.max_file_size:
                         messages.error(request, f'File size exceeds channel limit of {channel.max_file_size}MB.')
                         return redirect(request.META.get('HTTP_REFERER', 'home'))
                 message.file = file
             if channel_id:
-                channel = Channel.objects.get(id=channel_id)
-                if not (request.user.is_superuser or ChannelMembership.objects.filter(user=request.user, channel=channel, can_send_messages=True).exists()):
+                channel = await Channel.objects.aget(id=channel_id)
+                if not (user.is_superuser or await ChannelMembership.objects.filter(user=user, channel=channel, can_send_messages=True).aexists()):
                     messages.error(request, 'You do not have permission to send messages in this channel.')
                     return redirect(request.META.get('HTTP_REFERER', 'home'))
                 message.channel = channel
             elif recipient_id:
-                message.recipient = CustomUser.objects.get(id=recipient_id)
+                message.recipient = await CustomUser.objects.aget(id=recipient_id)
             else:
                 messages.error(request, 'Invalid chat context.')
                 return redirect('home')
-            message.save()
+            if file:
+                # Store the attachment from the thread pool, outside the write transaction.
+                await sync_to_async(message.file.save, thread_sensitive=False)(file.name, file, save=False)
+            await sync_to_async(writes.run)(save_message, message)
             return redirect(request.META.get('HTTP_REFERER', 'home'))
         except Exception as e:
             messages.error(request, f'Error sending message: {str(e)}')
@@ -200,68 +336,322 @@ def send_message_view(request):
     return redirect('home')
 
 @login_required
-def get_messages_view(request):
-    channel_id = request.GET.get('channel_id')
-    recipient_id = request.GET.get('recipient_id')
-    last_message_id = request.GET.get('last_message_id', 0)
+def upload_start_view(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    try:
+        channel_id = request.POST.get('channel_id')
+        recipient_id = request.POST.get('recipient_id')
+        session = start_upload(
+            request.user,
+            filename=request.POST.get('filename', ''),
+            size=int(request.POST.get('size', 0)),
+            channel=Channel.objects.get(id=channel_id) if channel_id else None,
+            recipient=CustomUser.objects.get(id=recipient_id) if recipient_id else None,
+            content=request.POST.get('content', '').strip(),
+        )
+        return JsonResponse({'upload_id': str(session.id), 'offset': 0, 'chunk_size': UPLOAD_CHUNK_SIZE})
+    except UploadError as e:
+        return JsonResponse({'error': str(e), **e.extra}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+def _chunk_offset(request):
+    content_range = request.headers.get('Content-Range', '')
+    if content_range.startswith('bytes '):
+        return int(content_range[len('bytes '):].split('-', 1)[0])
+    return int(request.GET.get('offset', 0))
+
+@login_required
+def upload_chunk_view(request, upload_id):
+    session = UploadSession.objects.filter(id=upload_id, user=request.user).first()
+    if session is None:
+        return JsonResponse({'error': 'Unknown upload'}, status=404)
+    if request.method == 'GET':
+        return JsonResponse({'offset': session.received, 'size': session.total_size})
+    if request.method not in ('PUT', 'POST'):
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    try:
+        offset = append_chunk(session, _chunk_offset(request), request, int(request.META.get('CONTENT_LENGTH') or 0))
+        if offset < session.total_size:
+            return JsonResponse({'offset': offset, 'complete': False})
+        message = finalize(session)
+        publish_message(message)
+        return JsonResponse({'offset': offset, 'complete': True, 'message_id': message.id})
+    except UploadError as e:
+        return JsonResponse({'error': str(e), **e.extra}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+@login_required
+def attachment_view(request, message_id):
+    try:
+        message = get_attachment(request.user, message_id)
+    except Http404:
+        message = archive.get_attachment(request.user, message_id)
+    # Falls back to the original while the thumbnail is still being rendered.
+    thumbnail = message.thumbnail if request.GET.get('thumbnail') else None
+    return serve_attachment(request, message, thumbnail)
+
+@login_required
+def bulk_post_messages_view(request):
+    """Post many text messages in one request: ``{"messages": [{"channel_id"|"recipient_id", "content"}, ...]}``.
 
+    Staff only.  Superusers may also set ``sender_id`` per message, e.g. to import history.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
     try:
-        messages = []
-        if channel_id:
-            channel = Channel.objects.get(id=channel_id)
-            messages = Message.objects.filter(channel=channel, id__gt=last_message_id).order_by('timestamp')
-        elif recipient_id:
-            recipient = CustomUser.objects.get(id=recipient_id)
-            messages = Message.objects.filter(
-                Q(sender=request.user, recipient=recipient) | Q(sender=recipient, recipient=request.user),
-                id__gt=last_message_id
-            ).order_by('timestamp')
+        items = json.loads(request.body)['messages']
+        if len(items) > BULK_MAX_MESSAGES:
+            return JsonResponse({'error': f'At most {BULK_MAX_MESSAGES} messages per request.'}, status=413)
+        for item in items:
+            item['sender_id'] = int(item.get('sender_id') or request.user.id)
+        if not request.user.is_superuser and any(item['sender_id'] != request.user.id for item in items):
+            return JsonResponse({'error': 'Only superusers may post as someone else.'}, status=403)
+        users = CustomUser.objects.in_bulk(
+            {item['sender_id'] for item in items} | {int(item['recipient_id']) for item in items if item.get('recipient_id')}
+        )
+        channels = Channel.objects.in_bulk({int(item['channel_id']) for item in items if item.get('channel_id')})
+        if not request.user.is_superuser:
+            allowed = set(ChannelMembership.objects.filter(
+                user=request.user, channel_id__in=channels, can_send_messages=True
+            ).values_list('channel_id', flat=True))
+            if set(channels) - allowed:
+                return JsonResponse({'error': 'You do not have permission to send messages in this channel.'}, status=403)
+        try:
+            to_post = [
+                Message(
+                    sender=users[item['sender_id']],
+                    channel=channels[int(item['channel_id'])] if item.get('channel_id') else None,
+                    recipient=users[int(item['recipient_id'])] if item.get('recipient_id') else None,
+                    content=item.get('content'),
+                )
+                for item in items
+            ]
+        except KeyError as e:
+            return JsonResponse({'error': f'Unknown user or channel {e}.'}, status=400)
+        post_messages(to_post)
+        return JsonResponse({'ids': [message.id for message in to_post]})
+    except (KeyError, ValueError, TypeError, BulkPostError) as e:
+        return JsonResponse({'error': str(e) or 'Invalid request'}, status=400)
+
+async def _arequested_conversation(user, params):
+    """Resolve ``channel_id``/``recipient_id`` from ``params`` to a queryset, conversation kwargs and channel."""
+    channel_id = params.get('channel_id')
+    recipient_id = params.get('recipient_id')
+    if channel_id:
+        channel = await Channel.objects.aget(id=channel_id)
+        return Message.objects.filter(channel=channel), {'channel_id': channel.id}, channel
+    if recipient_id:
+        recipient = await CustomUser.objects.aget(id=recipient_id)
+        return Message.objects.for_conversation(user, peer_id=recipient.id), {'peer_id': recipient.id}, None
+    return None, None, None
+
+def _conversation_key(user, conversation):
+    if 'channel_id' in conversation:
+        return conversation_key(channel_id=conversation['channel_id'])
+    return conversation_key(user_ids=(user.id, conversation['peer_id']))
+
+async def _amessages_payload(user, rows, conversation, channel=None):
+    if not rows:
+        return []
+    if channel is not None and channel.is_broadcast:
+        # Broadcasts have no read receipts; skip aggregating every member's cursor.
+        read_up_to = None
+    else:
+        read_up_to = await aothers_read_up_to(user, **conversation)
+    return serialize_rows(rows, user.id, read_up_to)
+
+def _poll_etag(request, etag_for):
+    user_id = request.session.get(SESSION_KEY)
+    return etag_for(int(user_id), request.GET) if user_id else None
+
+def conditional_poll(etag_for):
+    """Answer a poll whose ``If-None-Match`` is still current with a 304, before authenticating.
+
+    ``etag_for(user_id, params)`` builds the ETag from change versions (chat/versions.py)
+    or returns None; it is computed before the view runs, so a change made while
+    the view reads is never hidden behind the new response's ETag.  Without a
+    version cache every worker shares, polls always get the full response.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            # Other workers' messages reach this process's caches and versions over the bus.
+            bus.start()
+            if not versions.enabled():
+                return await view(request, *args, **kwargs)
+            etag = await sync_to_async(_poll_etag)(request, etag_for)
+            if etag and etag in parse_etags(request.headers.get('If-None-Match', '')):
+                return HttpResponseNotModified(headers={'ETag': etag})
+            response = await view(request, *args, **kwargs)
+            if etag and response.status_code == 200:
+                response['ETag'] = etag
+                patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+def _messages_etag(user_id, params):
+    try:
+        last_message_id = int(params.get('last_message_id') or 0)
+        if params.get('channel_id'):
+            key = conversation_key(channel_id=int(params['channel_id']))
+        elif params.get('recipient_id'):
+            key = conversation_key(user_ids=(user_id, int(params['recipient_id'])))
         else:
+            return None
+    except ValueError:
+        return None
+    version, = versions.versions([versions.conversation_version_key(key)])
+    return f'"m{user_id}.{version}.{last_message_id}"'
+
+def _unread_etag(user_id, params):
+    version, = versions.versions([versions.user_version_key(user_id)])
+    return f'"u{user_id}.{version}"'
+
+@conditional_poll(_messages_etag)
+@login_required
+async def get_messages_view(request):
+    last_message_id = request.GET.get('last_message_id', 0)
+
+    try:
+        user = await request.auser()
+        queryset, conversation, channel = await _arequested_conversation(user, request.GET)
+        if queryset is None:
+            return JsonResponse({'error': 'Invalid request'}, status=400)
+
+        rows, has_more = await sync_to_async(rows_since)(_conversation_key(user, conversation), last_message_id)
+        message_data = await _amessages_payload(user, rows, conversation, channel)
+        if rows:
+            await sync_to_async(writes.mark_read)(user, rows[-1]['id'], **conversation)
+        return JsonResponse({'messages': message_data, 'has_more': has_more})
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+@login_required
+async def wait_messages_view(request):
+    """Long-poll variant of get_messages_view: holds the request until a message arrives or ``timeout``."""
+    try:
+        last_message_id = int(request.GET.get('last_message_id', 0))
+        timeout = float(request.GET.get('timeout', LONG_POLL_TIMEOUT))
+        if not math.isfinite(timeout):
+            return JsonResponse({'error': 'Invalid timeout'}, status=400)
+        timeout = max(0.0, min(timeout, LONG_POLL_TIMEOUT))
+        user = await request.auser()
+        queryset, conversation, channel = await _arequested_conversation(user, request.GET)
+        if queryset is None:
             return JsonResponse({'error': 'Invalid request'}, status=400)
 
-        message_data = [
-            {
-                'id': msg.id,
-                'sender': msg.sender.get_full_name() or msg.sender.username,
-                'sender_profile_image': msg.sender.get_profile_image(),
-                'content': msg.content or '',
-                'file_url': msg.file.url if msg.file else '',
-                'file_type': (
-                    'image' if msg.file and msg.file.name.lower().endswith(('.jpg', '.png', '.jpeg', '.gif')) else
-                    'video' if msg.file and msg.file.name.lower().endswith(('.mp4', '.webm')) else
-                    'audio' if msg.file and msg.file.name.lower().endswith(('.mp3', '.wav')) else
-                    'file'
-                ),
-                'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M'),
-                'is_sent': msg.sender == request.user,
-                'read': msg.read
-            }
-            for msg in messages
-        ]
-        if channel_id:
-            Message.objects.filter(channel=channel, read=False).exclude(sender=request.user).update(read=True)
-        elif recipient_id:
-            Message.objects.filter(sender=recipient, recipient=request.user, read=False).update(read=True)
-        return JsonResponse({'messages': message_data})
+        rows, has_more = await wait_for_messages(_conversation_key(user, conversation), last_message_id, timeout)
+        message_data = await _amessages_payload(user, rows, conversation, channel)
+        if rows:
+            await sync_to_async(writes.mark_read)(user, rows[-1]['id'], **conversation)
+        return JsonResponse({'messages': message_data, 'has_more': has_more})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 @login_required
-def get_unread_counts(request):
+def message_cache_stats_view(request):
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
+    cache = get_message_cache()
+    return JsonResponse(cache.stats() if cache else {'backend': None})
+
+def _message_cache_metrics():
+    cache = get_message_cache()
+    if not cache:
+        return []
+    stats = cache.stats()
+    return [
+        ('chat_message_cache_hits_total', 'counter', 'Polls answered from the message cache.', stats['hits']),
+        ('chat_message_cache_misses_total', 'counter', 'Polls that fell back to the database.', stats['misses']),
+    ]
+
+def instrumentation_view(request):
+    """Admin page with the per-view request metrics, hottest views first."""
+    if request.method == 'POST' and 'reset' in request.POST:
+        instrumentation.reset()
+        return redirect('instrumentation')
+    views, repeats = instrumentation.snapshot()
+    rows = [
+        {
+            'view': view,
+            'requests': stats.requests,
+            'errors': stats.errors,
+            'total_seconds': stats.seconds,
+            'mean_ms': 1000 * stats.seconds / stats.requests,
+            'percentiles': [stats.percentile(q) for q in (0.5, 0.95, 0.99)],
+            'mean_bytes': stats.response_bytes // stats.requests,
+            'sampled': stats.sampled,
+            'queries': stats.queries / stats.sampled if stats.sampled else None,
+            'query_ms': 1000 * stats.query_seconds / stats.sampled if stats.sampled else None,
+        }
+        for view, stats in views.items()
+    ]
+    rows.sort(key=lambda row: row['total_seconds'], reverse=True)
+    repeated = sorted(
+        ({'view': view, 'sql': sql, 'requests': flagged, 'most': most} for (view, sql), (flagged, most) in repeats.items()),
+        key=lambda row: (row['requests'], row['most']), reverse=True,
+    )
+    cache = get_message_cache()
+    return render(request, 'admin/instrumentation.html', {
+        **admin.site.each_context(request),
+        'title': 'Request instrumentation',
+        'rows': rows,
+        'repeated': repeated,
+        'message_cache': cache.stats() if cache else None,
+        'sample_rate': getattr(settings, 'CHAT_INSTRUMENTATION_SAMPLE_RATE', 0.1),
+        'repeat_threshold': getattr(settings, 'CHAT_INSTRUMENTATION_REPEAT_THRESHOLD', 5),
+    })
+
+def metrics_view(request):
+    """Prometheus scrape endpoint: staff sessions, or ``Authorization: Bearer <CHAT_METRICS_TOKEN>``."""
+    token = getattr(settings, 'CHAT_METRICS_TOKEN', None)
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not request.user.is_staff and not (token and hmac.compare_digest(supplied, token)):
+        return HttpResponse('Forbidden\n', status=403, content_type='text/plain')
+    return HttpResponse(
+        instrumentation.prometheus_text(_message_cache_metrics()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
+
+@login_required
+async def get_history_view(request):
+    before_id = request.GET.get('before_id')
+
     try:
-        users = CustomUser.objects.exclude(id=request.user.id)
-        channels = request.user.channels.all()
-        user_data = [
-            {'id': user.id, 'unread_count': user.unread_messages_count(request.user)}
-            for user in users
-        ]
-        channel_data = [
-            {'id': channel.id, 'unread_count': channel.unread_messages_count(request.user)}
-            for channel in channels
-        ]
+        user = await request.auser()
+        queryset, conversation, channel = await _arequested_conversation(user, request.GET)
+        if queryset is None:
+            return JsonResponse({'error': 'Invalid request'}, status=400)
+
+        size = page_size(request.GET.get('limit'))
+        rows, has_more = await apage_before(queryset.values(*MESSAGE_FIELDS), before_id, size)
+        if not has_more:
+            # The table has run out; continue with archived messages.
+            older, has_more = await sync_to_async(archive.page_before)(
+                _conversation_key(user, conversation), rows[0]['id'] if rows else before_id, size - len(rows),
+            )
+            rows = older + rows
         return JsonResponse({
-            'users': user_data,
-            'channels': channel_data
+            'messages': await _amessages_payload(user, rows, conversation, channel),
+            'has_more': has_more,
         })
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=400)
\ No newline at end of file
+        return JsonResponse({'error': str(e)}, status=400)
+
+@conditional_poll(_unread_etag)
+@login_required
+async def get_unread_counts(request):
+    try:
+        counts = await aunread_counts(await request.auser())
+        return JsonResponse({
+            'users': [{'id': user_id, 'unread_count': count} for user_id, count in counts['users'].items()],
+            'channels': [{'id': channel_id, 'unread_count': count} for channel_id, count in counts['channels'].items()],
+        })
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
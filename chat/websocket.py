@@ -0,0 +1,188 @@
+"""
+WebSocket endpoint that pushes new messages to open chat pages.
+
+Clients connect to ``/ws/chat/?channel_id=<id>`` or ``/ws/chat/?recipient_id=<id>``
+(optionally with ``last_message_id`` to catch up on anything sent between the
+page render and the socket opening) and receive the same JSON shape that
+``get_messages_view`` returns.  The polling endpoint remains as a fallback.
+Messages saved by other processes arrive from the bus as hints and are read
+from the database.
+"""
+import asyncio
+import json
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import parse_qs, urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import aget_user
+from django.http.request import split_domain_port, validate_host
+from django.utils.http import is_same_domain
+
+from . import bus
+from .hub import hub
+from .serializers import MESSAGE_FIELDS, serialize_rows
+from .writes import mark_read
+from .models import Channel, ChannelMembership, CustomUser, Message, conversation_key
+
+WEBSOCKET_PATH = '/ws/chat/'
+
+
+class _SessionRequest:
+    """Just enough of an HttpRequest for ``aget_user``."""
+
+    def __init__(self, session):
+        self.session = session
+
+
+def _get_header(scope, name):
+    for key, value in scope.get('headers', []):
+        if key.decode('latin1').lower() == name:
+            return value.decode('latin1')
+    return ''
+
+
+def _origin_allowed(scope):
+    """Whether the handshake comes from one of our own pages, as the CSRF check requires for forms."""
+    origin = _get_header(scope, 'origin')
+    if not origin:
+        return False
+    for trusted in settings.CSRF_TRUSTED_ORIGINS:
+        scheme, _, host = trusted.partition('://')
+        parsed = urlsplit(origin)
+        if parsed.scheme == scheme and is_same_domain(parsed.netloc, host):
+            return True
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    domain, _ = split_domain_port(urlsplit(origin).netloc)
+    return bool(domain) and validate_host(domain, allowed_hosts)
+
+
+async def _authenticate(scope):
+    cookie = SimpleCookie()
+    cookie.load(_get_header(scope, 'cookie'))
+    morsel = cookie.get(settings.SESSION_COOKIE_NAME)
+    if morsel is None:
+        return None
+    engine = import_module(settings.SESSION_ENGINE)
+    user = await aget_user(_SessionRequest(engine.SessionStore(morsel.value)))
+    return user if user.is_authenticated else None
+
+
+def _resolve_conversation(user, params):
+    """Return ``(key, channel_id, peer_id)`` if ``user`` may follow the conversation."""
+    channel_id = params.get('channel_id')
+    recipient_id = params.get('recipient_id')
+    if channel_id:
+        channel = Channel.objects.filter(id=channel_id).first()
+        if channel is None:
+            return None
+        if not (user.is_superuser or ChannelMembership.objects.filter(user=user, channel=channel).exists()):
+            return None
+        return conversation_key(channel_id=channel.id), channel.id, None
+    if recipient_id:
+        recipient = CustomUser.objects.filter(id=recipient_id).first()
+        if recipient is None:
+            return None
+        return conversation_key(user_ids=(user.id, recipient.id)), None, recipient.id
+    return None
+
+
+def _fetch_since(user, channel_id, peer_id, last_message_id):
+    rows = Message.objects.for_conversation(
+        user, channel_id=channel_id, peer_id=peer_id
+    ).filter(id__gt=last_message_id).order_by('id').values(*MESSAGE_FIELDS)
+    return serialize_rows(rows, user.id)
+
+
+def _mark_read(user, channel_id, peer_id, up_to):
+    mark_read(user, up_to, channel_id=channel_id, peer_id=peer_id)
+
+
+async def _send_json(send, data):
+    await send({'type': 'websocket.send', 'text': json.dumps(data)})
+
+
+async def websocket_application(scope, receive, send):
+    if scope['path'] != WEBSOCKET_PATH:
+        await receive()
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    # The session cookie rides along on cross-site handshakes too.
+    if not _origin_allowed(scope):
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+
+    user = await _authenticate(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': 4401})
+        return
+
+    params = {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode()).items()}
+    conversation = await sync_to_async(_resolve_conversation)(user, params)
+    if conversation is None:
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+    key, channel_id, peer_id = conversation
+
+    # Subscribe before catching up so nothing saved in between is lost.
+    bus.start()
+    subscription = hub.subscribe(key)
+    receive_task = push_task = None
+    await send({'type': 'websocket.accept'})
+    try:
+        try:
+            last_message_id = int(params.get('last_message_id', 0))
+        except ValueError:
+            last_message_id = 0
+        backlog = await sync_to_async(_fetch_since)(user, channel_id, peer_id, last_message_id)
+        if backlog:
+            last_message_id = backlog[-1]['id']
+            await _send_json(send, {'messages': backlog})
+            await sync_to_async(_mark_read)(user, channel_id, peer_id, last_message_id)
+
+        receive_task = asyncio.ensure_future(receive())
+        push_task = asyncio.ensure_future(subscription.get())
+        while True:
+            done, _ = await asyncio.wait({receive_task, push_task}, return_when=asyncio.FIRST_COMPLETED)
+            if receive_task in done:
+                if receive_task.result()['type'] == 'websocket.disconnect':
+                    return
+                # Client frames are only keep-alives; keep listening.
+                receive_task = asyncio.ensure_future(receive())
+            if push_task not in done:
+                continue
+
+            payloads = [push_task.result()]
+            while not subscription.queue.empty():
+                payloads.append(subscription.queue.get_nowait())
+            push_task = asyncio.ensure_future(subscription.get())
+            # Bus hints only carry the newest id of messages another process saved.
+            hinted = any(p.get('last_id', 0) > last_message_id for p in payloads)
+            payloads = [p for p in payloads if 'last_id' not in p]
+            if subscription.overflowed or hinted:
+                # We dropped pushes or were only hinted; re-read everything past the last delivered id.
+                subscription.overflowed = False
+                payloads = await sync_to_async(_fetch_since)(user, channel_id, peer_id, last_message_id)
+            payloads = [
+                dict(p, is_sent=p['sender_id'] == user.id, read=p['sender_id'] != user.id)
+                for p in payloads if p['id'] > last_message_id
+            ]
+            if not payloads:
+                continue
+            last_message_id = max(p['id'] for p in payloads)
+            await _send_json(send, {'messages': payloads})
+            if any(not p['is_sent'] for p in payloads):
+                await sync_to_async(_mark_read)(user, channel_id, peer_id, last_message_id)
+    finally:
+        hub.unsubscribe(subscription)
+        for task in (receive_task, push_task):
+            if task is not None and not task.done():
+                task.cancel()
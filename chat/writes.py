@@ -0,0 +1,160 @@
+"""
+Single writer queue for SQLite.
+
+SQLite allows one writer at a time, so request threads that each open
+their own write transaction queue up on the file lock and eventually fail
+with "database is locked".  With ``CHAT_WRITE_QUEUE`` on, message saves and
+read-cursor updates are handed to one writer thread per process instead.
+That thread runs whatever is waiting, up to ``CHAT_WRITE_BATCH_SIZE`` jobs,
+as a single transaction, so concurrent senders share one commit.
+
+``run`` waits for its job and returns the result.  ``mark_read`` does not
+wait, and repeated marks of one conversation collapse into one pending
+update.  With the queue off both run inline in the caller's thread.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from . import unread
+
+_STOP = object()
+
+_queue = None
+_queue_lock = threading.Lock()
+_pending_reads = {}
+_pending_lock = threading.Lock()
+
+
+class WriteQueue:
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or getattr(settings, 'CHAT_WRITE_BATCH_SIZE', 100)
+        self.batches = self.jobs = 0
+        self._jobs = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._loop, name='chat-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)``; returns a ``Future`` for its result."""
+        future = Future()
+        self._jobs.put((func, args, kwargs, future))
+        return future
+
+    def run(self, func, *args, **kwargs):
+        if threading.current_thread() is self._thread:
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def stop(self):
+        """Finish the queued jobs, close the writer's connection and end its thread."""
+        self._jobs.put(_STOP)
+        self._thread.join()
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            batch = [self._jobs.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = _STOP in batch
+            batch = [job for job in batch if job is not _STOP]
+            if batch:
+                self._execute(batch)
+        connection.close()
+
+    def _execute(self, batch):
+        # The writer is long-lived; honour CONN_MAX_AGE and drop broken connections.
+        close_old_connections()
+        try:
+            with transaction.atomic():
+                results = [func(*args, **kwargs) for func, args, kwargs, _ in batch]
+        except Exception:
+            # Rolled back; run the jobs one by one so only the failing one fails.
+            for job in batch:
+                self._execute_one(job)
+        else:
+            for (_, _, _, future), result in zip(batch, results):
+                future.set_result(result)
+        self.batches += 1
+        self.jobs += len(batch)
+
+    def _execute_one(self, job):
+        func, args, kwargs, future = job
+        try:
+            with transaction.atomic():
+                result = func(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+
+def enabled():
+    return getattr(settings, 'CHAT_WRITE_QUEUE', False)
+
+
+def get_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = WriteQueue()
+        return _queue
+
+
+def stop():
+    """Stop the writer thread, e.g. before the database goes away; the next write starts a new one."""
+    global _queue
+    with _queue_lock:
+        writer, _queue = _queue, None
+    if writer is not None:
+        writer.stop()
+
+
+def run(func, *args, **kwargs):
+    """Run a write through the queue when it is enabled and return its result."""
+    if not enabled():
+        return func(*args, **kwargs)
+    return get_queue().run(func, *args, **kwargs)
+
+
+def mark_read(user, up_to, channel_id=None, peer_id=None):
+    """``unread.mark_read`` through the queue, without waiting for it."""
+    if not enabled():
+        return unread.mark_read(user, up_to, channel_id=channel_id, peer_id=peer_id)
+    if not up_to:
+        return
+    key = (user.id, channel_id, peer_id)
+    with _pending_lock:
+        queued = key in _pending_reads
+        _pending_reads[key] = max(up_to, _pending_reads.get(key, 0))
+    if not queued:
+        get_queue().submit(_flush_read, user, key)
+
+
+def _flush_read(user, key):
+    with _pending_lock:
+        up_to = _pending_reads.get(key)
+    if up_to is None:
+        return
+    try:
+        unread.mark_read(user, up_to, channel_id=key[1], peer_id=key[2])
+    except Exception:
+        with _pending_lock:
+            _pending_reads.pop(key, None)
+        raise
+    transaction.on_commit(lambda: _read_flushed(user, key, up_to))
+
+
+def _read_flushed(user, key, up_to):
+    with _pending_lock:
+        if _pending_reads.get(key) == up_to:
+            del _pending_reads[key]
+            return
+    # A newer mark arrived while this one was being written.
+    get_queue().submit(_flush_read, user, key)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -39,12 +40,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'chat.fastpath.PollingFastPathMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    # Before any process_view, so the CSRF check never reads an oversized body.
+    'chat.uploads.UploadSizeLimitMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -77,10 +82,83 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-        'timeout': 20,
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
+# Production SQLite profile, enabled with CHAT_DB_PROFILE=production: WAL so
+# readers never wait for the writer, fsync at checkpoints only, a larger page
+# cache and memory-mapped reads, write transactions that take the lock up
+# front instead of failing on upgrade, persistent connections, and message
+# and read-cursor writes funnelled through one writer thread (chat/writes.py).
+SQLITE_PRODUCTION_OPTIONS = {
+    'timeout': 20,
+    'transaction_mode': 'IMMEDIATE',
+    'init_command': (
+        'PRAGMA journal_mode=WAL;'
+        'PRAGMA synchronous=NORMAL;'
+        'PRAGMA cache_size=-65536;'
+        'PRAGMA mmap_size=268435456;'
+        'PRAGMA temp_store=MEMORY;'
+    ),
+}
+
+if os.environ.get('CHAT_DB_PROFILE') == 'production':
+    DATABASES['default'].update({
+        'OPTIONS': SQLITE_PRODUCTION_OPTIONS,
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    })
+    CHAT_WRITE_QUEUE = True
+
+
+# Rendered message markup (chat/fragments.py) gets its own cache so it does
+# not push other entries out of the default one.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chat-fragments',
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+CHAT_FRAGMENT_CACHE_ALIAS = 'fragments'
+
+# The development server is one process, so the per-process message cache
+# (chat/message_cache.py) sees every write.  With several workers leave this
+# unset: it is DjangoMessageCache when 'default' is shared, otherwise off.
+if DEBUG:
+    CHAT_MESSAGE_CACHE_BACKEND = 'chat.message_cache.LocMemMessageCache'
+
+# Conditional polling (ETags from chat/versions.py) needs the change versions
+# in a cache every worker shares; with several workers and the LocMem
+# 'default' above leave this unset, and polls always get full responses.
+if DEBUG:
+    CHAT_CONDITIONAL_POLLING = True
+
+
+# Sessions are read on every poll; keep them in the cache, backed by the
+# database, but only when that cache is shared (Redis, memcached).  With a
+# per-process cache a logout would only end the session in one worker, so
+# sessions stay in the database.  Independently of the engine, the polling
+# fast path (chat/fastpath.py) caches sessions and users per process for
+# CHAT_FAST_PATH_SESSION_TTL and CHAT_FAST_PATH_USER_TTL (30) seconds: other
+# workers see a logout, a password change or a deactivation up to that long
+# after it happens.
+SESSION_CACHE_ALIAS = 'default'
+if CACHES[SESSION_CACHE_ALIAS]['BACKEND'] not in (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+):
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+else:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -17,22 +17,33 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from chat import views
-from django.conf import settings
-from django.conf.urls.static import static
+from chat.media import public_media_urls
 
 urlpatterns = [
+    path('admin/instrumentation/', admin.site.admin_view(views.instrumentation_view), name='instrumentation'),
     path('admin/', admin.site.urls),
+    path('metrics/', views.metrics_view, name='metrics'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('profile/', views.profile_view, name='profile'),
     path('profile/change-password/', views.change_password_view, name='change_password'),
     path('', views.home_view, name='home'),
     path('search/', views.search_view, name='search'),
+    path('search/messages/', views.search_messages_view, name='search_messages'),
     path('chat/private/<int:user_id>/', views.private_chat_view, name='private_chat'),
     path('chat/channel/<int:channel_id>/', views.channel_chat_view, name='channel_chat'),
     path('channel/create/', views.create_channel_view, name='create_channel'),
     path('channel/<int:channel_id>/add_member/', views.add_channel_member_view, name='add_channel_member'),
+    path('channel/<int:channel_id>/members/', views.channel_members_view, name='channel_members'),
+    path('users/search/', views.user_search_view, name='user_search'),
     path('chat/send/', views.send_message_view, name='send_message'),
+    path('chat/upload/', views.upload_start_view, name='upload_start'),
+    path('chat/upload/<uuid:upload_id>/', views.upload_chunk_view, name='upload_chunk'),
     path('chat/messages/', views.get_messages_view, name='get_messages'),
+    path('chat/messages/wait/', views.wait_messages_view, name='wait_messages'),
+    path('chat/messages/bulk/', views.bulk_post_messages_view, name='bulk_post_messages'),
+    path('chat/messages/cache-stats/', views.message_cache_stats_view, name='message_cache_stats'),
+    path('chat/attachments/<int:message_id>/', views.attachment_view, name='message_attachment'),
+    path('chat/history/', views.get_history_view, name='get_history'),
     path('chat/unread_counts/', views.get_unread_counts, name='get_unread_counts'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+] + public_media_urls()
\ No newline at end of file